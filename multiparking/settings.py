@@ -114,6 +114,19 @@ DATABASES = {
 }
 
 
+# Caché
+# Los snapshots de los dashboards se guardan aquí con VersionParqueadero en la clave
+# (parqueadero.utils.obtener_snapshot). LocMem es por proceso: con varios workers de
+# gunicorn cada uno calcula una vez por cambio. Para compartirlo entre workers basta
+# con cambiar el backend (Redis, Memcached o DatabaseCache) sin tocar el código.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'multiparking',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -201,6 +214,22 @@ if not DEBUG:
     SESSION_COOKIE_SECURE = True
     CSRF_COOKIE_SECURE = True
 
+# ── Cámaras LPR de las rampas ───────────────────────────────────────────────
+# Claves separadas por coma; cada cámara envía `Authorization: Bearer <clave>`.
+LPR_API_KEYS = [k.strip() for k in os.getenv('LPR_API_KEYS', '').split(',') if k.strip()]
+
+# ── QR por espacio ──────────────────────────────────────────────────────────
+# Con True cada espacio tiene su QR firmado (hoja PDF por piso en "Generar QR"):
+# escanearlo registra el ingreso directo en ese espacio, sin buscar en el pool de libres.
+QR_POR_ESPACIO = os.getenv('QR_POR_ESPACIO', '').lower() in ('1', 'true', 'yes')
+
+# ── Dashboards en vivo (Server-Sent Events) ─────────────────────────────────
+# Cada stream SSE mantiene abierta su conexión hasta ~25s; con los workers síncronos
+# por defecto de gunicorn eso bloquea un worker entero por navegador. Activarlo solo
+# con workers de hilos (`gunicorn multiparking.wsgi -k gthread --threads 8`, ver el
+# manual de despliegue). Apagado, los dashboards refrescan por polling cada 10s.
+DASHBOARD_SSE = os.getenv('DASHBOARD_SSE', '').lower() in ('1', 'true', 'yes')
+
 # ── Email: Resend HTTP API (prioritario) / SendGrid (fallback) ───────────────
 _resend_key = os.getenv('RESEND_API_KEY', '')
 if _resend_key:
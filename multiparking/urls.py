@@ -14,20 +14,22 @@ from usuarios.views import (
     AdminTestEmailView,
 )
 from parqueadero.views import (
-    AdminDashboardView, AdminDashboardDataView,
+    AdminDashboardView, AdminDashboardDataView, AdminDashboardStreamView, AdminDashboardMetricasView,
+    AdminDashboardMapaView, AdminDashboardGraficasView, AdminDashboardReservasView,
     PisoListView, PisoCreateView, PisoUpdateView, PisoDeleteView,
     TipoEspacioListView, TipoEspacioCreateView, TipoEspacioUpdateView, TipoEspacioDeleteView,
     EspacioListView, EspacioCreateView, EspacioUpdateView, EspacioDeleteView, EspacioRangeCreateView,
     InventarioListView,
-    EntradaParqueaderoView, EscanearQRView, GenerarQRView
+    EntradaParqueaderoView, EntradaEspacioView, EscanearQRView, GenerarQRView, QREspaciosPDFView
 )
 from parqueadero.vigilante_views import (
-    VigilanteDashboardView, VigilanteDashboardDataView,
+    VigilanteDashboardView, VigilanteDashboardDataView, VigilanteDashboardStreamView,
     VigilanteRegistrarIngresoView, VigilanteRegistrarSalidaView,
     VigilanteConfirmarPagoView, VigilanteBuscarVehiculoView,
     VigilanteObtenerDetalleView,
 )
 from parqueadero.cliente_views import ClienteSalidaView
+from parqueadero.camaras_views import CamaraEventosView
 from tarifas.views import (
     TarifaListView, TarifaCreateView, TarifaUpdateView, TarifaToggleView, TarifaDeleteView
 )
@@ -75,6 +77,11 @@ urlpatterns = [
     # Dashboard
     path('admin-panel/', AdminDashboardView.as_view(), name='admin_dashboard'),
     path('admin-panel/api/dashboard-data/', AdminDashboardDataView.as_view(), name='admin_dashboard_data'),
+    path('admin-panel/api/dashboard-stream/', AdminDashboardStreamView.as_view(), name='admin_dashboard_stream'),
+    path('admin-panel/api/dashboard-metricas/', AdminDashboardMetricasView.as_view(), name='admin_dashboard_metricas'),
+    path('admin-panel/api/dashboard-mapa/', AdminDashboardMapaView.as_view(), name='admin_dashboard_mapa'),
+    path('admin-panel/api/dashboard-graficas/', AdminDashboardGraficasView.as_view(), name='admin_dashboard_graficas'),
+    path('admin-panel/api/dashboard-reservas/', AdminDashboardReservasView.as_view(), name='admin_dashboard_reservas'),
 
     # Pisos
     path('admin-panel/pisos/', PisoListView.as_view(), name='admin_pisos'),
@@ -152,6 +159,7 @@ urlpatterns = [
 
     # Código QR
     path('admin-panel/qr/generar/', GenerarQRView.as_view(), name='admin_generar_qr'),
+    path('admin-panel/qr/pisos/<int:pk>/pdf/', QREspaciosPDFView.as_view(), name='admin_qr_espacios_pdf'),
 
     # Prueba de correos
     path('admin-panel/test-email/', AdminTestEmailView.as_view(), name='admin_test_email'),
@@ -160,17 +168,23 @@ urlpatterns = [
 
     path('guardia/', VigilanteDashboardView.as_view(), name='guardia_dashboard'),
     path('guardia/api/data/', VigilanteDashboardDataView.as_view(), name='guardia_data'),
+    path('guardia/api/stream/', VigilanteDashboardStreamView.as_view(), name='guardia_stream'),
     path('guardia/registrar-ingreso/', VigilanteRegistrarIngresoView.as_view(), name='guardia_registrar_ingreso'),
     path('guardia/registrar-salida/', VigilanteRegistrarSalidaView.as_view(), name='guardia_registrar_salida'),
     path('guardia/confirmar-pago/', VigilanteConfirmarPagoView.as_view(), name='guardia_confirmar_pago'),
     path('guardia/api/buscar-vehiculo/', VigilanteBuscarVehiculoView.as_view(), name='guardia_buscar_vehiculo'),
     path('guardia/api/detalle-ocupacion/', VigilanteObtenerDetalleView.as_view(), name='guardia_detalle_ocupacion'),
 
+    # ── CÁMARAS LPR ──────────────────────────────────────────────────────
+
+    path('api/camaras/eventos/', CamaraEventosView.as_view(), name='camaras_eventos'),
+
     # ── CLIENTE PANEL ────────────────────────────────────────────────────
 
     # Entrada al Parqueadero
     path('parqueadero/escanear/', EscanearQRView.as_view(), name='escanear_qr'),
     path('parqueadero/entrada/', EntradaParqueaderoView.as_view(), name='entrada_parqueadero'),
+    path('parqueadero/entrada/espacio/<str:token>/', EntradaEspacioView.as_view(), name='entrada_espacio'),
     path('parqueadero/salida/', ClienteSalidaView.as_view(), name='cliente_salida'),
 
     # Vehículos del Cliente
@@ -40,3 +40,17 @@ class Pago(models.Model):
 
     def __str__(self):
         return f'Pago {self.pk} - ${self.pagMonto} ({self.pagEstado})'
+
+    def save(self, *args, **kwargs):
+        # Todo save de un Pago en el sistema es un cambio de estado (creación PENDIENTE/
+        # PAGADO o confirmación PENDIENTE → PAGADO) que cambia el mapa de pisos
+        # (espacio amarillo) y la cola de salidas del guardia.
+        from parqueadero.models import VersionParqueadero
+        super().save(*args, **kwargs)
+        VersionParqueadero.incrementar()
+
+    def delete(self, *args, **kwargs):
+        from parqueadero.models import VersionParqueadero
+        resultado = super().delete(*args, **kwargs)
+        VersionParqueadero.incrementar()
+        return resultado
@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.db import transaction
 
 from .models import Espacio, InventarioParqueo, Piso, TipoEspacio
 
@@ -20,6 +21,12 @@ class EspacioAdmin(admin.ModelAdmin):
     list_filter = ('espEstado', 'fkIdPiso', 'fkIdTipoEspacio')
     search_fields = ('espNumero',)
 
+    def delete_queryset(self, request, queryset):
+        # El borrado masivo no llama a Espacio.delete(): uno por uno para mantener los contadores
+        with transaction.atomic():
+            for espacio in queryset:
+                espacio.delete()
+
 
 @admin.register(InventarioParqueo)
 class InventarioParqueoAdmin(admin.ModelAdmin):
@@ -0,0 +1,47 @@
+"""
+API para las cámaras de reconocimiento de placas (LPR) de las rampas.
+
+Las cámaras no tienen sesión: se autentican con una clave (CamaraRequiredMixin) y
+envían lotes de eventos en JSON. La lógica de cada evento vive en services.py.
+"""
+import json
+
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from usuarios.mixins import CamaraRequiredMixin
+
+from .services import MAX_EVENTOS_CAMARA, procesar_eventos_camara
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class CamaraEventosView(CamaraRequiredMixin, View):
+    """
+    POST {"eventos": [{"id", "placa", "porteria", "tipo": "ENTRADA"|"SALIDA", "hora": ISO 8601}]}
+
+    Responde 200 con un resultado por evento (en el orden enviado) aunque algunos sean
+    rechazados; la cámara solo debe reintentar los que vuelvan con estado ERROR.
+    """
+
+    def post(self, request):
+        try:
+            datos = json.loads(request.body)
+        except (ValueError, UnicodeDecodeError):
+            return JsonResponse({'error': 'JSON inválido.'}, status=400)
+
+        eventos = datos.get('eventos') if isinstance(datos, dict) else None
+        if not isinstance(eventos, list) or not eventos:
+            return JsonResponse({'error': 'Se esperaba {"eventos": [...]} con al menos un evento.'}, status=400)
+        if len(eventos) > MAX_EVENTOS_CAMARA:
+            return JsonResponse(
+                {'error': f'Máximo {MAX_EVENTOS_CAMARA} eventos por lote; divide el envío.'}, status=400,
+            )
+
+        resultados = procesar_eventos_camara(eventos)
+        return JsonResponse({
+            'procesados': len(resultados),
+            'aceptados': sum(1 for r in resultados if r['estado'] == 'OK'),
+            'resultados': resultados,
+        })
@@ -1,20 +1,22 @@
 import math
+import uuid
 from decimal import Decimal
 from django.contrib import messages
+from django.db import transaction
 from django.shortcuts import get_object_or_404, redirect, render
 from django.views import View
 from django.utils import timezone
 
-from multiparking import email_utils
-from parqueadero.models import Espacio, InventarioParqueo
+from parqueadero.models import Espacio, InventarioParqueo, SolicitudSalida
+from parqueadero.services import calcular_costo_parqueo, registrar_salida
+from parqueadero.utils import IdempotenteMixin
 from parqueadero.views import ClienteRequiredMixin
 from pagos.models import Pago
 from cupones.models import Cupon, CuponAplicado
 from tarifas.models import Tarifa
-from fidelidad.models import Sticker
 
 
-class ClienteSalidaView(ClienteRequiredMixin, View):
+class ClienteSalidaView(ClienteRequiredMixin, IdempotenteMixin, View):
     """Vista para procesar la salida del vehículo del parqueadero"""
 
     def get(self, request):
@@ -91,6 +93,7 @@ class ClienteSalidaView(ClienteRequiredMixin, View):
             'tarifa_info': tarifa_info,
             'monto_total': monto_total,
             'cupones': cupones_disponibles,
+            'clave_idempotencia': uuid.uuid4().hex,
         })
 
     def post(self, request):
@@ -113,25 +116,12 @@ class ClienteSalidaView(ClienteRequiredMixin, View):
         metodo_pago = request.POST.get('metodo_pago', 'EFECTIVO')
         codigo_cupon = request.POST.get('codigo_cupon', '').strip()
 
-        # Calcular costo
+        # Calcular costo (misma regla que la salida por portería)
         ahora = timezone.now()
-        duracion = ahora - registro.parHoraEntrada
-
-        total_seconds = int(duracion.total_seconds())
-        total_minutos = max((total_seconds + 59) // 60, 1)
-
-        # Obtener tarifa
-        tarifa = Tarifa.objects.filter(
-            fkIdTipoEspacio=registro.fkIdEspacio.fkIdTipoEspacio,
-            activa=True
-        ).first()
-
+        tarifa = Tarifa.get_active_for(registro.fkIdEspacio.fkIdTipoEspacio_id)
         monto_total = Decimal('0')
-        es_visitante = registro.fkIdVehiculo.es_visitante
-
         if tarifa:
-            precio_hora = tarifa.precioHoraVisitante if es_visitante and tarifa.precioHoraVisitante > 0 else tarifa.precioHora
-            monto_total = math.ceil((float(precio_hora) / 60) * total_minutos)
+            monto_total = calcular_costo_parqueo(registro.parHoraEntrada, tarifa, registro.fkIdVehiculo, ahora)
 
         # Aplicar cupón si existe
         cupon = None
@@ -174,48 +164,57 @@ class ClienteSalidaView(ClienteRequiredMixin, View):
         else:  # PSE
             estado_pago = 'PAGADO'     # PSE: pago inmediato, se libera el espacio al instante
 
-        pago = Pago.objects.create(
-            pagMonto=monto_final,
-            pagMetodo=metodo_pago,
-            pagEstado=estado_pago,
-            fkIdParqueo=registro
-        )
-
-        # Aplicar cupón al pago si existe
-        if cupon and monto_descuento > 0:
-            CuponAplicado.objects.create(
-                fkIdPago=pago,
-                fkIdCupon=cupon,
-                montoDescontado=monto_descuento
+        with transaction.atomic():
+            # Bloquea el turno: una salida del guardia en paralelo espera a este pago (y lo
+            # confirma), o ya cerró el turno y no se crea un segundo cobro
+            if not InventarioParqueo.objects.select_for_update().filter(
+                pk=registro.pk, parHoraSalida__isnull=True,
+            ).values_list('pk', flat=True).first():
+                messages.error(request, 'La salida de tu vehículo ya fue registrada.')
+                return redirect('dashboard')
+            if metodo_pago == 'EFECTIVO':
+                # Reenvío del formulario sin clave de idempotencia: el turno ya tiene su pago
+                # en efectivo esperando al guardia y no se crea otro
+                pendiente = Pago.objects.filter(fkIdParqueo=registro, pagEstado='PENDIENTE').first()
+                if pendiente is not None:
+                    return render(request, 'cliente/salida_efectivo.html', {
+                        'registro': registro,
+                        'monto_final': pendiente.pagMonto,
+                        'pago': pendiente,
+                    })
+            pago = Pago.objects.create(
+                pagMonto=monto_final,
+                pagMetodo=metodo_pago,
+                pagEstado=estado_pago,
+                fkIdParqueo=registro
             )
 
+            # Aplicar cupón al pago si existe
+            if cupon and monto_descuento > 0:
+                CuponAplicado.objects.create(
+                    fkIdPago=pago,
+                    fkIdCupon=cupon,
+                    montoDescontado=monto_descuento
+                )
+
+            if metodo_pago == 'EFECTIVO':
+                # EFECTIVO: NO liberar espacio aún, se marca salida desde Vista General
+                # Solo registrar el pago pendiente y encolarlo para el guardia
+                SolicitudSalida.encolar(pago)
+            # PSE: marcar salida, sticker y liberar espacio inmediatamente con el pago ya hecho
+            elif registrar_salida(registro, pago=pago, ahora=ahora) is None:
+                # El guardia registró la salida mientras tanto: no se cobra dos veces
+                transaction.set_rollback(True)
+                messages.error(request, 'La salida de tu vehículo ya fue registrada.')
+                return redirect('dashboard')
+
         if metodo_pago == 'EFECTIVO':
-            # EFECTIVO: NO liberar espacio aún, se marca salida desde Vista General
-            # Solo registrar el pago pendiente
             return render(request, 'cliente/salida_efectivo.html', {
                 'registro': registro,
                 'monto_final': monto_final,
                 'pago': pago,
             })
         else:
-            # PSE: Marcar salida y liberar espacio inmediatamente
-            registro.parHoraSalida = ahora
-            registro.save()
-
-            espacio = registro.fkIdEspacio
-            espacio.espEstado = 'DISPONIBLE'
-            espacio.save()
-
-            # Sticker de fidelidad: si estuvo más de 1 hora y es usuario registrado
-            usuario_vehiculo = registro.fkIdVehiculo.fkIdUsuario
-            if usuario_vehiculo and total_minutos >= 60:
-                Sticker.objects.get_or_create(
-                    fkIdParqueo=registro,
-                    defaults={'fkIdUsuario': usuario_vehiculo}
-                )
-
-            email_utils.enviar_recibo_pago(pago, registro)
-
             return render(request, 'cliente/salida_exitosa.html', {
                 'registro': registro,
                 'monto_final': monto_final,
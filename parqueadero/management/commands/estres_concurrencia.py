@@ -0,0 +1,345 @@
+"""
+Management command que somete el parqueadero a guardias y clientes concurrentes.
+
+Uso:
+    python manage.py estres_concurrencia                         # 4 guardias, 8 clientes, 25 operaciones c/u
+    python manage.py estres_concurrencia --guardias 8 --clientes 32 --operaciones 50 --espacios 40
+    python manage.py estres_concurrencia --mantener              # no borra los datos creados al terminar
+
+Cada guardia y cada cliente es un hilo con su propio django.test.Client y su sesión,
+que hace POST a las mismas vistas que usan las tabletas y los teléfonos:
+  guardias → VigilanteRegistrarIngresoView (visitantes en un espacio al azar)
+             VigilanteRegistrarSalidaView (un turno abierto al azar)
+  clientes → EntradaParqueaderoView (GET que aparta espacio + POST)
+             ClienteSalidaView (PSE, o EFECTIVO y espera a que el guardia lo saque)
+             ClienteCrearReservaView / ClienteCancelarReservaView
+
+Al final reporta rendimiento (operaciones/s) y latencias p50/p95/p99 por operación, y
+verifica las invariantes: ningún espacio ni vehículo con dos turnos abiertos, ningún
+OCUPADO sin turno (ni turno en un espacio que no esté OCUPADO), ningún RESERVADO sin
+reserva ni retención, ningún turno con dos pagos, ninguna reserva duplicada y
+contadores/punteros al día. Sale con error si alguna falla y en ese caso conserva los
+datos para inspeccionarlos.
+
+Crea su propio piso, guardias, clientes y visitantes (documentos 9900…, placas ES…) y
+los borra al terminar. Solo corre con DEBUG=True (BD local) salvo --forzar. Con SQLite
+las escrituras concurrentes se rechazan ("database is locked") y aparecen como errores:
+la medición representativa es contra MySQL o PostgreSQL.
+"""
+import logging
+import math
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import got_request_exception
+from django.db import DatabaseError, connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from pagos.models import Pago
+from parqueadero.models import (
+    ContadorEspacios, Espacio, InventarioParqueo, Piso, RetencionEspacio, SolicitudSalida, TipoEspacio,
+)
+from parqueadero.services import registrar_salida
+from parqueadero.utils import pool_espacios
+from reservas.models import Reserva
+from tarifas.models import Tarifa
+from usuarios.models import Usuario
+from vehiculos.models import Vehiculo
+
+PISO_ESTRES = 'Estres concurrencia'
+TARIFA_ESTRES = 'Estres concurrencia'  # Solo se crea si no hay tarifa activa para Carro
+PREFIJO_DOCUMENTO = '9900'
+PREFIJO_CLIENTE = 'ESC'
+PREFIJO_VISITANTE = 'ESV'
+ESTADOS_RESERVA_ACTIVA = ['PENDIENTE', 'CONFIRMADA']
+
+_TOKEN_RETENCION = re.compile(r'name="retencion" value="(\w+)"')
+
+
+def percentil(valores, p):
+    """Percentil p (0-100) por rango más cercano de una lista ya ordenada."""
+    if not valores:
+        return 0.0
+    return valores[max(math.ceil(p / 100 * len(valores)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = 'Prueba de estrés concurrente de entradas, salidas y reservas con verificación de invariantes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--guardias', type=int, default=4, help='Hilos de guardia (default 4)')
+        parser.add_argument('--clientes', type=int, default=8, help='Hilos de cliente (default 8)')
+        parser.add_argument('--operaciones', type=int, default=25, help='Operaciones por hilo (default 25)')
+        parser.add_argument('--espacios', type=int, default=20, help='Espacios del piso de prueba (default 20)')
+        parser.add_argument('--semilla', type=int, default=None, help='Semilla para repetir la misma secuencia')
+        parser.add_argument('--mantener', action='store_true', help='No borra los datos creados al terminar')
+        parser.add_argument('--forzar', action='store_true', help='Corre aunque DEBUG=False')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['forzar']:
+            raise CommandError('Solo corre contra una BD local (DEBUG=True); usa --forzar si es intencional.')
+        if options['guardias'] + options['clientes'] < 1 or options['espacios'] < 1:
+            raise CommandError('Se necesita al menos un hilo y un espacio.')
+
+        # Client necesita 'testserver' en ALLOWED_HOSTS; además los correos quedan en memoria.
+        # Si ya está activo (el comando corre dentro de la suite de pruebas) se reutiliza.
+        try:
+            setup_test_environment()
+            entorno_propio = True
+        except RuntimeError:
+            entorno_propio = False
+
+        self.random = random.Random(options['semilla'])
+        self.latencias = defaultdict(list)
+        self.errores = defaultdict(int)
+        self.muestras_error = {}
+        self.lecturas_fallidas = 0
+        self.lock = threading.Lock()
+        # Client solo guarda la excepción de la vista en un atributo compartido entre
+        # hilos; se captura por hilo con la misma señal que usa Client
+        self.local = threading.local()
+        got_request_exception.connect(self._capturar_excepcion)
+        # Los 500 se cuentan en el reporte; el log de cada uno solo taparía la tabla
+        log_request = logging.getLogger('django.request')
+        nivel_log = log_request.level
+        log_request.setLevel(logging.CRITICAL)
+        try:
+            self._limpiar()
+            self._preparar(options)
+            duracion = self._ejecutar(options)
+            self._reportar(duracion)
+            fallas = self._verificar()
+            if not fallas and not options['mantener']:
+                self._limpiar()
+        finally:
+            log_request.setLevel(nivel_log)
+            got_request_exception.disconnect(self._capturar_excepcion)
+            if entorno_propio:
+                teardown_test_environment()
+
+        if fallas:
+            raise CommandError(f'{fallas} invariantes violadas; datos conservados para inspección.')
+        if options['mantener']:
+            self.stdout.write('Datos de prueba conservados (--mantener).')
+        self.stdout.write(self.style.SUCCESS('Invariantes OK.'))
+
+    # ── Preparación ──────────────────────────────────────────────────
+
+    def _preparar(self, options):
+        pool_espacios.invalidar()
+        self.tipo, _ = TipoEspacio.objects.get_or_create(nombre='Carro')
+        if Tarifa.get_active_for(self.tipo) is None:
+            Tarifa.objects.create(
+                nombre=TARIFA_ESTRES, fkIdTipoEspacio=self.tipo, precioHora=3000,
+                precioDia=20000, precioMensual=300000, fechaInicio=date.today(),
+            )
+        self.piso = Piso.objects.create(pisNombre=PISO_ESTRES)
+        self.espacios = [
+            Espacio.objects.create(espNumero=f'ES-{i:03d}', fkIdPiso=self.piso, fkIdTipoEspacio=self.tipo).pk
+            for i in range(1, options['espacios'] + 1)
+        ]
+        # Más visitantes que espacios para que haya competencia por los puestos
+        self.visitantes = [f'{PREFIJO_VISITANTE}{i:03d}' for i in range(options['espacios'] * 2)]
+
+        self.actores = []
+        for i in range(options['guardias'] + options['clientes']):
+            es_guardia = i < options['guardias']
+            usuario = Usuario.objects.create(
+                usuDocumento=f'{PREFIJO_DOCUMENTO}{i:05d}', usuNombre='Estres', usuApellido='Concurrencia',
+                usuCorreo=f'estres{i}@multiparking.test', usuClaveHash='!',
+                rolTipoRol='VIGILANTE' if es_guardia else 'CLIENTE',
+            )
+            vehiculo = None if es_guardia else Vehiculo.objects.create(
+                vehPlaca=f'{PREFIJO_CLIENTE}{i:03d}', fkIdUsuario=usuario,
+            )
+            cliente = Client(raise_request_exception=False)
+            session = cliente.session
+            session['usuario_id'] = usuario.pk
+            session['usuario_rol'] = usuario.rolTipoRol
+            session.save()
+            self.actores.append((cliente, usuario, vehiculo))
+
+    def _limpiar(self):
+        """Borra lo que creó una corrida (esta o una anterior interrumpida)."""
+        usuarios = Usuario.objects.filter(usuDocumento__startswith=PREFIJO_DOCUMENTO)
+        vehiculos = Vehiculo.objects.filter(vehPlaca__regex=f'^({PREFIJO_CLIENTE}|{PREFIJO_VISITANTE})[0-9]+$')
+        # Los clientes pudieron quedar en espacios de otros pisos: se cierran sus turnos y
+        # se sueltan sus retenciones para no dejar espacios OCUPADO/RESERVADO huérfanos
+        for registro in InventarioParqueo.objects.filter(
+            fkIdVehiculo__in=vehiculos, parHoraSalida__isnull=True,
+        ).select_related('fkIdVehiculo', 'fkIdEspacio'):
+            registrar_salida(registro)
+        RetencionEspacio.soltar(list(RetencionEspacio.objects.filter(fkIdUsuario__in=usuarios)))
+        for reserva in Reserva.objects.filter(
+            fkIdVehiculo__in=vehiculos, resEstado__in=ESTADOS_RESERVA_ACTIVA,
+        ).select_related('fkIdEspacio'):
+            reserva.cerrar('CANCELADA')
+        vehiculos.delete()
+        usuarios.delete()
+        # El piso arrastra (CASCADE) sus espacios, contadores, turnos, pagos y reservas
+        Piso.objects.filter(pisNombre=PISO_ESTRES).delete()
+        if Tarifa.objects.filter(nombre=TARIFA_ESTRES).exists():
+            Tarifa.objects.filter(nombre=TARIFA_ESTRES).delete()
+        pool_espacios.invalidar()
+
+    # ── Ejecución ────────────────────────────────────────────────────
+
+    def _ejecutar(self, options):
+        salida = threading.Barrier(len(self.actores))
+        hilos = [
+            threading.Thread(target=self._actor, args=(actor, options['operaciones'], salida, self.random.random()))
+            for actor in self.actores
+        ]
+        inicio = time.perf_counter()
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        return time.perf_counter() - inicio
+
+    def _actor(self, actor, operaciones, salida, semilla):
+        cliente, usuario, vehiculo = actor
+        azar = random.Random(semilla)
+        try:
+            salida.wait(30)
+            for _ in range(operaciones):
+                try:
+                    if vehiculo is None:
+                        nombre, operacion = self._operacion_guardia(cliente, azar)
+                    else:
+                        nombre, operacion = self._operacion_cliente(cliente, usuario, vehiculo, azar)
+                except DatabaseError as exc:
+                    # La lectura que elige la operación también compite por la BD
+                    with self.lock:
+                        self.lecturas_fallidas += 1
+                        self.muestras_error.setdefault('lectura de estado', f'{type(exc).__name__}: {exc}')
+                    continue
+                self._medir(nombre, operacion)
+        finally:
+            connection.close()
+
+    def _capturar_excepcion(self, **kwargs):
+        self.local.excepcion = sys.exc_info()[1]
+
+    def _medir(self, nombre, operacion):
+        self.local.excepcion = None
+        inicio = time.perf_counter()
+        try:
+            respuesta = operacion()
+            fallo = respuesta.status_code >= 500 and f'HTTP {respuesta.status_code}'
+        except Exception as exc:  # se reporta en la tabla junto con el resto de resultados
+            fallo = f'{type(exc).__name__}: {exc}'
+        if fallo and self.local.excepcion is not None:
+            fallo = f'{type(self.local.excepcion).__name__}: {self.local.excepcion}'
+        elif fallo == 'HTTP 500':
+            # Sin excepción: la atrapó DatabaseErrorMiddleware (en SQLite, "database is locked")
+            fallo = 'HTTP 500 por error de BD (DatabaseErrorMiddleware)'
+        transcurrido = time.perf_counter() - inicio
+        with self.lock:
+            self.latencias[nombre].append(transcurrido)
+            if fallo:
+                self.errores[nombre] += 1
+                self.muestras_error.setdefault(nombre, fallo)
+
+    def _operacion_guardia(self, cliente, azar):
+        abiertos = list(InventarioParqueo.objects.filter(
+            fkIdEspacio__fkIdPiso=self.piso, parHoraSalida__isnull=True,
+        ).values_list('pk', flat=True))
+        if abiertos and azar.random() < 0.45:
+            datos = {'registro_id': azar.choice(abiertos), 'idempotency_key': uuid.uuid4().hex}
+            return 'guardia_salida', lambda: cliente.post(reverse('guardia_registrar_salida'), datos)
+        datos = {'placa': azar.choice(self.visitantes), 'espacio_id': azar.choice(self.espacios)}
+        return 'guardia_ingreso', lambda: cliente.post(reverse('guardia_registrar_ingreso'), datos)
+
+    def _operacion_cliente(self, cliente, usuario, vehiculo, azar):
+        registro = InventarioParqueo.objects.filter(fkIdVehiculo=vehiculo, parHoraSalida__isnull=True).first()
+        if registro is not None and not SolicitudSalida.objects.filter(fkIdParqueo=registro).exists():
+            datos = {'metodo_pago': azar.choice(['PSE', 'EFECTIVO']), 'idempotency_key': uuid.uuid4().hex}
+            return 'cliente_salida', lambda: cliente.post(reverse('cliente_salida'), datos)
+
+        dado = azar.random()
+        if registro is None and dado < 0.6:
+            return 'cliente_entrada_qr', lambda: self._entrada_qr(cliente, vehiculo)
+        reserva = Reserva.objects.filter(
+            fkIdVehiculo=vehiculo, resEstado__in=ESTADOS_RESERVA_ACTIVA,
+        ).values_list('pk', flat=True).first()
+        if reserva is not None and dado < 0.8:
+            return 'reserva_cancelar', lambda: cliente.post(reverse('cliente_cancelar_reserva', args=[reserva]))
+        manana = timezone.localdate() + timedelta(days=1)
+        datos = {
+            'vehiculo_id': vehiculo.pk,
+            'espacio_id': azar.choice(self.espacios),
+            'fecha_inicio': manana.isoformat(),
+            'hora_inicio': f'{azar.randint(6, 20):02d}:00',
+        }
+        return 'reserva_crear', lambda: cliente.post(reverse('cliente_crear_reserva'), datos)
+
+    def _entrada_qr(self, cliente, vehiculo):
+        # Lo que hace el teléfono: abrir la página (aparta espacio) y confirmar con el token
+        pagina = cliente.get(reverse('entrada_parqueadero'), {'vehiculo': vehiculo.pk})
+        if pagina.status_code >= 500:
+            return pagina
+        tokens = _TOKEN_RETENCION.findall(pagina.content.decode())
+        return cliente.post(reverse('entrada_parqueadero'), {'vehiculo_id': vehiculo.pk, 'retencion': tokens})
+
+    # ── Reporte ──────────────────────────────────────────────────────
+
+    def _reportar(self, duracion):
+        total = sum(len(v) for v in self.latencias.values())
+        self.stdout.write(f'{"Operación":<20} {"n":>6} {"errores":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"máx ms":>8}')
+        for nombre in sorted(self.latencias):
+            valores = sorted(self.latencias[nombre])
+            ms = [percentil(valores, p) * 1000 for p in (50, 95, 99)] + [valores[-1] * 1000]
+            self.stdout.write(
+                f'{nombre:<20} {len(valores):>6} {self.errores[nombre]:>8} '
+                + ' '.join(f'{v:>8.1f}' for v in ms)
+            )
+        self.stdout.write(f'Total: {total} operaciones en {duracion:.2f} s → {total / duracion:.1f} ops/s')
+        if self.lecturas_fallidas:
+            self.stdout.write(f'Operaciones omitidas por error al leer el estado: {self.lecturas_fallidas}')
+        for nombre, muestra in sorted(self.muestras_error.items()):
+            self.stdout.write(f'  primer error de {nombre}: {muestra[:200]}')
+
+    def _verificar(self):
+        abiertos = InventarioParqueo.objects.filter(parHoraSalida__isnull=True)
+        invariantes = [
+            ('Espacios con más de un turno abierto',
+             abiertos.values('fkIdEspacio').annotate(n=Count('pk')).filter(n__gt=1).count()),
+            ('Vehículos con más de un turno abierto',
+             abiertos.values('fkIdVehiculo').annotate(n=Count('pk')).filter(n__gt=1).count()),
+            ('Espacios OCUPADO sin turno abierto',
+             Espacio.objects.filter(espEstado='OCUPADO').exclude(pk__in=abiertos.values('fkIdEspacio')).count()),
+            ('Turnos abiertos en espacios no OCUPADO',
+             abiertos.exclude(fkIdEspacio__espEstado='OCUPADO').count()),
+            ('Espacios RESERVADO sin reserva ni retención',
+             Espacio.objects.filter(espEstado='RESERVADO', retencion__isnull=True).exclude(
+                 reservas__resEstado__in=ESTADOS_RESERVA_ACTIVA,
+             ).count()),
+            ('Turnos con más de un pago',
+             Pago.objects.exclude(pagEstado='ANULADO').values('fkIdParqueo').annotate(
+                 n=Count('pk'),
+             ).filter(n__gt=1).count()),
+            ('Reservas activas duplicadas (espacio y hora)',
+             Reserva.objects.filter(resEstado__in=ESTADOS_RESERVA_ACTIVA).values(
+                 'fkIdEspacio', 'resInicio',
+             ).annotate(n=Count('pk')).filter(n__gt=1).count()),
+            ('Contadores desfasados', len(ContadorEspacios.diferencias())),
+            ('Punteros fkIdParqueoActual desfasados', len(Espacio.diferencias_parqueo_actual())),
+        ]
+        self.stdout.write('Invariantes:')
+        for descripcion, cantidad in invariantes:
+            marca = '✓' if cantidad == 0 else '✗'
+            self.stdout.write(f'  {marca} {descripcion}: {cantidad}')
+        return sum(1 for _, cantidad in invariantes if cantidad)
@@ -0,0 +1,21 @@
+"""
+Management command para devolver a DISPONIBLE los espacios de retenciones vencidas.
+
+Uso:
+    python manage.py liberar_retenciones
+
+La entrada por QR ya barre las vencidas en cada visita y cuando el pool se queda sin
+espacios; correrlo desde cron cada minuto evita que el mapa muestre como RESERVADO un
+espacio abandonado en horas de poco movimiento.
+"""
+from django.core.management.base import BaseCommand
+
+from parqueadero.models import RetencionEspacio
+
+
+class Command(BaseCommand):
+    help = 'Libera los espacios apartados por retenciones de entrada vencidas'
+
+    def handle(self, *args, **options):
+        liberadas = RetencionEspacio.liberar_vencidas()
+        self.stdout.write(self.style.SUCCESS(f'Completado: {liberadas} retenciones vencidas liberadas.'))
@@ -0,0 +1,20 @@
+"""
+Management command para borrar las respuestas idempotentes vencidas.
+
+Uso:
+    python manage.py purgar_idempotencia
+
+Las vencidas ya no se usan (se reemplazan al llegar otra petición con la misma clave),
+solo ocupan espacio; conviene correrlo a diario desde cron.
+"""
+from django.core.management.base import BaseCommand
+
+from parqueadero.models import RespuestaIdempotente
+
+
+class Command(BaseCommand):
+    help = 'Borra las respuestas de claves de idempotencia vencidas'
+
+    def handle(self, *args, **options):
+        borradas = RespuestaIdempotente.purgar()
+        self.stdout.write(self.style.SUCCESS(f'Completado: {borradas} respuestas vencidas borradas.'))
@@ -0,0 +1,47 @@
+"""
+Management command para recalcular los contadores de ocupación (ContadorEspacios).
+
+Uso:
+    python manage.py reconstruir_contadores             # recalcula desde la tabla de espacios
+    python manage.py reconstruir_contadores --verificar  # solo reporta diferencias (exit 1 si hay)
+
+Necesario después de cargar datos con bulk_create/.update() o editar espacios
+directamente en la BD, que no pasan por Espacio.save().
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from parqueadero.models import ContadorEspacios, Piso, TipoEspacio, VersionParqueadero
+
+
+class Command(BaseCommand):
+    help = 'Recalcula los contadores de espacios por piso, tipo y estado'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verificar', action='store_true',
+            help='Solo compara los contadores con los espacios, sin modificar nada',
+        )
+
+    def handle(self, *args, **options):
+        diferencias = ContadorEspacios.diferencias()
+        pisos = dict(Piso.objects.values_list('pk', 'pisNombre'))
+        tipos = dict(TipoEspacio.objects.values_list('pk', 'nombre'))
+
+        for (piso_id, tipo_id, estado), (contador, real) in sorted(diferencias.items()):
+            self.stdout.write(
+                f'  ✗ {pisos.get(piso_id, piso_id)} / {tipos.get(tipo_id, tipo_id)} / {estado}: '
+                f'contador {contador}, real {real}'
+            )
+
+        if options['verificar']:
+            if diferencias:
+                raise CommandError(f'{len(diferencias)} contadores desfasados.')
+            self.stdout.write(self.style.SUCCESS('Contadores al día.'))
+            return
+
+        filas = ContadorEspacios.reconstruir()
+        if diferencias:
+            VersionParqueadero.incrementar()
+        self.stdout.write(
+            self.style.SUCCESS(f'Completado: {filas} contadores recalculados, {len(diferencias)} corregidos.')
+        )
@@ -0,0 +1,45 @@
+"""
+Management command para verificar/corregir el turno actual de cada espacio (Espacio.fkIdParqueoActual).
+
+Uso:
+    python manage.py reconstruir_parqueo_actual             # corrige los punteros desfasados
+    python manage.py reconstruir_parqueo_actual --verificar  # solo reporta diferencias (exit 1 si hay)
+
+Necesario después de cargar turnos con scripts o .update() que no pasan por
+registrar_ingreso/registrar_salida, o de editar InventarioParqueo directamente en la BD.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from parqueadero.models import Espacio, VersionParqueadero
+
+
+class Command(BaseCommand):
+    help = 'Verifica que cada espacio apunte a su turno abierto en el inventario'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verificar', action='store_true',
+            help='Solo compara los punteros con el inventario, sin modificar nada',
+        )
+
+    def handle(self, *args, **options):
+        if options['verificar']:
+            diferencias = Espacio.diferencias_parqueo_actual()
+        else:
+            diferencias = Espacio.reconstruir_parqueo_actual()
+
+        numeros = dict(Espacio.objects.filter(pk__in=diferencias).values_list('pk', 'espNumero'))
+        for pk, (apuntado, real) in sorted(diferencias.items()):
+            self.stdout.write(
+                f'  ✗ Espacio {numeros.get(pk, pk)}: apunta a {apuntado or "ninguno"}, turno abierto {real or "ninguno"}'
+            )
+
+        if options['verificar']:
+            if diferencias:
+                raise CommandError(f'{len(diferencias)} espacios desfasados.')
+            self.stdout.write(self.style.SUCCESS('Punteros al día.'))
+            return
+
+        if diferencias:
+            VersionParqueadero.incrementar()
+        self.stdout.write(self.style.SUCCESS(f'Completado: {len(diferencias)} espacios corregidos.'))
@@ -6,7 +6,7 @@ from django.utils import timezone
 
 from cupones.models import Cupon, CuponAplicado
 from pagos.models import Pago
-from parqueadero.models import Espacio, InventarioParqueo, Piso, TipoEspacio
+from parqueadero.models import ContadorEspacios, Espacio, InventarioParqueo, Piso, TipoEspacio
 from reservas.models import Reserva
 from tarifas.models import Tarifa
 from usuarios.models import Usuario
@@ -283,6 +283,8 @@ class Command(BaseCommand):
         Espacio.objects.filter(espNumero='P2-C01').update(espEstado='OCUPADO')
         Espacio.objects.filter(espNumero='P3-C10').update(espEstado='INACTIVO')
         Espacio.objects.filter(espNumero='P3-M05').update(espEstado='INACTIVO')
+        # bulk_create/.update() no pasan por Espacio.save(): recalcular los contadores
+        ContadorEspacios.reconstruir()
 
         # Refrescar referencias para FK
         esp_p1c01 = Espacio.objects.get(espNumero='P1-C01')
@@ -430,6 +432,8 @@ class Command(BaseCommand):
         InventarioParqueo.objects.filter(pk=ip10.pk).update(
             parHoraEntrada=ahora - timedelta(minutes=45),
         )
+        # Los espacios se marcaron OCUPADO con .update(): apuntarlos a sus turnos abiertos
+        Espacio.reconstruir_parqueo_actual()
 
         # Refrescar para tener datos actualizados
         ip1.refresh_from_db()
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parqueadero', '0002_alter_espacio_espestado'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersionParqueadero',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Versión del Parqueadero',
+                'db_table': 'parqueadero_version',
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def poblar_contadores(apps, schema_editor):
+    Espacio = apps.get_model('parqueadero', 'Espacio')
+    ContadorEspacios = apps.get_model('parqueadero', 'ContadorEspacios')
+    filas = Espacio.objects.values('fkIdPiso_id', 'fkIdTipoEspacio_id', 'espEstado').annotate(n=Count('pk'))
+    ContadorEspacios.objects.bulk_create([
+        ContadorEspacios(
+            fkIdPiso_id=f['fkIdPiso_id'], fkIdTipoEspacio_id=f['fkIdTipoEspacio_id'],
+            conEstado=f['espEstado'], conCantidad=f['n'],
+        )
+        for f in filas
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parqueadero', '0003_versionparqueadero'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContadorEspacios',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conEstado', models.CharField(choices=[('DISPONIBLE', 'Disponible'), ('OCUPADO', 'Ocupado'), ('RESERVADO', 'Reservado'), ('INACTIVO', 'Inactivo')], max_length=10)),
+                ('conCantidad', models.IntegerField(default=0)),
+                ('fkIdPiso', models.ForeignKey(db_column='fkIdPiso', on_delete=django.db.models.deletion.CASCADE, related_name='contadores', to='parqueadero.piso')),
+                ('fkIdTipoEspacio', models.ForeignKey(db_column='fkIdTipoEspacio', on_delete=django.db.models.deletion.CASCADE, related_name='contadores', to='parqueadero.tipoespacio')),
+            ],
+            options={
+                'verbose_name': 'Contador de Espacios',
+                'verbose_name_plural': 'Contadores de Espacios',
+                'db_table': 'contadores_espacio',
+                'unique_together': {('fkIdPiso', 'fkIdTipoEspacio', 'conEstado')},
+            },
+        ),
+        migrations.RunPython(poblar_contadores, migrations.RunPython.noop),
+    ]
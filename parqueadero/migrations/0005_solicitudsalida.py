@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def poblar_solicitudes(apps, schema_editor):
+    Pago = apps.get_model('pagos', 'Pago')
+    SolicitudSalida = apps.get_model('parqueadero', 'SolicitudSalida')
+    pendientes = Pago.objects.filter(
+        pagEstado='PENDIENTE', pagMetodo='EFECTIVO', fkIdParqueo__parHoraSalida__isnull=True,
+    ).select_related(
+        'fkIdParqueo__fkIdVehiculo__fkIdUsuario', 'fkIdParqueo__fkIdEspacio__fkIdPiso',
+    ).order_by('pk')
+    solicitudes = {}
+    for pago in pendientes:
+        registro = pago.fkIdParqueo
+        vehiculo = registro.fkIdVehiculo
+        usuario = vehiculo.fkIdUsuario
+        # Se conserva el primer pago pendiente del registro, como hacía el dashboard
+        solicitudes.setdefault(registro.pk, SolicitudSalida(
+            fkIdParqueo=registro,
+            fkIdPago=pago,
+            solMonto=pago.pagMonto,
+            solPlaca=vehiculo.vehPlaca,
+            solNombre=f'{usuario.usuNombre} {usuario.usuApellido}'.strip() if usuario else (vehiculo.nombre_contacto or 'Visitante'),
+            solPiso=registro.fkIdEspacio.fkIdPiso.pisNombre,
+            solEspacio=registro.fkIdEspacio.espNumero,
+            solHoraEntrada=registro.parHoraEntrada,
+        ))
+    SolicitudSalida.objects.bulk_create(solicitudes.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pagos', '0001_initial'),
+        ('parqueadero', '0004_contadorespacios'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SolicitudSalida',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('solMonto', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('solPlaca', models.CharField(max_length=8)),
+                ('solNombre', models.CharField(max_length=101)),
+                ('solPiso', models.CharField(max_length=30)),
+                ('solEspacio', models.CharField(max_length=10)),
+                ('solHoraEntrada', models.DateTimeField()),
+                ('fkIdPago', models.ForeignKey(db_column='fkIdPago', on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pagos.pago')),
+                ('fkIdParqueo', models.OneToOneField(db_column='fkIdParqueo', on_delete=django.db.models.deletion.CASCADE, related_name='solicitud_salida', to='parqueadero.inventarioparqueo')),
+            ],
+            options={
+                'verbose_name': 'Solicitud de Salida',
+                'verbose_name_plural': 'Solicitudes de Salida',
+                'db_table': 'solicitudes_salida',
+                'indexes': [models.Index(fields=['-solHoraEntrada'], name='idx_solicitud_entrada')],
+            },
+        ),
+        migrations.RunPython(poblar_solicitudes, migrations.RunPython.noop),
+    ]
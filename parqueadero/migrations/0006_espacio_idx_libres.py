@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parqueadero', '0005_solicitudsalida'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='espacio',
+            index=models.Index(fields=['fkIdTipoEspacio', 'espEstado', 'fkIdPiso', 'espNumero'], name='idx_espacio_libres'),
+        ),
+    ]
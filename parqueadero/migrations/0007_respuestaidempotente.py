@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parqueadero', '0006_espacio_idx_libres'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RespuestaIdempotente',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idemHuella', models.CharField(max_length=64, unique=True)),
+                ('idemEstado', models.PositiveSmallIntegerField(null=True)),
+                ('idemCuerpo', models.TextField(blank=True)),
+                ('idemCabeceras', models.JSONField(default=dict)),
+                ('idemMensajes', models.JSONField(default=list)),
+                ('idemExpira', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Respuesta Idempotente',
+                'verbose_name_plural': 'Respuestas Idempotentes',
+                'db_table': 'respuestas_idempotentes',
+                'indexes': [models.Index(fields=['idemExpira'], name='idx_idempotente_expira')],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:33
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def cerrar_turnos_duplicados(apps, schema_editor):
+    # Las restricciones no se pueden crear si ya hay dos turnos abiertos del mismo vehículo
+    # o en el mismo espacio (carreras previas a este cambio). Se deja abierto el más reciente
+    # y los anteriores se cierran a la hora en que empezó ese; sin cobro, como un cierre manual.
+    InventarioParqueo = apps.get_model('parqueadero', 'InventarioParqueo')
+    abiertos = InventarioParqueo.objects.filter(parHoraSalida__isnull=True)
+    for campo in ('fkIdVehiculo', 'fkIdEspacio'):
+        repetidos = (
+            abiertos.values(campo).annotate(n=Count('pk')).filter(n__gt=1).values_list(campo, flat=True)
+        )
+        for valor in list(repetidos):
+            turnos = list(abiertos.filter(**{campo: valor}).order_by('-parHoraEntrada', '-pk'))
+            vigente = turnos[0]
+            abiertos.filter(pk__in=[t.pk for t in turnos[1:]]).update(parHoraSalida=vigente.parHoraEntrada)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parqueadero', '0007_respuestaidempotente'),
+        ('vehiculos', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(cerrar_turnos_duplicados, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='inventarioparqueo',
+            name='parEspacioActivo',
+            field=models.GeneratedField(db_persist=True, expression=models.Case(models.When(parHoraSalida__isnull=True, then=models.F('fkIdEspacio')), default=None), output_field=models.BigIntegerField(null=True)),
+        ),
+        migrations.AddField(
+            model_name='inventarioparqueo',
+            name='parVehiculoActivo',
+            field=models.GeneratedField(db_persist=True, expression=models.Case(models.When(parHoraSalida__isnull=True, then=models.F('fkIdVehiculo')), default=None), output_field=models.BigIntegerField(null=True)),
+        ),
+        migrations.AddConstraint(
+            model_name='inventarioparqueo',
+            constraint=models.UniqueConstraint(fields=('parVehiculoActivo',), name='uq_parqueo_vehiculo_activo'),
+        ),
+        migrations.AddConstraint(
+            model_name='inventarioparqueo',
+            constraint=models.UniqueConstraint(fields=('parEspacioActivo',), name='uq_parqueo_espacio_activo'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def poblar_parqueo_actual(apps, schema_editor):
+    # Misma regla que Espacio.reconstruir_parqueo_actual (los modelos históricos no tienen
+    # sus métodos); uq_parqueo_espacio_activo garantiza un solo turno abierto por espacio
+    Espacio = apps.get_model('parqueadero', 'Espacio')
+    InventarioParqueo = apps.get_model('parqueadero', 'InventarioParqueo')
+    abiertos = InventarioParqueo.objects.filter(parHoraSalida__isnull=True).values_list('fkIdEspacio_id', 'pk')
+    for espacio_id, registro_id in abiertos:
+        Espacio.objects.filter(pk=espacio_id).update(fkIdParqueoActual_id=registro_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parqueadero', '0008_parqueo_activo_unico'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='espacio',
+            name='fkIdParqueoActual',
+            field=models.OneToOneField(blank=True, db_column='fkIdParqueoActual', editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='parqueadero.inventarioparqueo'),
+        ),
+        migrations.RunPython(poblar_parqueo_actual, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parqueadero', '0009_espacio_parqueo_actual'),
+        ('usuarios', '0002_alter_usuario_usucorreo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetencionEspacio',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('retToken', models.CharField(max_length=32, unique=True)),
+                ('retExpira', models.DateTimeField()),
+                ('fkIdEspacio', models.OneToOneField(db_column='fkIdEspacio', on_delete=django.db.models.deletion.CASCADE, related_name='retencion', to='parqueadero.espacio')),
+                ('fkIdUsuario', models.ForeignKey(db_column='fkIdUsuario', on_delete=django.db.models.deletion.CASCADE, related_name='retenciones', to='usuarios.usuario')),
+            ],
+            options={
+                'verbose_name': 'Retención de Espacio',
+                'verbose_name_plural': 'Retenciones de Espacio',
+                'db_table': 'retenciones_espacio',
+                'indexes': [models.Index(fields=['retExpira'], name='idx_retencion_expira')],
+            },
+        ),
+    ]
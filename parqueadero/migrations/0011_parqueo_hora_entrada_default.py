@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:59
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parqueadero', '0010_retencionespacio'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='inventarioparqueo',
+            name='parHoraEntrada',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
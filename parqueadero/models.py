@@ -1,5 +1,11 @@
+import uuid
+from collections import Counter
+from datetime import timedelta
+
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Case, Count, F, Sum, When
+from django.utils import timezone
 
 
 class Piso(models.Model):
@@ -55,7 +61,8 @@ class Espacio(models.Model):
     # Regla de integridad de estados:
     # DISPONIBLE → puede recibir un vehículo (ingreso normal o desde reserva)
     # OCUPADO    → hay un InventarioParqueo activo (parHoraSalida IS NULL) para este espacio
-    # RESERVADO  → hay una Reserva PENDIENTE o CONFIRMADA; el espacio está bloqueado
+    # RESERVADO  → hay una Reserva PENDIENTE o CONFIRMADA, o una RetencionEspacio vigente
+    #              (entrada por QR en curso); el espacio está bloqueado
     # INACTIVO   → fuera de servicio; las vistas lo excluyen de todos los flujos operativos
     # Transición correcta: DISPONIBLE → RESERVADO → OCUPADO → DISPONIBLE
     # Si se cancela la reserva antes del ingreso: RESERVADO → DISPONIBLE (Reserva.cerrar())
@@ -64,6 +71,20 @@ class Espacio(models.Model):
         choices=EstadoChoices.choices,
         default=EstadoChoices.DISPONIBLE,
     )
+    # Turno abierto que ocupa el espacio (NULL si no está OCUPADO). Copia de
+    # "InventarioParqueo con este espacio y parHoraSalida IS NULL" para que "quién está en
+    # el espacio X" sea un join por PK. Se escribe junto con espEstado en cada transición
+    # (ocupar/liberar/reservar) y al abrir el turno (asignar_parqueo); si se desfasa,
+    # `manage.py reconstruir_parqueo_actual` lo recalcula.
+    fkIdParqueoActual = models.OneToOneField(
+        'InventarioParqueo',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='+',
+        db_column='fkIdParqueoActual',
+    )
 
     class Meta:
         db_table = 'espacios'
@@ -72,29 +93,296 @@ class Espacio(models.Model):
         unique_together = [('fkIdPiso', 'espNumero')]  # El mismo número no puede repetirse dentro de un piso
         indexes = [
             models.Index(fields=['espNumero'], name='idx_espacio_numero'),
+            # Búsqueda del próximo espacio libre de un tipo en la entrada (reclamar_disponible)
+            models.Index(fields=['fkIdTipoEspacio', 'espEstado', 'fkIdPiso', 'espNumero'], name='idx_espacio_libres'),
         ]
 
     def __str__(self):
         return f'{self.espNumero} - Piso {self.fkIdPiso}'
 
-    def ocupar(self):
-        """Marca el espacio como OCUPADO y guarda solo ese campo."""
-        self.espEstado = 'OCUPADO'
-        self.save(update_fields=['espEstado'])
+    # ── Contadores de ocupación ──
+    # Cada save()/delete() mueve el espacio entre las filas de ContadorEspacios dentro de
+    # la misma transacción. La clave (piso, tipo, estado) con la que el espacio está
+    # contado se relee de la BD bloqueando la fila: una instancia cargada antes (un
+    # formulario, la reserva leída al inicio de la vista) no sirve para descontarla.
+    def _clave_actual(self):
+        # Las vistas asignan los FK desde request.POST (str): normalizar al tipo de la PK
+        piso = self._meta.get_field('fkIdPiso').target_field.to_python(self.fkIdPiso_id)
+        tipo = self._meta.get_field('fkIdTipoEspacio').target_field.to_python(self.fkIdTipoEspacio_id)
+        return (piso, tipo, self.espEstado)
+
+    def _clave_guardada(self):
+        """Clave con la que el espacio está contado hoy; llamar dentro de la transacción."""
+        return Espacio.objects.select_for_update().filter(pk=self.pk).values_list(
+            'fkIdPiso_id', 'fkIdTipoEspacio_id', 'espEstado'
+        ).first()
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and not {'espEstado', 'fkIdPiso', 'fkIdTipoEspacio'} & set(update_fields):
+            return super().save(*args, **kwargs)
+        # Sin savepoint: un error aborta igual la transacción de quien llama, y cada
+        # transición (ingreso o salida, cientos por lote de cámaras) se ahorra un par
+        # SAVEPOINT/RELEASE
+        with transaction.atomic(savepoint=False):
+            anterior = None if self._state.adding else self._clave_guardada()
+            super().save(*args, **kwargs)
+            nueva = self._clave_actual()
+            if anterior != nueva:
+                ContadorEspacios.aplicar(salen=[anterior], entran=[nueva])
+                self._avisar_pool(nueva)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(savepoint=False):
+            anterior = self._clave_guardada()
+            pk = self.pk
+            resultado = super().delete(*args, **kwargs)
+            ContadorEspacios.aplicar(salen=[anterior])
+            self._avisar_pool(None, pk)
+        return resultado
+
+    def _avisar_pool(self, clave, pk=None):
+        """Pasa la transición al pool de espacios libres cuando confirma la transacción."""
+        from .utils import pool_espacios
+        pk, numero = pk or self.pk, self.espNumero
+        transaction.on_commit(lambda: pool_espacios.actualizar(pk, clave, numero))
+
+    def ocupar(self, registro=None):
+        """Marca el espacio como OCUPADO por `registro` (si ya existe) en un solo UPDATE."""
+        self._cambiar_estado('OCUPADO', registro)
 
     def liberar(self):
-        """Marca el espacio como DISPONIBLE y guarda solo ese campo."""
-        self.espEstado = 'DISPONIBLE'
-        self.save(update_fields=['espEstado'])
+        """Marca el espacio como DISPONIBLE y suelta el turno actual."""
+        self._cambiar_estado('DISPONIBLE')
 
     def reservar(self):
         """Marca el espacio como RESERVADO y guarda solo ese campo."""
-        self.espEstado = 'RESERVADO'
-        self.save(update_fields=['espEstado'])
+        self._cambiar_estado('RESERVADO')
+
+    @classmethod
+    def liberar_reservado(cls, pk):
+        """
+        Pasa el espacio `pk` a DISPONIBLE solo si sigue RESERVADO. El estado se relee con
+        la fila bloqueada (esperando, no SKIP LOCKED): una instancia cargada antes pudo
+        quedar OCUPADA por una entrada y no se debe soltar. True si lo liberó.
+        """
+        with transaction.atomic():
+            espacio = cls.objects.select_for_update().filter(pk=pk, espEstado='RESERVADO').first()
+            if espacio is None:
+                return False
+            espacio.liberar()
+            return True
+
+    def asignar_parqueo(self, registro):
+        """Apunta el espacio (ya OCUPADO por Espacio.reclamar) al turno recién creado."""
+        self.fkIdParqueoActual = registro
+        self.save(update_fields=['fkIdParqueoActual'])
+
+    def _cambiar_estado(self, nuevo_estado, registro=None):
+        self.espEstado = nuevo_estado
+        self.fkIdParqueoActual = registro
+        self.save(update_fields=['espEstado', 'fkIdParqueoActual'])
+        VersionParqueadero.incrementar()
+
+    @classmethod
+    def diferencias_parqueo_actual(cls):
+        """
+        {espacio_pk: (apuntado, real)} de los espacios cuyo fkIdParqueoActual no coincide
+        con su turno abierto (PK del InventarioParqueo o None). Vacío si todo cuadra.
+        """
+        reales = dict(InventarioParqueo.objects.filter(
+            parHoraSalida__isnull=True,
+        ).values_list('fkIdEspacio_id', 'pk'))
+        apuntados = dict(cls.objects.filter(
+            fkIdParqueoActual__isnull=False,
+        ).values_list('pk', 'fkIdParqueoActual_id'))
+        return {
+            pk: (apuntados.get(pk), reales.get(pk))
+            for pk in set(reales) | set(apuntados)
+            if apuntados.get(pk) != reales.get(pk)
+        }
+
+    @classmethod
+    def reconstruir_parqueo_actual(cls):
+        """Corrige los fkIdParqueoActual desfasados; retorna las diferencias que había."""
+        with transaction.atomic():
+            # Bloquea los espacios para que ningún ingreso o salida cambie el cálculo a mitad
+            list(cls.objects.select_for_update().values_list('pk', flat=True))
+            diferencias = cls.diferencias_parqueo_actual()
+            # Primero se sueltan todos: el puntero es único y otro espacio podría tener
+            # apuntado (mal) el turno que se va a asignar
+            cls.objects.filter(pk__in=diferencias).update(fkIdParqueoActual=None)
+            for pk, (_, real) in diferencias.items():
+                if real is not None:
+                    cls.objects.filter(pk=pk).update(fkIdParqueoActual=real)
+        return diferencias
+
+    @classmethod
+    def reclamar_disponible(cls, tipo_id, hacia='OCUPADO'):
+        """
+        Toma el espacio DISPONIBLE del tipo con mayor prioridad y lo deja en `hacia`
+        (OCUPADO, o RESERVADO para una retención). Devuelve el espacio o None si no
+        queda ninguno.
+
+        El candidato sale del pool en memoria (parqueadero.utils.pool_espacios, ordenado
+        por piso y número) sin recorrer la tabla; la BD solo confirma que siga libre
+        (reclamar). Llamar dentro de la transacción que crea el InventarioParqueo: si
+        esta falla, el espacio vuelve a quedar DISPONIBLE con el rollback.
+        """
+        from .utils import pool_espacios
+        return pool_espacios.reclamar(tipo_id, hacia)
+
+    @classmethod
+    def reclamar(cls, pk, desde=('DISPONIBLE',), hacia='OCUPADO'):
+        """
+        Pasa el espacio `pk` a `hacia` si sigue en alguno de los estados `desde`; None
+        si otra entrada lo tomó antes (o el espacio no existe).
+
+        Dos entradas simultáneas nunca reciben el mismo espacio y ninguna espera a la otra:
+        - Con SELECT ... FOR UPDATE SKIP LOCKED (MySQL 8, PostgreSQL) si otra transacción
+          ya bloqueó la fila se recibe None al instante y se prueba el siguiente candidato.
+        - Sin SKIP LOCKED (SQLite) se reclama con un UPDATE condicional sobre el estado
+          leído: si otro lo cambió primero afecta 0 filas.
+        """
+        with transaction.atomic(savepoint=False):
+            if connection.features.has_select_for_update_skip_locked:
+                # Sin select_related: FOR UPDATE bloquearía también la fila del piso
+                espacio = cls.objects.select_for_update(skip_locked=True).filter(
+                    pk=pk, espEstado__in=desde,
+                ).first()
+                if espacio is not None:
+                    espacio._cambiar_estado(hacia)
+                return espacio
+
+            espacio = cls.objects.filter(pk=pk, espEstado__in=desde).first()
+            # Mismos campos que _cambiar_estado: estado y puntero al turno (se suelta)
+            if espacio is None or not cls.objects.filter(
+                pk=pk, espEstado=espacio.espEstado,
+            ).update(espEstado=hacia, fkIdParqueoActual=None):
+                return None
+            # .update() no pasa por save(): contadores, pool y versión a mano
+            anterior = espacio._clave_actual()
+            espacio.espEstado = hacia
+            espacio.fkIdParqueoActual = None
+            ContadorEspacios.aplicar(salen=[anterior], entran=[espacio._clave_actual()])
+            espacio._avisar_pool(espacio._clave_actual())
+            VersionParqueadero.incrementar()
+            return espacio
+
+
+class ContadorEspacios(models.Model):
+    """
+    Cantidad de espacios por (piso, tipo de espacio, estado).
+
+    Los KPIs de ocupación leen esta tabla (a lo sumo pisos × tipos × 4 filas) en vez de
+    contar la tabla de espacios en cada request. Se mantiene en la misma transacción
+    que cambia el espacio: Espacio.save()/delete() (ocupar/liberar/reservar y el CRUD
+    del admin) y los .update() masivos, que deben llamar a aplicar() a mano
+    (ver Reserva.cancelar_vencidas). Si alguna ruta se salta el contador,
+    `python manage.py reconstruir_contadores` lo recalcula desde los espacios.
+    """
+    fkIdPiso = models.ForeignKey(
+        Piso,
+        on_delete=models.CASCADE,
+        related_name='contadores',
+        db_column='fkIdPiso',
+    )
+    fkIdTipoEspacio = models.ForeignKey(
+        TipoEspacio,
+        on_delete=models.CASCADE,
+        related_name='contadores',
+        db_column='fkIdTipoEspacio',
+    )
+    conEstado = models.CharField(max_length=10, choices=Espacio.EstadoChoices.choices)
+    conCantidad = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'contadores_espacio'
+        verbose_name = 'Contador de Espacios'
+        verbose_name_plural = 'Contadores de Espacios'
+        unique_together = [('fkIdPiso', 'fkIdTipoEspacio', 'conEstado')]
+
+    def __str__(self):
+        return f'{self.fkIdPiso} / {self.fkIdTipoEspacio} / {self.conEstado}: {self.conCantidad}'
+
+    @classmethod
+    def aplicar(cls, salen=(), entran=()):
+        """
+        Resta 1 por cada clave (piso_id, tipo_id, estado) de `salen` y suma 1 por cada
+        una de `entran`. Las filas se actualizan siempre en el mismo orden para que dos
+        transacciones concurrentes no se bloqueen mutuamente.
+        """
+        deltas = Counter()
+        for clave in salen:
+            if clave:
+                deltas[clave] -= 1
+        for clave in entran:
+            if clave:
+                deltas[clave] += 1
+        for clave in sorted(c for c, delta in deltas.items() if delta):
+            piso_id, tipo_id, estado = clave
+            filtro = {'fkIdPiso_id': piso_id, 'fkIdTipoEspacio_id': tipo_id, 'conEstado': estado}
+            if not cls.objects.filter(**filtro).update(conCantidad=F('conCantidad') + deltas[clave]):
+                cls.objects.get_or_create(**filtro)
+                cls.objects.filter(**filtro).update(conCantidad=F('conCantidad') + deltas[clave])
+
+    @classmethod
+    def totales(cls, **filtros):
+        """{estado: cantidad} con todos los estados (0 si no hay filas). Una query."""
+        totales = dict.fromkeys(Espacio.EstadoChoices.values, 0)
+        filas = cls.objects.filter(**filtros).values('conEstado').annotate(n=Sum('conCantidad'))
+        for fila in filas:
+            totales[fila['conEstado']] = fila['n']
+        return totales
+
+    @classmethod
+    def por_piso(cls):
+        """{piso_id: {estado: cantidad}} para todos los pisos con espacios. Una query."""
+        resultado = {}
+        filas = cls.objects.values('fkIdPiso_id', 'conEstado').annotate(n=Sum('conCantidad'))
+        for fila in filas:
+            piso = resultado.setdefault(fila['fkIdPiso_id'], dict.fromkeys(Espacio.EstadoChoices.values, 0))
+            piso[fila['conEstado']] = fila['n']
+        return resultado
+
+    @classmethod
+    def esperados(cls):
+        """Conteo real desde la tabla de espacios: {(piso_id, tipo_id, estado): cantidad}."""
+        filas = Espacio.objects.values('fkIdPiso_id', 'fkIdTipoEspacio_id', 'espEstado').annotate(n=Count('pk'))
+        return {(f['fkIdPiso_id'], f['fkIdTipoEspacio_id'], f['espEstado']): f['n'] for f in filas}
+
+    @classmethod
+    def diferencias(cls):
+        """Claves cuyo contador no coincide con los espacios: {clave: (contador, real)}."""
+        esperados = cls.esperados()
+        actuales = {
+            (c.fkIdPiso_id, c.fkIdTipoEspacio_id, c.conEstado): c.conCantidad
+            for c in cls.objects.all()
+        }
+        return {
+            clave: (actuales.get(clave, 0), esperados.get(clave, 0))
+            for clave in set(esperados) | set(actuales)
+            if actuales.get(clave, 0) != esperados.get(clave, 0)
+        }
+
+    @classmethod
+    def reconstruir(cls):
+        """Recalcula todos los contadores desde los espacios. Retorna las filas creadas."""
+        with transaction.atomic():
+            # Bloquea los espacios para que ninguna transición cambie el conteo a mitad
+            list(Espacio.objects.select_for_update().values_list('pk', flat=True))
+            cls.objects.all().delete()
+            filas = cls.objects.bulk_create([
+                cls(fkIdPiso_id=piso_id, fkIdTipoEspacio_id=tipo_id, conEstado=estado, conCantidad=n)
+                for (piso_id, tipo_id, estado), n in cls.esperados().items()
+            ])
+        return len(filas)
 
 
 class InventarioParqueo(models.Model):
-    parHoraEntrada = models.DateTimeField(auto_now_add=True)              # Se asigna automáticamente al crear el registro
+    # Se asigna automáticamente al crear el registro; el ingreso por cámaras pasa la hora
+    # del evento en el mismo INSERT (auto_now_add la pisaría y exigiría otro UPDATE)
+    parHoraEntrada = models.DateTimeField(default=timezone.now, editable=False)
     # parHoraSalida NULL significa "vehículo todavía estacionado".
     # NO existe un campo 'estado'; la presencia/ausencia de este valor ES el estado.
     # Consecuencia: para saber si un espacio está ocupado, siempre filtrar por
@@ -112,11 +400,29 @@ class InventarioParqueo(models.Model):
         related_name='parqueos',
         db_column='fkIdEspacio',
     )
+    # Copias del vehículo y del espacio que solo tienen valor mientras el turno está abierto
+    # (NULL al registrar la salida). MySQL no soporta índices únicos parciales; un índice
+    # único sobre estas columnas generadas es el equivalente: varios NULL están permitidos,
+    # así que la BD impide dos turnos abiertos del mismo vehículo o en el mismo espacio.
+    parVehiculoActivo = models.GeneratedField(
+        expression=Case(When(parHoraSalida__isnull=True, then=F('fkIdVehiculo')), default=None),
+        output_field=models.BigIntegerField(null=True),
+        db_persist=True,
+    )
+    parEspacioActivo = models.GeneratedField(
+        expression=Case(When(parHoraSalida__isnull=True, then=F('fkIdEspacio')), default=None),
+        output_field=models.BigIntegerField(null=True),
+        db_persist=True,
+    )
 
     class Meta:
         db_table = 'inventario_parqueo'
         verbose_name = 'Inventario Parqueo'
         verbose_name_plural = 'Inventario Parqueo'
+        constraints = [
+            models.UniqueConstraint(fields=['parVehiculoActivo'], name='uq_parqueo_vehiculo_activo'),
+            models.UniqueConstraint(fields=['parEspacioActivo'], name='uq_parqueo_espacio_activo'),
+        ]
         indexes = [
             # Índice parcial conceptual: la query más frecuente del sistema es
             # "¿qué vehículos están actualmente parqueados?" = parHoraSalida IS NULL.
@@ -147,3 +453,279 @@ class InventarioParqueo(models.Model):
             partes.append(f'{h}h')
         partes.append(f'{m}m')
         return ' '.join(partes)
+
+
+class SolicitudSalida(models.Model):
+    """
+    Cola materializada de "solicitudes de salida" del guardia: registros de parqueo
+    activos con un cobro en EFECTIVO pendiente de confirmar en portería.
+
+    Trae copiados placa, nombre, piso, espacio y monto para que el dashboard lea la
+    cola con un solo scan por índice, sin joins ni DISTINCT ni queries por fila.
+    Se mantiene en los puntos que cambian la cola:
+      encolar() → ClienteSalidaView.post al crear el Pago EFECTIVO PENDIENTE
+      retirar() → el guardia confirma el pago o autoriza la salida; salida desde el admin
+    Borrar el Pago o el registro de parqueo borra la solicitud (CASCADE).
+    """
+    fkIdParqueo = models.OneToOneField(
+        InventarioParqueo,
+        on_delete=models.CASCADE,
+        related_name='solicitud_salida',
+        db_column='fkIdParqueo',
+    )
+    fkIdPago = models.ForeignKey(
+        'pagos.Pago',
+        on_delete=models.CASCADE,
+        related_name='+',
+        db_column='fkIdPago',
+    )
+    solMonto = models.DecimalField(max_digits=12, decimal_places=2)
+    solPlaca = models.CharField(max_length=8)
+    solNombre = models.CharField(max_length=101)       # Usuario registrado o contacto del visitante
+    solPiso = models.CharField(max_length=30)
+    solEspacio = models.CharField(max_length=10)
+    solHoraEntrada = models.DateTimeField()            # Copia de parHoraEntrada: orden de la cola
+
+    class Meta:
+        db_table = 'solicitudes_salida'
+        verbose_name = 'Solicitud de Salida'
+        verbose_name_plural = 'Solicitudes de Salida'
+        indexes = [
+            models.Index(fields=['-solHoraEntrada'], name='idx_solicitud_entrada'),
+        ]
+
+    def __str__(self):
+        return f'{self.solPlaca} - ${self.solMonto}'
+
+    @property
+    def costo_display(self):
+        return f"${self.solMonto:,.0f}"
+
+    @classmethod
+    def encolar(cls, pago):
+        """Agrega (o actualiza) la solicitud del registro de `pago`, un Pago EFECTIVO PENDIENTE."""
+        registro = pago.fkIdParqueo
+        vehiculo = registro.fkIdVehiculo
+        espacio = registro.fkIdEspacio
+        usuario = vehiculo.fkIdUsuario
+        return cls.objects.update_or_create(fkIdParqueo=registro, defaults={
+            'fkIdPago': pago,
+            'solMonto': pago.pagMonto,
+            'solPlaca': vehiculo.vehPlaca,
+            'solNombre': usuario.usuNombreCompleto if usuario else (vehiculo.nombre_contacto or 'Visitante'),
+            'solPiso': espacio.fkIdPiso.pisNombre,
+            'solEspacio': espacio.espNumero,
+            'solHoraEntrada': registro.parHoraEntrada,
+        })[0]
+
+    @classmethod
+    def retirar(cls, registro):
+        """Saca de la cola la solicitud del registro (pago confirmado o vehículo ya salió)."""
+        cls.objects.filter(fkIdParqueo=registro).delete()
+
+
+class VersionParqueadero(models.Model):
+    """
+    Versión monotónica del estado del parqueadero (singleton, pk=1).
+
+    Cada transición que cambia lo que muestran los dashboards (ocupar/liberar/reservar
+    un espacio, cerrar o vencer reservas, crear o cambiar el estado de un Pago, CRUD
+    de pisos/espacios/tarifas) llama a incrementar(). Los dashboards cachean su snapshot con
+    esta versión en la clave: mientras no cambie, N estaciones consultando en paralelo
+    reutilizan el mismo cálculo (ver parqueadero.utils.obtener_snapshot).
+
+    El incremento se hace en transaction.on_commit y NO dentro de la transacción que
+    hizo el cambio: así la fila no se queda bloqueada mientras dura el ingreso/salida
+    (sería un lock global entre porterías) y ningún lector puede ver la versión nueva
+    antes de que los datos nuevos sean visibles.
+    """
+    version = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'parqueadero_version'
+        verbose_name = 'Versión del Parqueadero'
+
+    def __str__(self):
+        return f'Versión {self.version}'
+
+    @classmethod
+    def actual(cls):
+        """Retorna la versión vigente (una query por PK)."""
+        version = cls.objects.filter(pk=1).values_list('version', flat=True).first()
+        if version is None:
+            obj, _ = cls.objects.get_or_create(pk=1)
+            version = obj.version
+        return version
+
+    @classmethod
+    def incrementar(cls):
+        """Programa el incremento para cuando confirme la transacción actual."""
+        transaction.on_commit(cls._incrementar_ahora)
+
+    @classmethod
+    def _incrementar_ahora(cls):
+        from .utils import canal_cambios
+        if not cls.objects.filter(pk=1).update(version=F('version') + 1):
+            obj, creado = cls.objects.get_or_create(pk=1, defaults={'version': 1})
+            if not creado:
+                cls.objects.filter(pk=1).update(version=F('version') + 1)
+        # Los streams SSE de este proceso se enteran sin esperar al hilo vigía
+        canal_cambios.notificar()
+
+
+class RespuestaIdempotente(models.Model):
+    """
+    Respuesta guardada de un POST con clave de idempotencia (IdempotenteMixin).
+
+    El doble toque en la tablet del guardia o el reintento del navegador llegan con la
+    misma clave y los mismos parámetros: se responde con lo guardado sin volver a tocar
+    inventario, pagos ni espacios. La fila se reserva (idemEstado NULL) antes de ejecutar
+    la vista, así que dos envíos simultáneos tampoco ejecutan dos veces.
+    """
+    idemHuella = models.CharField(max_length=64, unique=True)   # sha256(usuario, ruta, clave, parámetros)
+    idemEstado = models.PositiveSmallIntegerField(null=True)     # Código HTTP; NULL mientras la petición original está en curso
+    idemCuerpo = models.TextField(blank=True)
+    idemCabeceras = models.JSONField(default=dict)               # Content-Type y Location
+    idemMensajes = models.JSONField(default=list)                # [[nivel, texto]] pendientes de mostrar (redirects)
+    idemExpira = models.DateTimeField()
+
+    class Meta:
+        db_table = 'respuestas_idempotentes'
+        verbose_name = 'Respuesta Idempotente'
+        verbose_name_plural = 'Respuestas Idempotentes'
+        indexes = [
+            models.Index(fields=['idemExpira'], name='idx_idempotente_expira'),
+        ]
+
+    def __str__(self):
+        return f'{self.idemHuella[:12]} ({self.idemEstado or "en curso"})'
+
+    @classmethod
+    def purgar(cls):
+        """Borra las respuestas vencidas; retorna cuántas."""
+        return cls.objects.filter(idemExpira__lt=timezone.now()).delete()[0]
+
+
+class RetencionEspacio(models.Model):
+    """
+    Espacio apartado por unos minutos para el cliente que abrió la entrada por QR.
+
+    EntradaParqueaderoView.get reclama un espacio del tipo de cada vehículo del cliente
+    (DISPONIBLE → RESERVADO, el mismo bloqueo de las reservas) y pone el token en el
+    formulario; el POST lo convierte en turno (registrar_ingreso con `retencion`) sin
+    volver a buscar cupo, así que quien ya está frente a la barrera no se queda sin
+    espacio por los que escanearon después. Si el cliente no confirma, liberar_vencidas()
+    devuelve el espacio a DISPONIBLE: un scan por idx_retencion_expira que en el caso
+    normal no encuentra nada.
+    """
+    DURACION = timedelta(minutes=2)
+
+    retToken = models.CharField(max_length=32, unique=True)
+    fkIdEspacio = models.OneToOneField(
+        Espacio,
+        on_delete=models.CASCADE,
+        related_name='retencion',
+        db_column='fkIdEspacio',
+    )
+    fkIdUsuario = models.ForeignKey(
+        'usuarios.Usuario',
+        on_delete=models.CASCADE,
+        related_name='retenciones',
+        db_column='fkIdUsuario',
+    )
+    retExpira = models.DateTimeField()
+
+    class Meta:
+        db_table = 'retenciones_espacio'
+        verbose_name = 'Retención de Espacio'
+        verbose_name_plural = 'Retenciones de Espacio'
+        indexes = [
+            models.Index(fields=['retExpira'], name='idx_retencion_expira'),
+        ]
+
+    def __str__(self):
+        return f'{self.fkIdEspacio_id} hasta {self.retExpira:%H:%M:%S}'
+
+    @classmethod
+    def retener(cls, usuario, tipo_id):
+        """
+        Aparta para `usuario` un espacio DISPONIBLE del tipo durante DURACION; None si no
+        hay cupo. Si ya tiene una retención vigente de ese tipo (recargó la página) se
+        extiende esa en vez de tomar otro espacio.
+        """
+        ahora = timezone.now()
+        expira = ahora + cls.DURACION
+        vigente = cls.objects.filter(
+            fkIdUsuario=usuario, fkIdEspacio__fkIdTipoEspacio_id=tipo_id, retExpira__gt=ahora,
+        ).select_related('fkIdEspacio').first()
+        # Condicional: si el barrido la venció entre las dos queries se toma otro espacio
+        if vigente is not None and cls.objects.filter(
+            pk=vigente.pk, retExpira__gt=ahora,
+        ).update(retExpira=expira):
+            vigente.retExpira = expira
+            return vigente
+
+        with transaction.atomic():
+            espacio = Espacio.reclamar_disponible(tipo_id, hacia='RESERVADO')
+            if espacio is None:
+                return None
+            # update_or_create: una retención huérfana del espacio (liberado a mano desde
+            # el admin) no debe romper la unicidad de fkIdEspacio
+            return cls.objects.update_or_create(fkIdEspacio=espacio, defaults={
+                'retToken': uuid.uuid4().hex,
+                'fkIdUsuario': usuario,
+                'retExpira': expira,
+            })[0]
+
+    def convertir(self):
+        """
+        Ocupa el espacio retenido si la retención sigue vigente y la consume; None si
+        venció (o ya se usó) y hay que buscar espacio como en una entrada normal.
+        Llamar dentro de la transacción que crea el InventarioParqueo.
+        """
+        with transaction.atomic():
+            if not RetencionEspacio.objects.filter(pk=self.pk, retExpira__gt=timezone.now()).delete()[0]:
+                return None
+            return Espacio.reclamar(self.fkIdEspacio_id, desde=('RESERVADO',))
+
+    @classmethod
+    def liberar_vencidas(cls):
+        """Devuelve a DISPONIBLE los espacios de las retenciones vencidas; retorna cuántas había."""
+        return cls._liberar(retExpira__lte=timezone.now())
+
+    @classmethod
+    def soltar(cls, retenciones):
+        """Libera ya las retenciones dadas (el cliente entró con otro vehículo o por su reserva)."""
+        return cls._liberar(pk__in=[r.pk for r in retenciones]) if retenciones else 0
+
+    @classmethod
+    def _liberar(cls, **filtros):
+        from .utils import pool_espacios
+        # Lectura sin bloqueo primero: en el caso normal no hay nada que liberar
+        if not cls.objects.filter(**filtros).exists():
+            return 0
+        with transaction.atomic():
+            # Bloquear las retenciones hace esperar a un convertir() concurrente, que
+            # luego no las encuentra y busca espacio por el pool
+            retenidos = dict(cls.objects.select_for_update().filter(**filtros).values_list('pk', 'fkIdEspacio_id'))
+            espacios = {
+                pk: (piso_id, tipo_id, numero)
+                for pk, piso_id, tipo_id, numero in Espacio.objects.select_for_update().filter(
+                    pk__in=retenidos.values(), espEstado='RESERVADO',
+                ).values_list('pk', 'fkIdPiso_id', 'fkIdTipoEspacio_id', 'espNumero')
+            }
+            Espacio.objects.filter(pk__in=espacios).update(espEstado='DISPONIBLE')
+            cls.objects.filter(pk__in=retenidos).delete()
+            # .update() no pasa por Espacio.liberar(): contadores, pool y versión a mano
+            ContadorEspacios.aplicar(
+                salen=[(piso_id, tipo_id, 'RESERVADO') for piso_id, tipo_id, _ in espacios.values()],
+                entran=[(piso_id, tipo_id, 'DISPONIBLE') for piso_id, tipo_id, _ in espacios.values()],
+            )
+
+            def avisar_pool():
+                for pk, (piso_id, tipo_id, numero) in espacios.items():
+                    pool_espacios.actualizar(pk, (piso_id, tipo_id, 'DISPONIBLE'), numero)
+            transaction.on_commit(avisar_pool)
+            if espacios:
+                VersionParqueadero.incrementar()
+        return len(retenidos)
@@ -6,13 +6,14 @@ from django.views import View
 from django.http import HttpResponse
 from django.db.models import Sum
 from django.utils import timezone
-from datetime import datetime, timedelta
+from datetime import timedelta
 from decimal import Decimal
 import json
 
 from usuarios.mixins import AdminRequiredMixin
-from parqueadero.models import Piso, Espacio, InventarioParqueo
+from parqueadero.models import ContadorEspacios, Piso, InventarioParqueo
 from pagos.models import Pago
+from parqueadero.utils import conteo_por_hora, rango_dia_local
 from reservas.models import Reserva
 
 
@@ -52,11 +53,12 @@ class ReportesView(AdminRequiredMixin, View):
         # 1. MÉTRICAS PRINCIPALES
         # ══════════════════════════════════════════
 
-        # Total espacios
-        total_espacios = Espacio.objects.filter(espEstado__in=['DISPONIBLE', 'OCUPADO']).count()
+        # Total espacios (operativos: DISPONIBLE + OCUPADO) y ocupados, desde los contadores
+        totales = ContadorEspacios.totales()
+        total_espacios = totales['DISPONIBLE'] + totales['OCUPADO']
 
         # Espacios actualmente ocupados
-        espacios_ocupados = Espacio.objects.filter(espEstado='OCUPADO').count()
+        espacios_ocupados = totales['OCUPADO']
 
         # Ocupación promedio en el período
         if total_espacios > 0:
@@ -123,27 +125,15 @@ class ReportesView(AdminRequiredMixin, View):
         # Obtener fecha local de hoy
         hoy_local = timezone.localtime(now).date()
 
-        # Traer todos los registros del día actual
-        registros_hoy = InventarioParqueo.objects.filter(
-            parHoraEntrada__range=(
-                timezone.make_aware(datetime.combine(hoy_local, datetime.min.time())),
-                timezone.make_aware(datetime.combine(hoy_local, datetime.max.time()))
-            )
+        # Ingresos del día agrupados por hora local en la BD (GROUP BY hora)
+        counts_por_hora = conteo_por_hora(
+            InventarioParqueo.objects.filter(parHoraEntrada__range=rango_dia_local(hoy_local)),
+            'parHoraEntrada', range(6, 23),
         )
 
-        # Contar por hora en Python (más eficiente)
-        counts_por_hora = {h: 0 for h in range(6, 23)}
-        for r in registros_hoy:
-            h = timezone.localtime(r.parHoraEntrada).hour
-            if 6 <= h < 23:
-                counts_por_hora[h] += 1
-
         # Generar labels y data
-        ocupacion_labels = []
-        ocupacion_data = []
-        for h in range(6, 23):
-            ocupacion_labels.append(f"{h}:00")
-            ocupacion_data.append(counts_por_hora[h])
+        ocupacion_labels = [f"{h}:00" for h in counts_por_hora]
+        ocupacion_data = list(counts_por_hora.values())
 
         # ══════════════════════════════════════════
         # 3. INGRESOS MENSUALES (últimos 6 meses)
@@ -201,15 +191,15 @@ class ReportesView(AdminRequiredMixin, View):
         # 5. RESUMEN POR PISO
         # ══════════════════════════════════════════
 
-        pisos = Piso.objects.filter(pisEstado=True).prefetch_related('espacios')
+        pisos = Piso.objects.filter(pisEstado=True)
+        contadores_piso = ContadorEspacios.por_piso()
         resumen_pisos = []
 
         for piso in pisos:
-            total_espacios_piso = piso.espacios.filter(
-                espEstado__in=['DISPONIBLE', 'OCUPADO']
-            ).count()
+            estados = contadores_piso.get(piso.pk, {})
+            total_espacios_piso = estados.get('DISPONIBLE', 0) + estados.get('OCUPADO', 0)
 
-            ocupados_piso = piso.espacios.filter(espEstado='OCUPADO').count()
+            ocupados_piso = estados.get('OCUPADO', 0)
 
             if total_espacios_piso > 0:
                 ocupacion_piso = int((ocupados_piso / total_espacios_piso) * 100)
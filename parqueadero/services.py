@@ -1,6 +1,22 @@
 import math
+import re
+from dataclasses import dataclass
+from datetime import timedelta
+from decimal import Decimal
 
+from django.db import DatabaseError, IntegrityError, transaction
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from fidelidad.models import Sticker
+from multiparking import email_utils
+from pagos.models import Pago
+from reservas.models import Reserva
+from tarifas.models import Tarifa
+from vehiculos.models import Vehiculo
+
+from .models import Espacio, InventarioParqueo, RetencionEspacio, SolicitudSalida, TipoEspacio
+from .utils import pool_espacios
 
 STICKER_MIN_MINUTOS = 60  # Mínimo de minutos para ganar un sticker de fidelidad
 
@@ -29,3 +45,322 @@ def calcular_costo_parqueo(hora_entrada, tarifa, vehiculo, hora_salida=None):
         else float(tarifa.precioHora)
     )
     return math.ceil((precio / 60) * total_minutos)
+
+
+def minutos_cobrables(hora_entrada, hora_salida):
+    """Minutos del turno redondeados hacia arriba, mínimo 1 (misma regla que el cobro)."""
+    return max((int((hora_salida - hora_entrada).total_seconds()) + 59) // 60, 1)
+
+
+@dataclass
+class ResultadoSalida:
+    registro: InventarioParqueo
+    pago: Pago | None     # None: no había pago previo ni tarifa activa (salida sin cobro)
+    monto: Decimal
+    minutos: int
+    sticker: bool         # True si el turno ganó un sticker de fidelidad
+
+
+def registrar_salida(registro, pago=None, ahora=None):
+    """
+    Cierra el turno `registro` (salida desde el admin, el guardia o el cliente con PSE).
+
+    En una sola transacción: marca la hora de salida, saca el registro de la cola de
+    salidas, cobra (confirma el pago pendiente o, si no hay, crea uno PAGADO en efectivo
+    con la tarifa activa), otorga el sticker de fidelidad y libera el espacio. El recibo
+    por correo sale después del commit. `pago` es un pago ya confirmado por quien llama
+    (PSE del cliente); se usa tal cual.
+
+    `registro` debe venir con select_related('fkIdVehiculo', 'fkIdEspacio'). Con eso el
+    costo es fijo, sin importar el historial del vehículo (ver SalidaServicioTests): 9
+    sentencias con pago pendiente y sticker (cierre, cola, pago ×2, sticker, espacio ×2 y
+    2 contadores); una más si hay que crear el pago (tarifa + INSERT).
+
+    Retorna un ResultadoSalida, o None si el turno ya estaba cerrado (dos porterías
+    registrando la misma salida a la vez: solo una la cierra y cobra).
+    """
+    ahora = ahora or timezone.now()
+    vehiculo, espacio = registro.fkIdVehiculo, registro.fkIdEspacio
+
+    with transaction.atomic():
+        # UPDATE condicional: el turno se cierra una sola vez aunque lleguen dos salidas
+        if not InventarioParqueo.objects.filter(
+            pk=registro.pk, parHoraSalida__isnull=True,
+        ).update(parHoraSalida=ahora):
+            return None
+        registro.parHoraSalida = ahora
+        SolicitudSalida.retirar(registro)
+
+        minutos = minutos_cobrables(registro.parHoraEntrada, ahora)
+        if pago is None:
+            pago = Pago.objects.filter(fkIdParqueo=registro, pagEstado='PENDIENTE').first()
+            if pago is not None:
+                # Pago pre-calculado (el cliente eligió efectivo): solo confirmarlo
+                pago.pagEstado = 'PAGADO'
+                pago.save(update_fields=['pagEstado'])
+            else:
+                tarifa = Tarifa.get_active_for(espacio.fkIdTipoEspacio_id)
+                if tarifa:
+                    pago = Pago.objects.create(
+                        pagMonto=calcular_costo_parqueo(registro.parHoraEntrada, tarifa, vehiculo, ahora),
+                        pagMetodo='EFECTIVO',
+                        pagEstado='PAGADO',
+                        fkIdParqueo=registro,
+                    )
+
+        # Sticker de fidelidad: usuario registrado con al menos STICKER_MIN_MINUTOS.
+        # El UPDATE condicional de arriba garantiza que nadie más está cerrando este turno.
+        sticker = not vehiculo.es_visitante and minutos >= STICKER_MIN_MINUTOS
+        if sticker:
+            Sticker.objects.create(fkIdParqueo=registro, fkIdUsuario_id=vehiculo.fkIdUsuario_id)
+
+        espacio.liberar()
+
+        if pago is not None and not vehiculo.es_visitante:
+            transaction.on_commit(lambda: email_utils.enviar_recibo_pago(pago, registro))
+
+    return ResultadoSalida(
+        registro=registro,
+        pago=pago,
+        monto=pago.pagMonto if pago is not None else Decimal('0'),
+        minutos=minutos,
+        sticker=sticker,
+    )
+
+
+# ── Ingreso ──────────────────────────────────────────────────────────
+
+class IngresoRechazado(Exception):
+    """El ingreso no se puede registrar; el mensaje se muestra tal cual al usuario."""
+
+
+def vehiculo_para_ingreso(placa, nombre='', telefono=''):
+    """
+    Valida los datos del formulario de ingreso rápido (admin y guardia) y retorna el
+    vehículo de la placa. Si no existe lo crea como visitante (sin usuario); si es un
+    visitante conocido, actualiza sus datos de contacto con los que se ingresaron.
+    """
+    if not re.match(r'^[A-Za-z0-9-]+$', placa):
+        raise IngresoRechazado('La placa solo acepta letras, números y guiones.')
+    if nombre and not re.match(r'^[a-zA-ZáéíóúÁÉÍÓÚñÑ\s]+$', nombre):
+        raise IngresoRechazado('El nombre solo debe contener letras.')
+    if telefono and not re.match(r'^[0-9]+$', telefono):
+        raise IngresoRechazado('El teléfono solo debe contener números.')
+
+    vehiculo, creado = Vehiculo.objects.get_or_create(vehPlaca=placa, defaults={
+        'vehTipo': 'Carro', 'nombre_contacto': nombre, 'telefono_contacto': telefono,
+    })
+    if not creado and vehiculo.es_visitante and (nombre or telefono):
+        if nombre:
+            vehiculo.nombre_contacto = nombre
+        if telefono:
+            vehiculo.telefono_contacto = telefono
+        vehiculo.save(update_fields=['nombre_contacto', 'telefono_contacto'])
+    return vehiculo
+
+
+def registrar_ingreso(vehiculo, espacio_id=None, reserva=None, hora=None, retencion=None, tipos=None):
+    """
+    Abre un turno para `vehiculo` (ingreso desde el admin, el guardia o el QR del cliente).
+
+    El espacio sale, en este orden, de la reserva (su espacio, DISPONIBLE o RESERVADO),
+    de `espacio_id` (el que eligió el operador), de `retencion` (la RetencionEspacio que
+    apartó la página de entrada por QR, si sigue vigente) o del pool de libres según el
+    tipo del vehículo. Siempre se reclama de forma atómica (Espacio.reclamar): dos
+    porterías nunca ocupan el mismo espacio.
+
+    La transacción de la portería solo hace lo imprescindible: reclamar el espacio, crear
+    el InventarioParqueo y apuntar el espacio a él (fkIdParqueoActual). Que el vehículo
+    no esté ya adentro no se pregunta antes: lo garantiza la restricción única sobre
+    parVehiculoActivo y el IntegrityError del INSERT se traduce al mensaje de siempre
+    (ver _rechazo_por_turno_abierto). Completar la reserva y el correo de confirmación
+    van en on_commit. Presupuesto con espacio elegido (ver IngresoServicioTests): 6
+    sentencias (reclamo ×2, contadores ×2, INSERT, puntero); con pool suma la búsqueda
+    del TipoEspacio, salvo que `tipos` ({nombre: pk}) ya venga resuelto por quien llama
+    (los lotes de cámaras lo leen una vez por lote).
+
+    `hora` fija la hora de entrada cuando el evento ocurrió antes de registrarse (cámaras
+    que reenvían eventos acumulados); va en el mismo INSERT.
+
+    Retorna el InventarioParqueo nuevo con fkIdEspacio cargado. Lanza IngresoRechazado
+    con un mensaje para el usuario si el vehículo ya está adentro o no hay espacio.
+    """
+    espacio = None
+    estado_anterior = 'DISPONIBLE'
+    try:
+        with transaction.atomic():
+            if reserva is not None:
+                espacio = Espacio.reclamar(reserva.fkIdEspacio_id, desde=('DISPONIBLE', 'RESERVADO'))
+            elif espacio_id is not None:
+                espacio = Espacio.reclamar(espacio_id)
+            else:
+                if retencion is not None:
+                    espacio = retencion.convertir()
+                    if espacio is not None:
+                        estado_anterior = 'RESERVADO'
+                if espacio is None:
+                    tipo_nombre = 'Moto' if vehiculo.vehTipo == 'Moto' else 'Carro'
+                    if tipos is None:
+                        tipos = dict(TipoEspacio.objects.filter(nombre=tipo_nombre).values_list('nombre', 'pk'))
+                    tipo_id = tipos.get(tipo_nombre)
+                    espacio = Espacio.reclamar_disponible(tipo_id)
+                    if espacio is None and RetencionEspacio.liberar_vencidas():
+                        # El pool estaba vacío por retenciones abandonadas: ya volvieron
+                        espacio = Espacio.reclamar_disponible(tipo_id)
+                if espacio is None:
+                    raise IngresoRechazado(
+                        f'Lo sentimos, no hay espacios disponibles para {tipo_nombre} en este momento. '
+                        'Por favor intenta más tarde.'
+                    )
+            if espacio is None and reserva is not None:
+                raise IngresoRechazado(
+                    f'El espacio reservado {reserva.fkIdEspacio.espNumero} no está disponible. Contacta al administrador.'
+                )
+            if espacio is None:
+                raise IngresoRechazado('El espacio seleccionado no está disponible.')
+
+            # INSERT optimista: las restricciones únicas rechazan un segundo turno abierto
+            registro = InventarioParqueo.objects.create(
+                fkIdVehiculo=vehiculo, fkIdEspacio=espacio, parHoraEntrada=hora or timezone.now(),
+            )
+            espacio.asignar_parqueo(registro)
+
+            if reserva is not None:
+                # Solo si sigue activa: una cancelación concurrente no se pisa
+                transaction.on_commit(lambda: Reserva.objects.filter(
+                    pk=reserva.pk, resEstado__in=['PENDIENTE', 'CONFIRMADA'],
+                ).update(resEstado='COMPLETADA'))
+            transaction.on_commit(lambda: email_utils.enviar_confirmacion_entrada(registro))
+    except IntegrityError as e:
+        rechazo = _rechazo_por_turno_abierto(e, vehiculo)
+        if rechazo is None:
+            raise
+        if espacio is not None and reserva is None:
+            # El rollback dejó el espacio como estaba (DISPONIBLE, o RESERVADO si venía de
+            # una retención); sin esto el pool lo perdería hasta la próxima recarga
+            piso_id, tipo_id, _ = espacio._clave_actual()
+            pool_espacios.actualizar(espacio.pk, (piso_id, tipo_id, estado_anterior), espacio.espNumero)
+        raise rechazo from e
+    return registro
+
+
+def _rechazo_por_turno_abierto(error, vehiculo):
+    """
+    Traduce la violación de uq_parqueo_vehiculo_activo / uq_parqueo_espacio_activo al
+    mensaje para el usuario; None si el IntegrityError es otro. MySQL y PostgreSQL citan
+    el nombre de la restricción; SQLite, la columna.
+    """
+    texto = str(error).lower()
+    if 'vehiculo_activo' in texto or 'parvehiculoactivo' in texto:
+        return IngresoRechazado(f'El vehículo {vehiculo.vehPlaca} ya tiene un ingreso activo.')
+    if 'espacio_activo' in texto or 'parespacioactivo' in texto:
+        return IngresoRechazado('El espacio seleccionado no está disponible.')
+    return None
+
+
+# ── Eventos de cámaras LPR ───────────────────────────────────────────
+
+LOTE_EVENTOS_CAMARA = 200      # Eventos por transacción al procesar un lote
+MAX_EVENTOS_CAMARA = 5000      # Tamaño máximo de un lote por petición
+TOLERANCIA_RELOJ_CAMARA = timedelta(minutes=5)  # Desfase aceptado del reloj de la cámara
+
+
+def _leer_evento_camara(datos):
+    """Valida un evento crudo de cámara; retorna un dict normalizado o lanza ValueError."""
+    if not isinstance(datos, dict):
+        raise ValueError('El evento debe ser un objeto.')
+    placa = str(datos.get('placa') or '').upper().strip()
+    tipo = str(datos.get('tipo') or '').upper().strip()
+    if not placa:
+        raise ValueError('Placa requerida.')
+    if tipo not in ('ENTRADA', 'SALIDA'):
+        raise ValueError('El tipo debe ser ENTRADA o SALIDA.')
+    hora = parse_datetime(str(datos.get('hora') or ''))
+    if hora is None:
+        raise ValueError('Hora inválida; se espera ISO 8601.')
+    if timezone.is_naive(hora):
+        hora = timezone.make_aware(hora)
+    if hora > timezone.now() + TOLERANCIA_RELOJ_CAMARA:
+        raise ValueError('La hora del evento está en el futuro.')
+    return {
+        'id': datos.get('id'),
+        'placa': placa,
+        'tipo': tipo,
+        'hora': hora,
+        'porteria': str(datos.get('porteria') or ''),
+    }
+
+
+def _aplicar_evento_camara(evento, tipos):
+    """
+    Registra un evento ya validado con los mismos servicios de la portería manual.
+    `tipos` es el {nombre: pk} de TipoEspacio leído una vez para todo el lote.
+    """
+    placa, hora = evento['placa'], evento['hora']
+    if evento['tipo'] == 'ENTRADA':
+        # Reenvío de un evento ya aplicado: un turno cerrado ya cubre esa hora
+        if InventarioParqueo.objects.filter(
+            fkIdVehiculo__vehPlaca=placa, parHoraEntrada__lte=hora, parHoraSalida__gte=hora,
+        ).exists():
+            raise IngresoRechazado(f'El ingreso de {placa} a esa hora ya fue registrado.')
+        registro = registrar_ingreso(vehiculo_para_ingreso(placa), hora=hora, tipos=tipos)
+        return {'registro': registro.pk, 'espacio': registro.fkIdEspacio.espNumero}
+
+    registro = (
+        InventarioParqueo.objects
+        .select_related('fkIdVehiculo', 'fkIdEspacio')
+        .filter(fkIdVehiculo__vehPlaca=placa, parHoraSalida__isnull=True)
+        .first()
+    )
+    if registro is None:
+        raise IngresoRechazado(f'El vehículo {placa} no tiene un ingreso activo.')
+    if hora < registro.parHoraEntrada:
+        raise IngresoRechazado(f'La salida de {placa} es anterior a su ingreso activo.')
+    resultado = registrar_salida(registro, ahora=hora)
+    if resultado is None:
+        raise IngresoRechazado(f'La salida de {placa} ya fue registrada.')
+    return {'registro': registro.pk, 'monto': float(resultado.monto), 'minutos': resultado.minutos}
+
+
+def procesar_eventos_camara(eventos):
+    """
+    Registra un lote de eventos de las cámaras de las rampas (entradas y salidas por placa).
+
+    Las cámaras acumulan eventos cuando se cae la red y los reenvían juntos, así que el
+    lote se aplica en orden cronológico (no en el de llegada) y en transacciones de
+    LOTE_EVENTOS_CAMARA eventos: cientos de ingresos por commit en lugar de uno por
+    petición. Cada evento va en su propio savepoint; uno rechazado (placa ya adentro,
+    sin espacio, salida sin ingreso) no tumba a los demás del bloque.
+
+    Entradas y salidas usan registrar_ingreso/registrar_salida con la hora del evento:
+    el cobro, el sticker y la liberación del espacio son los mismos que en la portería.
+    Reenviar un lote ya aplicado no duplica turnos: la entrada cae dentro de un turno
+    cerrado (o el vehículo sigue adentro) y la salida no encuentra ingreso abierto.
+
+    Retorna un resultado por evento, en el orden recibido:
+    {'id', 'porteria', 'estado': OK|RECHAZADO|INVALIDO|ERROR, 'mensaje', ...}.
+    """
+    resultados = [None] * len(eventos)
+    validos = []
+    for i, datos in enumerate(eventos):
+        try:
+            validos.append((i, _leer_evento_camara(datos)))
+        except ValueError as e:
+            evento_id = datos.get('id') if isinstance(datos, dict) else None
+            resultados[i] = {'id': evento_id, 'estado': 'INVALIDO', 'mensaje': str(e)}
+    validos.sort(key=lambda par: par[1]['hora'])  # sort estable: empates conservan el orden
+    tipos = dict(TipoEspacio.objects.values_list('nombre', 'pk')) if validos else {}
+
+    for inicio in range(0, len(validos), LOTE_EVENTOS_CAMARA):
+        with transaction.atomic():
+            for i, evento in validos[inicio:inicio + LOTE_EVENTOS_CAMARA]:
+                resultado = {'id': evento['id'], 'porteria': evento['porteria']}
+                try:
+                    with transaction.atomic():
+                        resultado.update(_aplicar_evento_camara(evento, tipos), estado='OK', mensaje='')
+                except IngresoRechazado as e:
+                    resultado.update(estado='RECHAZADO', mensaje=str(e))
+                except DatabaseError:
+                    resultado.update(estado='ERROR', mensaje='Error de base de datos al registrar el evento.')
+                resultados[i] = resultado
+    return resultados
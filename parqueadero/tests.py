@@ -1,3 +1,1542 @@
-from django.test import TestCase
+import gzip
+import json
+import threading
+import time
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from pagos.models import Pago
+from fidelidad.models import Sticker
+from reservas.models import Reserva
+from tarifas.models import Tarifa
+from usuarios.models import Usuario
+from vehiculos.models import Vehiculo
+
+from .models import (
+    ContadorEspacios, Espacio, InventarioParqueo, Piso, RespuestaIdempotente, RetencionEspacio, SolicitudSalida,
+    TipoEspacio, VersionParqueadero,
+)
+from .services import (
+    IngresoRechazado, procesar_eventos_camara, registrar_ingreso, registrar_salida, vehiculo_para_ingreso,
+)
+from .utils import (
+    ESTADOS_COMPACTOS, PoolEspacios, VueloUnico, pool_espacios, prioridad_pisos_preferidos, _calcular_pisos_data, conteo_por_hora, obtener_delta,
+    firmar_qr_espacio, leer_qr_espacio, obtener_delta_compacto, obtener_snapshot, stream_tablero, suma_por_dia,
+)
+from .views import _payload_dashboard_admin
+from .vigilante_views import _payload_dashboard_guardia
+
+
+class ParqueaderoTestMixin:
+    """Crea un parqueadero mínimo: pisos con espacios de tipo Carro."""
+
+    def crear_parqueadero(self, pisos=2, espacios_por_piso=3):
+        self.tipo_carro, _ = TipoEspacio.objects.get_or_create(nombre='Carro')
+        creados = []
+        for p in range(1, pisos + 1):
+            piso = Piso.objects.create(pisNombre=f'Piso {p}')
+            for e in range(1, espacios_por_piso + 1):
+                creados.append(Espacio.objects.create(
+                    espNumero=f'P{p}-{e:02d}', fkIdPiso=piso, fkIdTipoEspacio=self.tipo_carro,
+                ))
+        return creados
+
+    def iniciar_sesion(self, rol='ADMIN'):
+        # Los mixins de acceso solo miran la sesión (usuario_id + usuario_rol)
+        session = self.client.session
+        session['usuario_id'] = 1
+        session['usuario_rol'] = rol
+        session.save()
+
+    def ingresar(self, espacio, placa):
+        vehiculo = Vehiculo.objects.create(vehPlaca=placa)
+        registro = InventarioParqueo.objects.create(fkIdVehiculo=vehiculo, fkIdEspacio=espacio)
+        espacio.ocupar(registro)
+        return registro
+
+
+class CalcularPisosDataTests(ParqueaderoTestMixin, TestCase):
+
+    def test_numero_de_queries_no_depende_de_los_espacios(self):
+        espacios = self.crear_parqueadero(pisos=2, espacios_por_piso=3)
+        self.ingresar(espacios[0], 'AAA111')
+        now = timezone.now()
+        # pisos + espacios con la placa de su turno (join por fkIdParqueoActual) + reservas
+        with self.assertNumQueries(3):
+            _calcular_pisos_data(now)
+
+        # Triplicar pisos y espacios no agrega queries
+        espacios += self.crear_parqueadero(pisos=4, espacios_por_piso=20)
+        for i, espacio in enumerate(espacios[10:20]):
+            self.ingresar(espacio, f'BBB{i:03d}')
+        with self.assertNumQueries(3):
+            _calcular_pisos_data(now)
+
+    def test_datos_por_piso_y_por_espacio(self):
+        espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=4)
+        registro = self.ingresar(espacios[0], 'AAA111')
+        Pago.objects.create(pagMonto=5000, pagMetodo='EFECTIVO', pagEstado='PENDIENTE', fkIdParqueo=registro)
+        self.ingresar(espacios[1], 'BBB222')
+
+        now = timezone.now()
+        inicio = timezone.localtime(now + timedelta(hours=1))
+        reserva = Reserva.objects.create(
+            resFechaReserva=inicio.date(), resHoraInicio=inicio.time().replace(microsecond=0),
+            fkIdEspacio=espacios[2], fkIdVehiculo=Vehiculo.objects.create(vehPlaca='CCC333'),
+        )
+        lejana = timezone.localtime(now + timedelta(hours=5))
+        Reserva.objects.create(
+            resFechaReserva=lejana.date(), resHoraInicio=lejana.time().replace(microsecond=0),
+            fkIdEspacio=espacios[3], fkIdVehiculo=Vehiculo.objects.create(vehPlaca='DDD444'),
+        )
+
+        piso = _calcular_pisos_data(now)[0]
+        self.assertEqual(piso.total_espacios, 4)
+        self.assertEqual(piso.ocupados_espacios, 2)
+        self.assertEqual(piso.ocupacion_pct, 50)
+
+        por_numero = {e.espNumero: e for e in piso.espacios_list}
+        self.assertEqual([e.espNumero for e in piso.espacios_list], sorted(por_numero))
+        self.assertEqual(por_numero['P1-01'].placa_actual, 'AAA111')
+        self.assertTrue(por_numero['P1-01'].pago_pendiente)
+        self.assertEqual(por_numero['P1-02'].placa_actual, 'BBB222')
+        self.assertFalse(por_numero['P1-02'].pago_pendiente)
+        self.assertEqual(por_numero['P1-03'].reserva_proxima, reserva)
+        self.assertIsNone(por_numero['P1-04'].reserva_proxima)
+        self.assertIsNone(por_numero['P1-04'].placa_actual)
+
+
+class SnapshotDashboardTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=2)
+
+    def test_transiciones_incrementan_la_version(self):
+        inicial = VersionParqueadero.actual()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.espacios[0].ocupar()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.espacios[0].liberar()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.espacios[1].reservar()
+        self.assertEqual(VersionParqueadero.actual(), inicial + 3)
+
+    def test_snapshot_se_reutiliza_hasta_que_cambia_la_version(self):
+        llamadas = []
+
+        def construir(now):
+            llamadas.append(now)
+            return {'ocupados': Espacio.objects.filter(espEstado='OCUPADO').count()}
+
+        self.assertEqual(obtener_snapshot('test', construir)['ocupados'], 0)
+        with self.assertNumQueries(1):  # solo leer la versión
+            obtener_snapshot('test', construir)
+        self.assertEqual(len(llamadas), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.espacios[0].ocupar()
+        self.assertEqual(obtener_snapshot('test', construir)['ocupados'], 1)
+        self.assertEqual(len(llamadas), 2)
+
+
+class DeltaDashboardTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.espacios = self.crear_parqueadero(pisos=2, espacios_por_piso=3)
+
+    def test_sin_version_responde_payload_completo(self):
+        data = obtener_delta('admin', _payload_dashboard_admin)
+        self.assertFalse(data['delta'])
+        self.assertEqual(len(data['pisos']), 2)
+        self.assertEqual(obtener_delta('admin', _payload_dashboard_admin, 'basura')['delta'], False)
+
+    def test_delta_solo_incluye_lo_que_cambio(self):
+        version = obtener_delta('admin', _payload_dashboard_admin)['version']
+        self.assertEqual(
+            obtener_delta('admin', _payload_dashboard_admin, version),
+            {'version': version, 'delta': True},
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ingresar(self.espacios[4], 'AAA111')
+        delta = obtener_delta('admin', _payload_dashboard_admin, version)
+        self.assertTrue(delta['delta'])
+        self.assertNotEqual(delta['version'], version)
+        self.assertEqual(delta['ocupados'], 1)
+        self.assertEqual(delta['disponibles'], 5)
+        self.assertNotIn('total_espacios', delta)
+
+        [piso] = delta['pisos']
+        self.assertEqual(piso['pk'], self.espacios[4].fkIdPiso_id)
+        self.assertEqual(piso['ocupados_espacios'], 1)
+        [espacio] = piso['espacios']
+        self.assertEqual(espacio['pk'], self.espacios[4].pk)
+        self.assertEqual(espacio['espEstado'], 'OCUPADO')
+        self.assertEqual(espacio['placa_actual'], 'AAA111')
+
+    def test_cambio_de_estructura_responde_payload_completo(self):
+        version = obtener_delta('admin', _payload_dashboard_admin)['version']
+        with self.captureOnCommitCallbacks(execute=True):
+            Espacio.objects.create(espNumero='P1-99', fkIdPiso=self.espacios[0].fkIdPiso,
+                                   fkIdTipoEspacio=self.tipo_carro)
+            VersionParqueadero.incrementar()
+        data = obtener_delta('admin', _payload_dashboard_admin, version)
+        self.assertFalse(data['delta'])
+        self.assertEqual(data['total_espacios'], 7)
+
+
+class StreamTableroTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.crear_parqueadero(pisos=1, espacios_por_piso=2)
+
+    def _evento(self, chunk):
+        campos = dict(linea.split(': ', 1) for linea in chunk.strip().split('\n'))
+        return campos['id'], campos['event'], json.loads(campos['data'])
+
+    def test_primer_evento_es_el_payload_completo(self):
+        stream = stream_tablero('admin', _payload_dashboard_admin)
+        self.assertTrue(next(stream).startswith('retry: '))
+        id_evento, tipo, data = self._evento(next(stream))
+        stream.close()
+        self.assertEqual(tipo, 'tablero')
+        self.assertEqual(id_evento, data['version'])
+        self.assertFalse(data['delta'])
+        self.assertEqual(data['total_espacios'], 2)
+
+    def test_reconexion_con_version_conocida_envia_delta(self):
+        version = obtener_delta('admin', _payload_dashboard_admin)['version']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ingresar(Espacio.objects.first(), 'AAA111')
+        stream = stream_tablero('admin', _payload_dashboard_admin, since=version)
+        next(stream)
+        _, _, data = self._evento(next(stream))
+        stream.close()
+        self.assertTrue(data['delta'])
+        self.assertEqual(data['ocupados'], 1)
+
+    @override_settings(DASHBOARD_SSE=False)
+    def test_sin_dashboard_sse_los_dashboards_usan_polling(self):
+        casos = (
+            ('ADMIN', 'admin_dashboard', 'admin_dashboard_stream'),
+            ('VIGILANTE', 'guardia_dashboard', 'guardia_stream'),
+        )
+        for rol, pagina, stream in casos:
+            self.iniciar_sesion(rol)
+            response = self.client.get(reverse(pagina))
+            self.assertFalse(response.context['dashboard_sse'])
+            self.assertContains(response, 'const SSE_ACTIVO = false;')
+            # Una página vieja que abra el stream recibe 204 y EventSource no reconecta
+            self.assertEqual(self.client.get(reverse(stream)).status_code, 204)
+
+    @override_settings(DASHBOARD_SSE=True)
+    def test_con_dashboard_sse_el_stream_responde(self):
+        self.iniciar_sesion('VIGILANTE')
+        self.assertContains(self.client.get(reverse('guardia_dashboard')), 'const SSE_ACTIVO = true;')
+        response = self.client.get(reverse('guardia_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        response.close()
+
+
+class EtagDashboardTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=2)
+
+    def test_dashboard_responde_304_sin_queries_del_payload(self):
+        casos = (('ADMIN', 'admin_dashboard_data'), ('VIGILANTE', 'guardia_data'))
+        for (rol, url), espacio in zip(casos, self.espacios):
+            self.iniciar_sesion(rol)
+            response = self.client.get(reverse(url))
+            etag = response['ETag']
+            self.assertEqual(etag, f'"{response.json()["version"]}"')
+
+            with self.assertNumQueries(2):  # sesión + versión
+                response = self.client.get(reverse(url), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ingresar(espacio, f'{rol[:3]}111')
+            response = self.client.get(reverse(url), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_distingue_el_formato_y_sobrevive_a_gzip(self):
+        self.iniciar_sesion('VIGILANTE')
+        url = reverse('guardia_data')
+        completo = self.client.get(url)['ETag']
+
+        response = self.client.get(url, {'formato': 'compacto'}, HTTP_IF_NONE_MATCH=completo)
+        self.assertEqual(response.status_code, 200)
+        compacto = response['ETag']
+        self.assertNotEqual(compacto, completo)
+        layout = response.json()['layout']
+
+        # Otro layout cambia el cuerpo (viaja o no la 'estructura'): otra ETag
+        response = self.client.get(url, {'formato': 'compacto', 'layout': layout}, HTTP_IF_NONE_MATCH=compacto)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('estructura', response.json())
+
+        # Comprimida la ETag sigue siendo fuerte y el 304 funciona igual
+        response = self.client.get(url, {'formato': 'compacto'}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['ETag'], compacto)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        response = self.client.get(url, {'formato': 'compacto'}, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=compacto)
+        self.assertEqual(response.status_code, 304)
+
+    def test_detalle_cambia_etag_con_la_version(self):
+        self.iniciar_sesion('VIGILANTE')
+        registro = self.ingresar(self.espacios[0], 'AAA111')
+        url = reverse('guardia_detalle_ocupacion') + f'?espacio_id={self.espacios[0].pk}'
+        response = self.client.get(url)
+        self.assertTrue(response.json()['found'])
+        etag = response['ETag']
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            Pago.objects.create(pagMonto=5000, pagMetodo='EFECTIVO', pagEstado='PENDIENTE', fkIdParqueo=registro)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['tiene_pago_pendiente'])
+
+
+class VueloUnicoTests(SimpleTestCase):
+
+    def test_peticiones_simultaneas_comparten_un_calculo(self):
+        vuelo = VueloUnico()
+        salida = threading.Barrier(8)
+        llamadas = []
+        resultados = []
+
+        def calcular():
+            llamadas.append(1)
+            time.sleep(0.3)  # el cálculo dura más que lo que tardan en llegar los demás
+            return {'pisos': []}
+
+        def peticion():
+            salida.wait(5)
+            resultados.append(vuelo.ejecutar('k', calcular))
+
+        hilos = [threading.Thread(target=peticion) for _ in range(8)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join(5)
+
+        self.assertEqual(len(llamadas), 1)
+        self.assertEqual(len(resultados), 8)
+        self.assertTrue(all(r is resultados[0] for r in resultados))
+        metricas = vuelo.metricas()
+        self.assertEqual((metricas['calculados'], metricas['compartidos']), (1, 7))
+
+    def test_la_excepcion_del_lider_llega_a_todos_y_no_queda_en_vuelo(self):
+        vuelo = VueloUnico()
+        with self.assertRaises(ValueError):
+            vuelo.ejecutar('k', lambda: int('x'))
+        self.assertEqual(vuelo.metricas()['en_vuelo'], 0)
+        self.assertEqual(vuelo.ejecutar('k', lambda: 1), 1)
+
+
+class SerializadorPisosTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def _poblar(self, espacios):
+        for espacio in espacios[::2]:
+            registro = self.ingresar(espacio, f'PLA{espacio.pk:03d}')
+            SolicitudSalida.encolar(Pago.objects.create(
+                pagMonto=1000, pagMetodo='EFECTIVO', pagEstado='PENDIENTE', fkIdParqueo=registro,
+            ))
+
+    def test_payload_guardia_sin_n_mas_1(self):
+        self._poblar(self.crear_parqueadero(pisos=1, espacios_por_piso=4))
+        # 2 colas de solicitudes (la de salida ya materializada) + 2 KPIs + 3 del mapa de pisos
+        with self.assertNumQueries(7):
+            _payload_dashboard_guardia(timezone.now())
+
+        self._poblar(self.crear_parqueadero(pisos=3, espacios_por_piso=10))
+        with self.assertNumQueries(7):
+            _payload_dashboard_guardia(timezone.now())
+
+    def test_admin_y_guardia_comparten_el_mapa(self):
+        espacios = self.crear_parqueadero(pisos=2, espacios_por_piso=3)
+        self._poblar(espacios)
+        inicio = timezone.localtime(timezone.now() + timedelta(hours=1))
+        Reserva.objects.create(
+            resFechaReserva=inicio.date(), resHoraInicio=inicio.time().replace(second=0, microsecond=0),
+            fkIdEspacio=espacios[1], fkIdVehiculo=Vehiculo.objects.create(vehPlaca='RES111'),
+        )
+        now = timezone.now()
+        admin = _payload_dashboard_admin(now)['pisos']
+        guardia = _payload_dashboard_guardia(now)['pisos']
+
+        # El guardia solo agrega su campo opcional; el resto es idéntico
+        for piso in guardia:
+            for espacio in piso['espacios']:
+                hora = espacio.pop('reserva_hora')
+                self.assertEqual(hora is None, espacio['reserva_pk'] is None)
+        self.assertEqual(admin, guardia)
+
+    def test_vistas_html_usan_el_snapshot(self):
+        self.crear_parqueadero(pisos=1, espacios_por_piso=2)
+        self.iniciar_sesion('VIGILANTE')
+        response = self.client.get(reverse('guardia_dashboard'))
+        self.assertEqual(response.status_code, 200)
+        snapshot = obtener_snapshot('guardia', None)  # ya está en caché: no se construye
+        self.assertEqual(response.context['dashboard_version'], snapshot['version'])
+        self.assertEqual(response.context['pisos'], snapshot['pisos'])
+
+        # En el admin el mapa es un panel aparte que sale del snapshot
+        self.iniciar_sesion('ADMIN')
+        data = self.client.get(reverse('admin_dashboard_mapa')).json()
+        snapshot = obtener_snapshot('admin', None)
+        self.assertEqual(data['version'], snapshot['version'])
+        for espacio in snapshot['pisos'][0]['espacios']:
+            self.assertIn(f'data-espacio-id="{espacio["pk"]}"', data['html'])
+
+
+class FormatoCompactoTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.espacios = self.crear_parqueadero(pisos=2, espacios_por_piso=3)
+
+    def test_columnas_y_estructura_por_layout(self):
+        self.ingresar(self.espacios[1], 'AAA111')
+        data = obtener_delta_compacto('guardia', _payload_dashboard_guardia)
+        estructura = data['estructura']
+        self.assertEqual(estructura['layout'], data['layout'])
+        self.assertEqual(estructura['estados'], ESTADOS_COMPACTOS)
+
+        piso = data['pisos'][0]
+        self.assertNotIn('espacios', piso)
+        self.assertEqual(piso['esp'], [e.pk for e in self.espacios[:3]])
+        self.assertEqual([estructura['estados'][c] for c in piso['est']], ['DISPONIBLE', 'OCUPADO', 'DISPONIBLE'])
+        self.assertEqual(piso['placa'], [None, 'AAA111', None])
+        self.assertEqual(piso['pago'], [0, 0, 0])
+        self.assertEqual(len(piso['reserva_hora']), 3)
+        self.assertEqual(estructura['pisos'][piso['pk']]['espacios'][self.espacios[0].pk], 'P1-01')
+
+        # Con el layout ya conocido no se reenvía la estructura
+        data = obtener_delta_compacto('guardia', _payload_dashboard_guardia, layout=data['layout'])
+        self.assertNotIn('estructura', data)
+
+    def test_endpoint_compacto_y_gzip(self):
+        self.iniciar_sesion('VIGILANTE')
+        url = reverse('guardia_data')
+        compacto = self.client.get(url + '?formato=compacto', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compacto['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compacto['Vary'])
+
+        completo = self.client.get(url)
+        datos = json.loads(gzip.decompress(compacto.content))
+        self.assertEqual(datos['formato'], 'compacto')
+        self.assertEqual(datos['version'], completo.json()['version'])
+        self.assertLess(len(json.dumps(datos['pisos'])), len(json.dumps(completo.json()['pisos'])))
+
+
+class ContadorEspaciosTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.espacios = self.crear_parqueadero(pisos=2, espacios_por_piso=3)
+
+    def assertContadoresAlDia(self):
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+    def test_transiciones_y_crud_mantienen_los_contadores(self):
+        self.assertEqual(ContadorEspacios.totales()['DISPONIBLE'], 6)
+        espacio = self.espacios[0]
+        espacio.reservar()
+        espacio.ocupar()
+        self.espacios[1].ocupar()
+        self.espacios[1].liberar()
+        self.assertEqual(ContadorEspacios.totales(), {'DISPONIBLE': 5, 'OCUPADO': 1, 'RESERVADO': 0, 'INACTIVO': 0})
+        self.assertContadoresAlDia()
+
+        self.iniciar_sesion('ADMIN')
+        otro_piso = self.espacios[3].fkIdPiso_id
+        self.client.post(reverse('admin_espacios_editar', args=[self.espacios[2].pk]), {
+            'espNumero': 'P1-03', 'fkIdPiso': otro_piso, 'fkIdTipoEspacio': self.tipo_carro.pk, 'espEstado': 'INACTIVO',
+        })
+        self.client.post(reverse('admin_espacios_eliminar', args=[self.espacios[5].pk]))
+        self.client.post(reverse('admin_espacios_crear'), {
+            'espNumero': 'P1-09', 'fkIdPiso': espacio.fkIdPiso_id, 'fkIdTipoEspacio': self.tipo_carro.pk,
+            'espEstado': 'DISPONIBLE',
+        })
+        self.assertEqual(ContadorEspacios.totales(fkIdPiso_id=otro_piso)['INACTIVO'], 1)
+        self.assertContadoresAlDia()
+
+        espacio.fkIdPiso.delete()  # CASCADE borra también sus contadores
+        self.assertContadoresAlDia()
+
+    def test_cancelar_vencidas_actualiza_los_contadores(self):
+        inicio = timezone.localtime(timezone.now() + timedelta(minutes=5))
+        for espacio in self.espacios[:2]:
+            Reserva.objects.create(
+                resFechaReserva=inicio.date(), resHoraInicio=inicio.time(), fkIdEspacio=espacio,
+                fkIdVehiculo=Vehiculo.objects.create(vehPlaca=f'RES{espacio.pk:03d}'),
+            )
+            espacio.reservar()
+        self.assertEqual(ContadorEspacios.totales()['RESERVADO'], 2)
+
+        Reserva.cancelar_vencidas()
+        self.assertEqual(ContadorEspacios.totales()['RESERVADO'], 0)
+        self.assertContadoresAlDia()
+
+    def test_instancia_desactualizada_no_desfasa_los_contadores(self):
+        vieja = Espacio.objects.get(pk=self.espacios[0].pk)
+        Espacio.objects.get(pk=vieja.pk).reservar()  # otra petición lo cambia después
+        vieja.ocupar()  # se descuenta de RESERVADO (BD), no de DISPONIBLE (memoria)
+        self.assertEqual(ContadorEspacios.totales(), {'DISPONIBLE': 5, 'OCUPADO': 1, 'RESERVADO': 0, 'INACTIVO': 0})
+        self.assertContadoresAlDia()
+
+        vieja = Espacio.objects.get(pk=self.espacios[1].pk)
+        Espacio.objects.get(pk=vieja.pk).ocupar()
+        vieja.delete()
+        self.assertContadoresAlDia()
+
+    def test_reservas_no_sueltan_un_espacio_ocupado_mientras_tanto(self):
+        espacio = self.espacios[0]
+        inicio = timezone.localtime(timezone.now() + timedelta(hours=3))
+        reserva = Reserva.objects.create(
+            resFechaReserva=inicio.date(), resHoraInicio=inicio.time(), fkIdEspacio=espacio,
+            fkIdVehiculo=Vehiculo.objects.create(vehPlaca='RES001'),
+        )
+        espacio.reservar()
+        reserva = Reserva.objects.select_related('fkIdEspacio').get(pk=reserva.pk)
+        Espacio.objects.get(pk=espacio.pk).ocupar()  # una entrada lo toma
+        reserva.cerrar('CANCELADA')
+        espacio.refresh_from_db()
+        self.assertEqual(espacio.espEstado, 'OCUPADO')
+        self.assertContadoresAlDia()
+
+    def test_editar_reserva_del_cliente_mueve_el_bloqueo(self):
+        cliente = Usuario.objects.create(
+            usuDocumento='123', usuNombre='Ana', usuApellido='Ruiz', usuCorreo='ana@example.com', usuClaveHash='x',
+        )
+        vehiculo = Vehiculo.objects.create(vehPlaca='CLI001', fkIdUsuario=cliente)
+        inicio = timezone.localtime(timezone.now() + timedelta(days=1))
+        anterior, nuevo = self.espacios[0], self.espacios[1]
+        reserva = Reserva.objects.create(
+            resFechaReserva=inicio.date(), resHoraInicio=inicio.time().replace(second=0, microsecond=0),
+            fkIdEspacio=anterior, fkIdVehiculo=vehiculo,
+        )
+        anterior.reservar()
+        session = self.client.session
+        session['usuario_id'] = cliente.pk
+        session.save()
+        self.client.post(reverse('cliente_editar_reserva', args=[reserva.pk]), {
+            'vehiculo_id': vehiculo.pk, 'espacio_id': nuevo.pk,
+            'fecha_inicio': inicio.date().isoformat(), 'hora_inicio': inicio.strftime('%H:%M'),
+        })
+        reserva.refresh_from_db()
+        self.assertEqual(reserva.fkIdEspacio_id, nuevo.pk)
+        self.assertEqual(
+            dict(Espacio.objects.filter(pk__in=[anterior.pk, nuevo.pk]).values_list('pk', 'espEstado')),
+            {anterior.pk: 'DISPONIBLE', nuevo.pk: 'RESERVADO'},
+        )
+        self.assertContadoresAlDia()
+
+    def test_kpis_sin_contar_espacios_y_comando_de_reconstruccion(self):
+        self.espacios[0].ocupar()
+        Espacio.objects.filter(pk=self.espacios[1].pk).update(espEstado='INACTIVO')  # se salta el contador
+        self.assertEqual(len(ContadorEspacios.diferencias()), 2)
+        with self.assertRaises(CommandError):
+            call_command('reconstruir_contadores', '--verificar', stdout=StringIO())
+
+        call_command('reconstruir_contadores', stdout=StringIO())
+        self.assertContadoresAlDia()
+        with self.assertNumQueries(1):
+            totales = ContadorEspacios.totales()
+        self.assertEqual(totales, {'DISPONIBLE': 4, 'OCUPADO': 1, 'RESERVADO': 0, 'INACTIVO': 1})
+        payload = _payload_dashboard_admin(timezone.now())
+        self.assertEqual((payload['total_espacios'], payload['ocupados'], payload['disponibles']), (6, 1, 4))
+
+
+class GraficasZonaHorariaTests(ParqueaderoTestMixin, TestCase):
+    """Los agregados agrupan por hora/día de America/Bogota (UTC-5), no por UTC."""
+
+    def setUp(self):
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=1)
+
+    def _local(self, dia, hora, minuto=0):
+        return timezone.make_aware(datetime.combine(dia, datetime.min.time()).replace(hour=hora, minute=minuto))
+
+    def test_conteo_por_hora_local(self):
+        dia = date(2026, 3, 10)
+        for i, (hora, minuto) in enumerate([(6, 5), (6, 50), (19, 30), (22, 59), (23, 10)]):
+            registro = self.ingresar(self.espacios[0], f'HOR{i:03d}')
+            entrada = self._local(dia, hora, minuto)
+            # Cerrado: un espacio no admite dos turnos abiertos
+            InventarioParqueo.objects.filter(pk=registro.pk).update(
+                parHoraEntrada=entrada, parHoraSalida=entrada + timedelta(minutes=30),
+            )
+
+        conteo = conteo_por_hora(InventarioParqueo.objects.all(), 'parHoraEntrada', range(6, 23))
+        self.assertEqual(conteo[6], 2)
+        self.assertEqual(conteo[19], 1)  # 00:30 UTC del día siguiente
+        self.assertEqual(conteo[22], 1)
+        self.assertEqual(sum(conteo.values()), 4)  # las 23h quedan fuera del rango pedido
+
+    def test_suma_por_dia_local(self):
+        registro = self.ingresar(self.espacios[0], 'DIA001')
+        dias = [date(2026, 3, 10), date(2026, 3, 11)]
+        for monto, momento in ((1000, self._local(dias[0], 21)), (500, self._local(dias[1], 8)), (250, self._local(dias[1], 23, 30))):
+            pago = Pago.objects.create(pagMonto=monto, pagMetodo='PSE', pagEstado='PAGADO', fkIdParqueo=registro)
+            Pago.objects.filter(pk=pago.pk).update(pagFechaPago=momento)
+
+        with self.assertNumQueries(1):
+            sumas = suma_por_dia(Pago.objects.all(), 'pagFechaPago', 'pagMonto', dias)
+        self.assertEqual(sumas, {dias[0]: 1000.0, dias[1]: 750.0})
+
+
+class PanelesDashboardAdminTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.espacios = self.crear_parqueadero(pisos=2, espacios_por_piso=3)
+        self.iniciar_sesion('ADMIN')
+
+    def test_shell_solo_calcula_los_kpis(self):
+        self.ingresar(self.espacios[0], 'AAA111')
+        with self.assertNumQueries(3):  # sesión + contadores + reservas activas
+            response = self.client.get(reverse('admin_dashboard'))
+        self.assertEqual(response.context['ocupados'], 1)
+        self.assertEqual(response.context['total_espacios'], 6)
+        self.assertNotIn('pisos', response.context)
+        self.assertContains(response, 'id="panel-mapa"')
+
+    def test_paneles_se_cachean_por_separado(self):
+        registro = self.ingresar(self.espacios[0], 'AAA111')
+        Pago.objects.create(pagMonto=2500, pagMetodo='PSE', pagEstado='PAGADO', fkIdParqueo=registro)
+
+        graficas = self.client.get(reverse('admin_dashboard_graficas')).json()
+        self.assertEqual(len(graficas['ocupacion_labels']), 17)
+        self.assertEqual(graficas['ingresos_data'][-1], 2500.0)
+        self.assertIn('No hay reservas recientes', self.client.get(reverse('admin_dashboard_reservas')).json()['html'])
+
+        # Con la versión sin cambios, cada panel sale de su caché: sesión + versión
+        # (el mapa lee la versión también para su ETag)
+        for url, queries in (('admin_dashboard_graficas', 2), ('admin_dashboard_reservas', 2), ('admin_dashboard_mapa', 3)):
+            self.client.get(reverse(url))
+            with self.assertNumQueries(queries):
+                self.assertEqual(self.client.get(reverse(url)).status_code, 200)
+
+
+class FragmentoMapaTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=3)
+
+    def test_mapa_se_cachea_por_rol_y_revision(self):
+        casos = (('VIGILANTE', 'guardia_dashboard', 'guardia'), ('ADMIN', 'admin_dashboard_mapa', 'admin'))
+        for espacio, (rol, url, nombre) in zip(self.espacios, casos):
+            self.iniciar_sesion(rol)
+            self.assertEqual(self.client.get(reverse(url)).status_code, 200)
+            revision = obtener_snapshot(nombre, None)['version']
+            clave = make_template_fragment_key('mapa_pisos', [nombre, revision])
+            self.assertIsNotNone(cache.get(clave))
+
+            # Una recarga sin cambios reutiliza el HTML cacheado tal cual
+            cache.set(clave, '<div id="marca-cache"></div>')
+            self.assertContains(self.client.get(reverse(url)), 'marca-cache')
+
+            # Un cambio de estado genera otra revisión y otro fragmento
+            with self.captureOnCommitCallbacks(execute=True):
+                espacio.ocupar()
+            self.assertNotContains(self.client.get(reverse(url)), 'marca-cache')
+
+
+class SolicitudSalidaTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=3)
+        self.iniciar_sesion('VIGILANTE')
+
+    def _solicitar(self, espacio, placa, monto=4500):
+        registro = self.ingresar(espacio, placa)
+        pago = Pago.objects.create(pagMonto=monto, pagMetodo='EFECTIVO', pagEstado='PENDIENTE', fkIdParqueo=registro)
+        SolicitudSalida.encolar(pago)
+        return registro
+
+    def test_la_cola_se_lee_en_una_consulta(self):
+        registro = self._solicitar(self.espacios[0], 'ABC123')
+        self._solicitar(self.espacios[1], 'DEF456')
+        with self.assertNumQueries(1):
+            cola = list(SolicitudSalida.objects.order_by('-solHoraEntrada'))
+        sol = next(s for s in cola if s.fkIdParqueo_id == registro.pk)
+        self.assertEqual((sol.solPlaca, sol.solPiso, sol.solEspacio), ('ABC123', 'Piso 1', 'P1-01'))
+        self.assertEqual(sol.costo_display, '$4,500')
+
+    def test_confirmar_pago_retira_la_solicitud(self):
+        registro = self._solicitar(self.espacios[0], 'ABC123')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('guardia_confirmar_pago'), {'registro_id': registro.pk})
+        self.assertFalse(SolicitudSalida.objects.filter(fkIdParqueo=registro).exists())
+        self.assertEqual(Pago.objects.get(fkIdParqueo=registro).pagEstado, 'PAGADO')
+
+    def test_registrar_salida_retira_la_solicitud(self):
+        registro = self._solicitar(self.espacios[0], 'ABC123')
+        self._solicitar(self.espacios[1], 'DEF456')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('guardia_registrar_salida'), {'registro_id': registro.pk})
+        self.assertEqual(
+            list(SolicitudSalida.objects.values_list('solPlaca', flat=True)), ['DEF456'],
+        )
+        self.assertContains(self.client.get(reverse('guardia_dashboard')), 'DEF456')
+
+
+class RangoReservaTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=3)
+
+    def reservar(self, espacio, inicio, **extra):
+        inicio = timezone.localtime(inicio)
+        return Reserva.objects.create(
+            resFechaReserva=inicio.date(), resHoraInicio=inicio.time().replace(microsecond=0),
+            fkIdEspacio=espacio, fkIdVehiculo=Vehiculo.objects.create(vehPlaca=f'RES{espacio.pk:03d}'), **extra,
+        )
+
+    def test_inicio_y_fin_se_calculan_al_guardar(self):
+        # Fecha y hora llegan como strings del formulario; el fin antes del inicio cruza la medianoche
+        reserva = Reserva.objects.create(
+            resFechaReserva='2026-03-10', resHoraInicio='22:00', resHoraFin='02:00',
+            fkIdEspacio=self.espacios[0], fkIdVehiculo=Vehiculo.objects.create(vehPlaca='NOC123'),
+        )
+        reserva.refresh_from_db()
+        self.assertEqual(timezone.localtime(reserva.resInicio).replace(tzinfo=None), datetime(2026, 3, 10, 22, 0))
+        self.assertEqual(timezone.localtime(reserva.resFin).replace(tzinfo=None), datetime(2026, 3, 11, 2, 0))
+
+        reserva.resHoraInicio = datetime(2026, 1, 1, 20, 30).time()
+        reserva.save(update_fields=['resHoraInicio'])
+        reserva.refresh_from_db()
+        self.assertEqual(timezone.localtime(reserva.resInicio).hour, 20)
+
+    def test_ventanas_de_tiempo_se_filtran_en_la_bd(self):
+        now = timezone.now()
+        proxima = self.reservar(self.espacios[0], now + timedelta(minutes=10))
+        lejana = self.reservar(self.espacios[1], now + timedelta(hours=3))
+
+        self.assertEqual(
+            list(Reserva.objects.filter(resEstado='PENDIENTE', resInicio__range=(now, now + timedelta(hours=2)))),
+            [proxima],
+        )
+        Reserva.cancelar_vencidas()
+        proxima.refresh_from_db()
+        lejana.refresh_from_db()
+        self.assertEqual((proxima.resEstado, lejana.resEstado), ('CANCELADA', 'PENDIENTE'))
+
+    def test_entrada_cancela_las_reservas_pasadas_de_15_minutos(self):
+        usuario = Usuario.objects.create(
+            usuDocumento='123', usuNombre='Ana', usuApellido='Ruiz', usuCorreo='ana@example.com', usuClaveHash='x',
+        )
+        now = timezone.now()
+        vencida = self.reservar(self.espacios[0], now - timedelta(minutes=20), resEstado='CONFIRMADA')
+        en_gracia = self.reservar(self.espacios[1], now - timedelta(minutes=5), resEstado='CONFIRMADA')
+        self.espacios[0].reservar()
+        self.espacios[1].reservar()
+        session = self.client.session
+        session['usuario_id'] = usuario.pk
+        session.save()
+
+        self.assertEqual(self.client.get(reverse('entrada_parqueadero')).status_code, 200)
+        vencida.refresh_from_db()
+        en_gracia.refresh_from_db()
+        self.assertEqual((vencida.resEstado, en_gracia.resEstado), ('CANCELADA', 'CONFIRMADA'))
+        # El espacio de la cancelada vuelve a estar libre, con contadores al día
+        self.assertEqual(
+            list(Espacio.objects.filter(pk__in=[self.espacios[0].pk, self.espacios[1].pk])
+                 .order_by('pk').values_list('espEstado', flat=True)),
+            ['DISPONIBLE', 'RESERVADO'],
+        )
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+
+class ReclamoEspacioTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        pool_espacios.invalidar()
+
+    def test_reclama_en_orden_de_piso_y_numero_hasta_agotar(self):
+        espacios = self.crear_parqueadero(pisos=2, espacios_por_piso=2)
+        espacios[0].reservar()
+        reclamados = [Espacio.reclamar_disponible(self.tipo_carro.pk) for _ in range(4)]
+        self.assertEqual(reclamados, [espacios[1], espacios[2], espacios[3], None])
+        self.assertEqual(
+            set(Espacio.objects.filter(espEstado='OCUPADO').values_list('pk', flat=True)),
+            {e.pk for e in espacios[1:]},
+        )
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+    def test_ambos_caminos_dejan_el_mismo_estado(self):
+        espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=2)
+        for espacio, skip_locked in zip(espacios, (True, False)):
+            with self.subTest(skip_locked=skip_locked):
+                self.ingresar(espacio, f'SKP{espacio.pk:03d}')
+                version = VersionParqueadero.actual()
+                with mock.patch.object(connection.features, 'has_select_for_update_skip_locked', skip_locked), \
+                        self.captureOnCommitCallbacks(execute=True):
+                    reclamado = Espacio.reclamar(espacio.pk, desde=('OCUPADO',), hacia='DISPONIBLE')
+                self.assertEqual((reclamado.espEstado, reclamado.fkIdParqueoActual), ('DISPONIBLE', None))
+                self.assertEqual(
+                    Espacio.objects.filter(pk=espacio.pk).values_list('espEstado', 'fkIdParqueoActual').get(),
+                    ('DISPONIBLE', None),
+                )
+                self.assertEqual(VersionParqueadero.actual(), version + 1)
+                self.assertEqual(ContadorEspacios.diferencias(), {})
+
+    def test_entrada_por_qr_ocupa_el_espacio_reclamado(self):
+        espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=2)
+        usuario = Usuario.objects.create(
+            usuDocumento='123', usuNombre='Ana', usuApellido='Ruiz', usuCorreo='ana@example.com', usuClaveHash='x',
+        )
+        vehiculo = Vehiculo.objects.create(vehPlaca='QRE123', fkIdUsuario=usuario)
+        session = self.client.session
+        session['usuario_id'] = usuario.pk
+        session.save()
+
+        respuesta = self.client.post(reverse('entrada_parqueadero'), {'vehiculo_id': vehiculo.pk})
+        self.assertContains(respuesta, espacios[0].espNumero)
+        registro = InventarioParqueo.objects.get(fkIdVehiculo=vehiculo)
+        self.assertEqual(registro.fkIdEspacio, espacios[0])
+        espacios[0].refresh_from_db()
+        self.assertEqual(espacios[0].espEstado, 'OCUPADO')
+
+
+# SQLite (la BD de pruebas en memoria) rechaza escrituras concurrentes en vez de
+# esperarlas: la prueba de estrés corre contra MySQL/PostgreSQL.
+@skipUnlessDBFeature('has_select_for_update_skip_locked')
+class ReclamoConcurrenteTests(ParqueaderoTestMixin, TransactionTestCase):
+
+    def setUp(self):
+        pool_espacios.invalidar()
+
+    def test_entradas_simultaneas_no_comparten_espacio(self):
+        self.crear_parqueadero(pisos=3, espacios_por_piso=10)
+        hilos_total = 60  # el doble de entradas que espacios
+        salida = threading.Barrier(hilos_total)
+        reclamados, errores = [], []
+
+        def entrada():
+            try:
+                salida.wait(10)
+                espacio = Espacio.reclamar_disponible(self.tipo_carro.pk)
+                reclamados.append(espacio.pk if espacio else None)
+            except Exception as exc:  # se reporta abajo con el resto de los resultados
+                errores.append(exc)
+            finally:
+                connection.close()
+
+        hilos = [threading.Thread(target=entrada) for _ in range(hilos_total)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join(30)
+
+        self.assertEqual(errores, [])
+        asignados = [pk for pk in reclamados if pk is not None]
+        self.assertEqual(len(asignados), 30)
+        self.assertEqual(len(set(asignados)), 30)  # ningún espacio entregado dos veces
+        self.assertEqual(reclamados.count(None), 30)
+        self.assertEqual(Espacio.objects.filter(espEstado='DISPONIBLE').count(), 0)
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+
+class PoolEspaciosTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        self.espacios = self.crear_parqueadero(pisos=2, espacios_por_piso=3)
+        self.pool = PoolEspacios()
+
+    def test_regla_de_prioridad_configurable(self):
+        piso_2 = self.espacios[3].fkIdPiso_id
+        pool = PoolEspacios(prioridad=prioridad_pisos_preferidos(piso_2))
+        reclamados = [pool.reclamar(self.tipo_carro.pk) for _ in range(4)]
+        self.assertEqual(reclamados, self.espacios[3:] + self.espacios[:1])
+
+    def test_sigue_las_transiciones_sin_releer_la_tabla(self):
+        # Las transiciones avisan al pool global del proceso al confirmar
+        pool_espacios.invalidar()
+        tipo = self.tipo_carro.pk
+        with self.captureOnCommitCallbacks(execute=True):
+            primero = pool_espacios.reclamar(tipo)
+        self.assertEqual(primero, self.espacios[0])
+        antes = pool_espacios.metricas()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.espacios[1].reservar()
+            primero.liberar()
+        self.assertEqual(pool_espacios.metricas()['libres'][tipo], 5)
+
+        # El liberado vuelve al heap y el reservado sale, sin volver a cargar
+        self.assertEqual(
+            [pool_espacios.reclamar(tipo) for _ in range(3)],
+            [self.espacios[0], self.espacios[2], self.espacios[3]],
+        )
+        despues = pool_espacios.metricas()
+        self.assertEqual(
+            (despues['recargas'], despues['descartados']), (antes['recargas'], antes['descartados']),
+        )
+
+    def test_candidato_desactualizado_se_verifica_contra_la_bd(self):
+        self.pool.cargar(self.tipo_carro.pk)
+        # Otro worker ocupó los dos primeros sin que este pool se enterara
+        Espacio.objects.filter(pk__in=[e.pk for e in self.espacios[:2]]).update(espEstado='OCUPADO')
+        self.assertEqual(self.pool.reclamar(self.tipo_carro.pk), self.espacios[2])
+        self.assertEqual(self.pool.metricas()['descartados'], 2)
+
+    def test_pool_vacio_relee_la_bd_una_vez_antes_de_rendirse(self):
+        self.pool.cargar(self.tipo_carro.pk)
+        for _ in self.espacios:
+            self.assertIsNotNone(self.pool.reclamar(self.tipo_carro.pk))
+        # Liberado en otro proceso: no llegó al pool pero la recarga lo encuentra
+        Espacio.objects.filter(pk=self.espacios[5].pk).update(espEstado='DISPONIBLE')
+        self.assertEqual(self.pool.reclamar(self.tipo_carro.pk), self.espacios[5])
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.pool.reclamar(self.tipo_carro.pk))
+
+
+class SalidaServicioTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=3)
+        Tarifa.objects.create(
+            nombre='Carro', fkIdTipoEspacio=self.tipo_carro, precioHora=3000, precioDia=20000,
+            precioMensual=300000, fechaInicio=date(2026, 1, 1),
+        )
+        self.usuario = Usuario.objects.create(
+            usuDocumento='123', usuNombre='Ana', usuApellido='Ruiz', usuCorreo='ana@example.com', usuClaveHash='x',
+        )
+
+    def estacionar(self, espacio, placa, horas=2, usuario=None):
+        vehiculo, _ = Vehiculo.objects.get_or_create(vehPlaca=placa, defaults={'fkIdUsuario': usuario})
+        registro = InventarioParqueo.objects.create(fkIdVehiculo=vehiculo, fkIdEspacio=espacio)
+        InventarioParqueo.objects.filter(pk=registro.pk).update(
+            parHoraEntrada=timezone.now() - timedelta(hours=horas),
+        )
+        Espacio.objects.get(pk=espacio.pk).ocupar(registro)  # como las vistas: instancia recién leída
+        return InventarioParqueo.objects.select_related('fkIdVehiculo', 'fkIdEspacio').get(pk=registro.pk)
+
+    def test_costo_fijo_en_queries(self):
+        # Historial previo del mismo vehículo: no debe cambiar el costo de la salida
+        for _ in range(3):
+            anterior = self.estacionar(self.espacios[1], 'ABC123', usuario=self.usuario)
+            registrar_salida(anterior)
+        registro = self.estacionar(self.espacios[0], 'ABC123', usuario=self.usuario)
+        SolicitudSalida.encolar(Pago.objects.create(
+            pagMonto=6000, pagMetodo='EFECTIVO', pagEstado='PENDIENTE', fkIdParqueo=registro,
+        ))
+
+        # cierre + cola + pago pendiente (2) + sticker + espacio (2) + contadores (2) = 9 sentencias,
+        # más el par SAVEPOINT/RELEASE del atomic del servicio (Espacio.save no abre otro)
+        with self.assertNumQueries(11):
+            resultado = registrar_salida(registro)
+
+        self.assertEqual((resultado.monto, resultado.sticker), (6000, True))
+        self.assertEqual(Pago.objects.get(fkIdParqueo=registro).pagEstado, 'PAGADO')
+        self.assertFalse(SolicitudSalida.objects.filter(fkIdParqueo=registro).exists())
+        self.assertEqual(Espacio.objects.get(pk=self.espacios[0].pk).espEstado, 'DISPONIBLE')
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+    def test_sin_pago_previo_cobra_con_la_tarifa_activa(self):
+        registro = self.estacionar(self.espacios[0], 'VIS123', horas=1.5)
+        resultado = registrar_salida(registro)
+        self.assertEqual(resultado.monto, 4500)
+        self.assertEqual(resultado.pago.pagEstado, 'PAGADO')
+        self.assertFalse(resultado.sticker)  # visitante
+        self.assertEqual(Sticker.objects.count(), 0)
+
+    def test_la_misma_salida_se_cierra_una_sola_vez(self):
+        registro = self.estacionar(self.espacios[0], 'ABC123', usuario=self.usuario)
+        duplicado = InventarioParqueo.objects.select_related('fkIdVehiculo', 'fkIdEspacio').get(pk=registro.pk)
+        self.assertIsNotNone(registrar_salida(registro))
+        self.assertIsNone(registrar_salida(duplicado))
+        self.assertEqual(Pago.objects.filter(fkIdParqueo=registro).count(), 1)
+        self.assertEqual(Sticker.objects.filter(fkIdParqueo=registro).count(), 1)
+
+    def test_las_tres_salidas_usan_el_servicio(self):
+        registro = self.estacionar(self.espacios[0], 'ABC123', usuario=self.usuario)
+        session = self.client.session
+        session['usuario_id'] = self.usuario.pk
+        session.save()
+        respuesta = self.client.post(reverse('cliente_salida'), {'metodo_pago': 'PSE'})
+        self.assertEqual(respuesta.status_code, 200)
+        registro.refresh_from_db()
+        self.assertIsNotNone(registro.parHoraSalida)
+        self.assertEqual(list(Pago.objects.filter(fkIdParqueo=registro).values_list('pagMetodo', 'pagEstado')),
+                         [('PSE', 'PAGADO')])
+        self.assertTrue(Sticker.objects.filter(fkIdParqueo=registro).exists())
+
+        for rol, url in (('ADMIN', 'admin_registrar_salida'), ('VIGILANTE', 'guardia_registrar_salida')):
+            espacio = self.espacios[1]
+            registro = self.estacionar(espacio, f'{rol[:3]}123')
+            self.iniciar_sesion(rol)
+            self.client.post(reverse(url), {'espacio_id': espacio.pk})
+            registro.refresh_from_db()
+            self.assertIsNotNone(registro.parHoraSalida)
+            self.assertEqual(Pago.objects.get(fkIdParqueo=registro).pagEstado, 'PAGADO')
+            # Repetir la salida no vuelve a cobrar
+            self.client.post(reverse(url), {'espacio_id': espacio.pk})
+            self.assertEqual(Pago.objects.filter(fkIdParqueo=registro).count(), 1)
+
+
+class IngresoServicioTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        pool_espacios.invalidar()
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=3)
+
+    def test_presupuesto_de_queries_con_espacio_elegido(self):
+        vehiculo = Vehiculo.objects.create(vehPlaca='ABC123')
+        self.espacios[0].ocupar()  # régimen normal: la fila OCUPADO de contadores ya existe
+        # reclamo (2) + contadores (2) + INSERT + puntero del espacio = 6 sentencias, más el
+        # par SAVEPOINT/RELEASE del atomic del servicio (el reclamo no abre otro). "¿Ya está
+        # adentro?" no es una query: lo decide la restricción única al insertar.
+        with self.assertNumQueries(8):
+            registro = registrar_ingreso(vehiculo, espacio_id=self.espacios[1].pk)
+        self.assertEqual(registro.fkIdEspacio.espEstado, 'OCUPADO')
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+    def test_rechaza_doble_ingreso_y_espacio_tomado(self):
+        vehiculo = vehiculo_para_ingreso('ABC123', 'Ana', '300')
+        registrar_ingreso(vehiculo, espacio_id=self.espacios[0].pk)
+        with self.assertRaisesMessage(IngresoRechazado, 'ya tiene un ingreso activo'):
+            registrar_ingreso(vehiculo, espacio_id=self.espacios[1].pk)
+        with self.assertRaisesMessage(IngresoRechazado, 'no está disponible'):
+            registrar_ingreso(Vehiculo.objects.create(vehPlaca='DEF456'), espacio_id=self.espacios[0].pk)
+        with self.assertRaisesMessage(IngresoRechazado, 'solo acepta letras'):
+            vehiculo_para_ingreso('AB C')
+        self.assertEqual(InventarioParqueo.objects.count(), 1)
+        self.assertEqual(Espacio.objects.get(pk=self.espacios[1].pk).espEstado, 'DISPONIBLE')
+
+    def test_la_bd_impide_dos_turnos_abiertos_por_vehiculo_o_espacio(self):
+        registro = self.ingresar(self.espacios[0], 'ABC123')
+        otro = Vehiculo.objects.create(vehPlaca='DEF456')
+        for vehiculo, espacio in ((registro.fkIdVehiculo, self.espacios[1]), (otro, self.espacios[0])):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                InventarioParqueo.objects.create(fkIdVehiculo=vehiculo, fkIdEspacio=espacio)
+
+        # Cerrado el turno, el vehículo y el espacio vuelven a quedar libres para otro
+        InventarioParqueo.objects.filter(pk=registro.pk).update(parHoraSalida=timezone.now())
+        InventarioParqueo.objects.create(fkIdVehiculo=registro.fkIdVehiculo, fkIdEspacio=self.espacios[0])
+        InventarioParqueo.objects.create(fkIdVehiculo=otro, fkIdEspacio=self.espacios[1])
+        self.assertEqual(InventarioParqueo.objects.filter(parHoraSalida__isnull=True).count(), 2)
+
+    def test_doble_ingreso_por_pool_devuelve_el_espacio(self):
+        vehiculo = Vehiculo.objects.create(vehPlaca='ABC123')
+        primero = registrar_ingreso(vehiculo).fkIdEspacio
+        with self.assertRaisesMessage(IngresoRechazado, 'ya tiene un ingreso activo'):
+            registrar_ingreso(vehiculo)
+        # El espacio que alcanzó a reclamar el rechazado sigue libre y es el próximo del pool
+        segundo = registrar_ingreso(Vehiculo.objects.create(vehPlaca='DEF456')).fkIdEspacio
+        self.assertEqual(segundo, self.espacios[1])
+        self.assertNotEqual(segundo, primero)
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+    def test_reserva_ocupa_su_espacio_y_se_completa_al_confirmar(self):
+        espacio = self.espacios[2]
+        inicio = timezone.localtime(timezone.now() + timedelta(minutes=30))
+        reserva = Reserva.objects.create(
+            resFechaReserva=inicio.date(), resHoraInicio=inicio.time(), resEstado='CONFIRMADA',
+            fkIdEspacio=espacio, fkIdVehiculo=Vehiculo.objects.create(vehPlaca='RES123'),
+        )
+        espacio.reservar()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            registro = registrar_ingreso(reserva.fkIdVehiculo, reserva=reserva)
+            # Dentro de la transacción la reserva sigue igual: se completa en on_commit
+            self.assertEqual(Reserva.objects.get(pk=reserva.pk).resEstado, 'CONFIRMADA')
+        self.assertEqual(registro.fkIdEspacio, espacio)
+        self.assertEqual(Reserva.objects.get(pk=reserva.pk).resEstado, 'COMPLETADA')
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+    def test_admin_y_guardia_usan_el_servicio(self):
+        Vehiculo.objects.create(vehPlaca='VIS123', nombre_contacto='Ana')
+        casos = (('ADMIN', 'admin_registrar_ingreso'), ('VIGILANTE', 'guardia_registrar_ingreso'))
+        for (rol, url), espacio, placa in zip(casos, self.espacios, ('vis123', 'NEW456')):
+            self.iniciar_sesion(rol)
+            self.client.post(reverse(url), {'placa': placa, 'espacio_id': espacio.pk, 'telefono': '3001234567'})
+            registro = InventarioParqueo.objects.select_related('fkIdVehiculo').get(fkIdEspacio=espacio)
+            self.assertEqual(registro.fkIdVehiculo.vehPlaca, placa.upper())
+            self.assertEqual(registro.fkIdVehiculo.telefono_contacto, '3001234567')
+        self.assertEqual(Vehiculo.objects.get(vehPlaca='VIS123').nombre_contacto, 'Ana')
+
+
+@override_settings(LPR_API_KEYS=['clave-rampa'])
+class CamaraEventosTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        pool_espacios.invalidar()
+        self.espacios = self.crear_parqueadero(pisos=2, espacios_por_piso=20)
+        Tarifa.objects.create(
+            nombre='Carro', fkIdTipoEspacio=self.tipo_carro, precioHora=3000, precioDia=20000,
+            precioMensual=300000, fechaInicio=date(2026, 1, 1),
+        )
+        self.t0 = timezone.now().replace(microsecond=0) - timedelta(days=1)
+
+    def enviar(self, eventos, clave='clave-rampa'):
+        # Las cámaras no tienen cookie CSRF: el endpoint debe funcionar con el chequeo activo
+        cliente = Client(enforce_csrf_checks=True)
+        return cliente.post(
+            reverse('camaras_eventos'), json.dumps({'eventos': eventos}),
+            content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {clave}',
+        )
+
+    def evento(self, placa, tipo, minutos, **extra):
+        hora = (self.t0 + timedelta(minutes=minutos)).isoformat()
+        return {'id': f'{placa}-{tipo}', 'placa': placa, 'tipo': tipo, 'hora': hora, 'porteria': 'rampa-norte', **extra}
+
+    def test_requiere_clave_valida(self):
+        self.assertEqual(self.enviar([self.evento('ABC123', 'ENTRADA', 0)], clave='otra').status_code, 401)
+        respuesta = self.client.post(reverse('camaras_eventos'), '{}', content_type='application/json')
+        self.assertEqual(respuesta.status_code, 401)
+        self.assertEqual(self.enviar([]).status_code, 400)
+        self.assertFalse(InventarioParqueo.objects.exists())
+
+    def test_lote_mixto_se_aplica_en_orden_cronologico(self):
+        eventos = [
+            self.evento('ABC123', 'SALIDA', 120),   # llega antes que su entrada (buffer de la cámara)
+            self.evento('abc123', 'ENTRADA', 0),
+            self.evento('DEF456', 'SALIDA', 30),    # sin ingreso activo
+            {'id': 'x', 'placa': 'GHI789', 'tipo': 'PASO', 'hora': self.t0.isoformat()},
+        ]
+        respuesta = self.enviar(eventos)
+        self.assertEqual(respuesta.status_code, 200)
+        datos = respuesta.json()
+        estados = [r['estado'] for r in datos['resultados']]
+        self.assertEqual(estados, ['OK', 'OK', 'RECHAZADO', 'INVALIDO'])
+        self.assertEqual(datos['aceptados'], 2)
+
+        registro = InventarioParqueo.objects.get(fkIdVehiculo__vehPlaca='ABC123')
+        self.assertEqual(registro.parHoraEntrada, self.t0)
+        self.assertEqual(registro.parHoraSalida, self.t0 + timedelta(hours=2))
+        self.assertEqual(Pago.objects.get(fkIdParqueo=registro).pagMonto, 6000)
+        self.assertEqual(datos['resultados'][0]['monto'], 6000)
+        self.assertEqual(registro.fkIdEspacio.espEstado, 'DISPONIBLE')
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+    def test_el_tipo_se_lee_una_vez_y_la_hora_va_en_el_insert(self):
+        eventos = [self.evento(f'LPR{i:04d}', 'ENTRADA', i) for i in range(20)]
+        with CaptureQueriesContext(connection) as queries:
+            datos = procesar_eventos_camara(eventos)
+        self.assertEqual({r['estado'] for r in datos}, {'OK'})
+        sql = [q['sql'] for q in queries]
+        self.assertEqual(len([q for q in sql if '"tipos_espacio"' in q]), 1)
+        self.assertFalse([q for q in sql if q.startswith('UPDATE "inventario_parqueo"')])
+        self.assertEqual(
+            InventarioParqueo.objects.get(fkIdVehiculo__vehPlaca='LPR0003').parHoraEntrada,
+            self.t0 + timedelta(minutes=3),
+        )
+
+    def test_reenvio_de_un_backlog(self):
+        # 200 carros de 30 min escalonados cada minuto: nunca hay más de 31 adentro.
+        # Más de un bloque de LOTE_EVENTOS_CAMARA, así que cruza varias transacciones.
+        eventos = []
+        for i in range(200):
+            eventos += [self.evento(f'LPR{i:04d}', 'ENTRADA', i), self.evento(f'LPR{i:04d}', 'SALIDA', i + 30)]
+        datos = procesar_eventos_camara(eventos)
+        self.assertEqual({r['estado'] for r in datos}, {'OK'})
+        self.assertEqual(Pago.objects.filter(pagEstado='PAGADO').count(), 200)
+        self.assertFalse(InventarioParqueo.objects.filter(parHoraSalida__isnull=True).exists())
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+        # Reenviar eventos ya aplicados no duplica turnos
+        repetidos = procesar_eventos_camara(eventos[:4])
+        self.assertEqual({r['estado'] for r in repetidos}, {'RECHAZADO'})
+        self.assertEqual(InventarioParqueo.objects.count(), 200)
+
+
+class IdempotenciaTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=3)
+        Tarifa.objects.create(
+            nombre='Carro', fkIdTipoEspacio=self.tipo_carro, precioHora=3000, precioDia=20000,
+            precioMensual=300000, fechaInicio=date(2026, 1, 1),
+        )
+        self.usuario = Usuario.objects.create(
+            usuDocumento='123', usuNombre='Ana', usuApellido='Ruiz', usuCorreo='ana@example.com', usuClaveHash='x',
+        )
+
+    def estacionar(self, espacio, placa, usuario=None):
+        vehiculo = Vehiculo.objects.create(vehPlaca=placa, fkIdUsuario=usuario)
+        registro = InventarioParqueo.objects.create(fkIdVehiculo=vehiculo, fkIdEspacio=espacio)
+        Espacio.objects.get(pk=espacio.pk).ocupar(registro)
+        return registro
+
+    def enviar(self, url, datos, **extra):
+        # Sigue el redirect como el navegador: los mensajes se leen del dashboard renderizado
+        respuesta = self.client.post(reverse(url), datos, follow=True, **extra)
+        return respuesta, [str(m) for m in respuesta.context['messages']]
+
+    def test_reenvio_de_salida_responde_lo_mismo_sin_tocar_tablas_de_operacion(self):
+        registro = self.estacionar(self.espacios[0], 'ABC123')
+        self.iniciar_sesion('VIGILANTE')
+        datos = {'registro_id': registro.pk, 'idempotency_key': 'k1'}
+        primera = self.client.post(reverse('guardia_registrar_salida'), datos)
+        self.client.get(primera['Location'])  # el dashboard consume el mensaje flash
+
+        with CaptureQueriesContext(connection) as queries:
+            segunda = self.client.post(reverse('guardia_registrar_salida'), datos)
+        self.assertEqual(segunda.status_code, 302)
+        self.assertEqual(segunda['Location'], primera['Location'])
+        mensajes = [str(m) for m in self.client.get(segunda['Location']).context['messages']]
+        self.assertEqual(len(mensajes), 1)
+        self.assertIn('Salida autorizada', mensajes[0])
+        tablas = ('inventario_parqueo', 'pagos', 'espacios', 'contadores_espacio', 'solicitudes_salida')
+        self.assertFalse([q['sql'] for q in queries if any(f'"{t}"' in q['sql'] for t in tablas)])
+        self.assertEqual(Pago.objects.filter(fkIdParqueo=registro).count(), 1)
+
+    def test_misma_clave_con_otro_formulario_es_otra_operacion(self):
+        # La clave es por página: dos salidas distintas desde el mismo dashboard se ejecutan ambas
+        registros = [self.estacionar(e, f'ABC12{i}') for i, e in enumerate(self.espacios[:2])]
+        self.iniciar_sesion('VIGILANTE')
+        for registro in registros:
+            self.client.post(reverse('guardia_registrar_salida'), {'registro_id': registro.pk, 'idempotency_key': 'k1'})
+        self.assertEqual(InventarioParqueo.objects.filter(parHoraSalida__isnull=False).count(), 2)
+        self.assertEqual(RespuestaIdempotente.objects.count(), 2)
+
+    def test_doble_envio_de_la_salida_del_cliente_crea_un_solo_pago(self):
+        registro = self.estacionar(self.espacios[0], 'CLI123', usuario=self.usuario)
+        session = self.client.session
+        session['usuario_id'] = self.usuario.pk
+        session['usuario_rol'] = 'CLIENTE'
+        session.save()
+        clave = self.client.get(reverse('cliente_salida')).context['clave_idempotencia']
+
+        datos = {'metodo_pago': 'EFECTIVO', 'idempotency_key': clave}
+        primera = self.client.post(reverse('cliente_salida'), datos)
+        segunda = self.client.post(reverse('cliente_salida'), datos)
+        self.assertEqual(segunda.status_code, 200)
+        self.assertEqual(segunda.content, primera.content)
+        self.assertEqual(Pago.objects.filter(fkIdParqueo=registro).count(), 1)
+        self.assertEqual(SolicitudSalida.objects.count(), 1)
+
+        # Confirmar el pago dos veces: la segunda repite el "Pago confirmado" original
+        self.iniciar_sesion('VIGILANTE')
+        datos = {'registro_id': registro.pk, 'idempotency_key': 'k2'}
+        self.enviar('guardia_confirmar_pago', datos)
+        _, mensajes = self.enviar('guardia_confirmar_pago', {'registro_id': registro.pk}, HTTP_IDEMPOTENCY_KEY='k2')
+        self.assertEqual(len(mensajes), 1)
+        self.assertIn('Pago confirmado', mensajes[0])
+
+    def test_doble_toque_en_el_ingreso_repite_la_primera_respuesta(self):
+        self.iniciar_sesion('VIGILANTE')
+        clave = self.client.get(reverse('guardia_dashboard')).context['clave_idempotencia']
+        datos = {'placa': 'ING123', 'espacio_id': self.espacios[0].pk, 'idempotency_key': clave}
+        _, primeros = self.enviar('guardia_registrar_ingreso', datos)
+        _, segundos = self.enviar('guardia_registrar_ingreso', datos)
+        self.assertEqual(segundos, primeros)
+        self.assertIn('Ingreso registrado', segundos[0])
+        self.assertEqual(InventarioParqueo.objects.filter(fkIdVehiculo__vehPlaca='ING123').count(), 1)
+
+        self.iniciar_sesion('ADMIN')
+        clave = self.client.get(reverse('admin_dashboard')).context['clave_idempotencia']
+        datos = {'placa': 'ING456', 'espacio_id': self.espacios[1].pk, 'idempotency_key': clave}
+        _, primeros = self.enviar('admin_registrar_ingreso', datos)
+        _, segundos = self.enviar('admin_registrar_ingreso', datos)
+        self.assertEqual(segundos, primeros)
+        self.assertIn('Ingreso registrado', segundos[0])
+
+    def test_reenvio_sin_clave_de_la_salida_en_efectivo_no_crea_otro_pago(self):
+        registro = self.estacionar(self.espacios[0], 'CLI123', usuario=self.usuario)
+        session = self.client.session
+        session['usuario_id'] = self.usuario.pk
+        session['usuario_rol'] = 'CLIENTE'
+        session.save()
+        primera = self.client.post(reverse('cliente_salida'), {'metodo_pago': 'EFECTIVO'})
+        segunda = self.client.post(reverse('cliente_salida'), {'metodo_pago': 'EFECTIVO'})
+        self.assertEqual(segunda.context['pago'], primera.context['pago'])
+        self.assertEqual(Pago.objects.filter(fkIdParqueo=registro).count(), 1)
+        self.assertEqual(SolicitudSalida.objects.count(), 1)
+
+    def test_clave_en_curso_y_vencida(self):
+        registro = self.estacionar(self.espacios[0], 'ABC123')
+        self.iniciar_sesion('VIGILANTE')
+        datos = {'registro_id': registro.pk, 'idempotency_key': 'k1'}
+        self.enviar('guardia_registrar_salida', datos)
+
+        # Otra petición con la misma clave mientras la original se procesa
+        RespuestaIdempotente.objects.update(idemEstado=None)
+        _, mensajes = self.enviar('guardia_registrar_salida', datos)
+        self.assertEqual(mensajes, ['Tu solicitud anterior todavía se está procesando.'])
+
+        # Vencida: la vista vuelve a ejecutarse (el turno ya está cerrado → 404) y, como
+        # terminó en excepción, la clave queda libre para un reintento
+        RespuestaIdempotente.objects.update(idemExpira=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.client.post(reverse('guardia_registrar_salida'), datos).status_code, 404)
+        self.assertFalse(RespuestaIdempotente.objects.exists())
+
+        RespuestaIdempotente.objects.create(idemHuella='x', idemEstado=302, idemExpira=timezone.now())
+        call_command('purgar_idempotencia', stdout=StringIO())
+        self.assertFalse(RespuestaIdempotente.objects.exists())
+
+
+class ParqueoActualTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        pool_espacios.invalidar()
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=3)
+
+    def test_ingreso_y_salida_mantienen_el_puntero(self):
+        registro = registrar_ingreso(Vehiculo.objects.create(vehPlaca='ABC123'), espacio_id=self.espacios[0].pk)
+        espacio = Espacio.objects.get(pk=self.espacios[0].pk)
+        self.assertEqual(espacio.fkIdParqueoActual, registro)
+
+        registrar_salida(InventarioParqueo.objects.select_related('fkIdVehiculo', 'fkIdEspacio').get(pk=registro.pk))
+        espacio.refresh_from_db()
+        self.assertIsNone(espacio.fkIdParqueoActual)
+        self.assertEqual(Espacio.diferencias_parqueo_actual(), {})
+
+    def test_detalle_del_guardia_llega_por_el_puntero(self):
+        registro = self.ingresar(self.espacios[1], 'DEF456')
+        self.iniciar_sesion('VIGILANTE')
+        url = reverse('guardia_detalle_ocupacion') + f'?espacio_id={self.espacios[1].pk}'
+        VersionParqueadero.actual()  # la fila de versión ya existe en régimen normal
+        # sesión + versión (ETag) + espacio con turno, vehículo y usuario + pago + tarifa
+        with self.assertNumQueries(5):
+            datos = self.client.get(url).json()
+        self.assertEqual((datos['registro_id'], datos['placa']), (registro.pk, 'DEF456'))
+
+        url = reverse('guardia_detalle_ocupacion') + f'?espacio_id={self.espacios[2].pk}'
+        self.assertFalse(self.client.get(url).json()['found'])
+
+    def test_comando_detecta_y_corrige_punteros_desfasados(self):
+        registro = self.ingresar(self.espacios[0], 'ABC123')
+        otro = self.ingresar(self.espacios[1], 'DEF456')
+        # Un script que cambió los espacios con .update(): punteros cruzados y uno perdido
+        Espacio.objects.filter(pk=self.espacios[1].pk).update(fkIdParqueoActual=None)
+        Espacio.objects.filter(pk=self.espacios[2].pk).update(fkIdParqueoActual=otro)
+        Espacio.objects.filter(pk=self.espacios[0].pk).update(fkIdParqueoActual=None)
+
+        with self.assertRaises(CommandError):
+            call_command('reconstruir_parqueo_actual', '--verificar', stdout=StringIO())
+        call_command('reconstruir_parqueo_actual', stdout=StringIO())
+        self.assertEqual(Espacio.diferencias_parqueo_actual(), {})
+        punteros = dict(Espacio.objects.values_list('pk', 'fkIdParqueoActual'))
+        self.assertEqual(punteros, {
+            self.espacios[0].pk: registro.pk, self.espacios[1].pk: otro.pk, self.espacios[2].pk: None,
+        })
+        call_command('reconstruir_parqueo_actual', '--verificar', stdout=StringIO())
+
+
+class RetencionEspacioTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        pool_espacios.invalidar()
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=2)
+
+    def cliente(self, documento, placa, tipo='Carro'):
+        usuario = Usuario.objects.create(
+            usuDocumento=documento, usuNombre='Ana', usuApellido='Ruiz',
+            usuCorreo=f'{documento}@example.com', usuClaveHash='x',
+        )
+        vehiculo = Vehiculo.objects.create(vehPlaca=placa, vehTipo=tipo, fkIdUsuario=usuario)
+        cliente = Client()
+        session = cliente.session
+        session['usuario_id'] = usuario.pk
+        session.save()
+        return cliente, vehiculo
+
+    def test_la_pagina_de_entrada_aparta_el_espacio_hasta_confirmar(self):
+        ana, carro_ana = self.cliente('1', 'ANA123')
+        luis, carro_luis = self.cliente('2', 'LUI123')
+
+        respuesta = ana.get(reverse('entrada_parqueadero'))
+        retencion = RetencionEspacio.objects.get()
+        self.assertContains(respuesta, retencion.retToken)
+        self.assertEqual(retencion.fkIdEspacio, self.espacios[0])
+        self.assertEqual(Espacio.objects.get(pk=self.espacios[0].pk).espEstado, 'RESERVADO')
+
+        # Quien escanea después recibe otro espacio, aunque confirme primero
+        luis.post(reverse('entrada_parqueadero'), {'vehiculo_id': carro_luis.pk})
+        self.assertEqual(InventarioParqueo.objects.get(fkIdVehiculo=carro_luis).fkIdEspacio, self.espacios[1])
+
+        ana.post(reverse('entrada_parqueadero'), {'vehiculo_id': carro_ana.pk, 'retencion': retencion.retToken})
+        self.assertEqual(InventarioParqueo.objects.get(fkIdVehiculo=carro_ana).fkIdEspacio, self.espacios[0])
+        self.assertFalse(RetencionEspacio.objects.exists())
+        self.assertEqual(Espacio.objects.get(pk=self.espacios[0].pk).espEstado, 'OCUPADO')
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+    def test_sin_cupo_la_retencion_gana_a_la_entrada_sin_retencion(self):
+        self.espacios[1].ocupar()
+        ana, carro_ana = self.cliente('1', 'ANA123')
+        luis, carro_luis = self.cliente('2', 'LUI123')
+        ana.get(reverse('entrada_parqueadero'))
+        luis.get(reverse('entrada_parqueadero'))  # ya no queda nada que apartar
+        self.assertEqual(RetencionEspacio.objects.count(), 1)
+
+        with self.assertRaisesMessage(IngresoRechazado, 'no hay espacios disponibles'):
+            registrar_ingreso(carro_luis)
+        token = RetencionEspacio.objects.get().retToken
+        ana.post(reverse('entrada_parqueadero'), {'vehiculo_id': carro_ana.pk, 'retencion': token})
+        self.assertEqual(InventarioParqueo.objects.get(fkIdVehiculo=carro_ana).fkIdEspacio, self.espacios[0])
+
+    def test_recargar_la_pagina_extiende_la_misma_retencion(self):
+        ana, _ = self.cliente('1', 'ANA123')
+        ana.get(reverse('entrada_parqueadero'))
+        primera = RetencionEspacio.objects.get()
+        RetencionEspacio.objects.filter(pk=primera.pk).update(retExpira=timezone.now() + timedelta(seconds=5))
+        ana.get(reverse('entrada_parqueadero'))
+        segunda = RetencionEspacio.objects.get()
+        self.assertEqual((segunda.pk, segunda.fkIdEspacio_id), (primera.pk, primera.fkIdEspacio_id))
+        self.assertGreater(segunda.retExpira, timezone.now() + timedelta(seconds=60))
+        self.assertEqual(Espacio.objects.filter(espEstado='RESERVADO').count(), 1)
+
+    def test_barrido_devuelve_las_vencidas_y_no_cuesta_nada_sin_ellas(self):
+        ana, carro_ana = self.cliente('1', 'ANA123')
+        ana.get(reverse('entrada_parqueadero'))
+        with self.assertNumQueries(1):
+            self.assertEqual(RetencionEspacio.liberar_vencidas(), 0)
+
+        token = RetencionEspacio.objects.get().retToken
+        RetencionEspacio.objects.update(retExpira=timezone.now() - timedelta(seconds=1))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(RetencionEspacio.liberar_vencidas(), 1)
+        self.assertFalse(RetencionEspacio.objects.exists())
+        self.assertEqual(Espacio.objects.filter(espEstado='DISPONIBLE').count(), 2)
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+        # El token vencido no falla: la entrada busca espacio como siempre
+        ana.post(reverse('entrada_parqueadero'), {'vehiculo_id': carro_ana.pk, 'retencion': token})
+        self.assertTrue(InventarioParqueo.objects.filter(fkIdVehiculo=carro_ana).exists())
+
+    def test_pool_agotado_por_retenciones_abandonadas_las_recupera(self):
+        self.espacios[1].ocupar()
+        ana, _ = self.cliente('1', 'ANA123')
+        ana.get(reverse('entrada_parqueadero'))
+        RetencionEspacio.objects.update(retExpira=timezone.now() - timedelta(seconds=1))
+
+        registro = registrar_ingreso(Vehiculo.objects.create(vehPlaca='VIS123'))
+        self.assertEqual(registro.fkIdEspacio, self.espacios[0])
+        self.assertFalse(RetencionEspacio.objects.exists())
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+    def test_solo_se_aparta_para_el_vehiculo_elegido(self):
+        tipo_moto = TipoEspacio.objects.create(nombre='Moto')
+        moto = Espacio.objects.create(espNumero='M1-01', fkIdPiso=self.espacios[0].fkIdPiso, fkIdTipoEspacio=tipo_moto)
+        ana, carro_ana = self.cliente('1', 'ANA123')
+        moto_ana = Vehiculo.objects.create(vehPlaca='ANA12A', vehTipo='Moto', fkIdUsuario=carro_ana.fkIdUsuario)
+
+        # Por defecto, el primer vehículo: un solo espacio apartado
+        respuesta = ana.get(reverse('entrada_parqueadero'))
+        self.assertEqual(respuesta.context['retencion'].fkIdEspacio, self.espacios[0])
+        self.assertEqual(RetencionEspacio.objects.count(), 1)
+
+        # Elegir la moto cambia la retención de tipo en vez de sumar otra
+        with self.captureOnCommitCallbacks(execute=True):
+            respuesta = ana.get(reverse('entrada_parqueadero'), {'vehiculo': moto_ana.pk})
+        token = respuesta.context['retencion'].retToken
+        self.assertEqual(
+            list(RetencionEspacio.objects.values_list('fkIdEspacio', flat=True)), [moto.pk],
+        )
+        self.assertEqual(Espacio.objects.get(pk=self.espacios[0].pk).espEstado, 'DISPONIBLE')
+
+        # Entrar al final con el carro: espacio por el pool y la retención de la moto se suelta
+        ana.post(reverse('entrada_parqueadero'), {'vehiculo_id': carro_ana.pk, 'retencion': token})
+        self.assertEqual(InventarioParqueo.objects.get(fkIdVehiculo=carro_ana).fkIdEspacio, self.espacios[0])
+        self.assertEqual(Espacio.objects.get(pk=moto.pk).espEstado, 'DISPONIBLE')
+        self.assertFalse(RetencionEspacio.objects.exists())
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+
+@override_settings(QR_POR_ESPACIO=True)
+class QREspacioTests(ParqueaderoTestMixin, TestCase):
+
+    def setUp(self):
+        pool_espacios.invalidar()
+        self.espacios = self.crear_parqueadero(pisos=1, espacios_por_piso=3)
+        self.usuario = Usuario.objects.create(
+            usuDocumento='123', usuNombre='Ana', usuApellido='Ruiz', usuCorreo='ana@example.com', usuClaveHash='x',
+        )
+        self.vehiculo = Vehiculo.objects.create(vehPlaca='QRE123', fkIdUsuario=self.usuario)
+        session = self.client.session
+        session['usuario_id'] = self.usuario.pk
+        session.save()
+
+    def url(self, espacio):
+        return reverse('entrada_espacio', args=[firmar_qr_espacio(espacio.pk)])
+
+    def test_firma_verifica_el_espacio(self):
+        token = firmar_qr_espacio(self.espacios[2].pk)
+        self.assertEqual(leer_qr_espacio(token), self.espacios[2].pk)
+        firma = token.split(':', 1)[1]
+        self.assertIsNone(leer_qr_espacio(f'{self.espacios[0].pk}:{firma}'))
+        self.assertIsNone(leer_qr_espacio('basura'))
+
+    def test_escanear_el_espacio_ingresa_en_ese_espacio(self):
+        destino = self.espacios[2]
+        self.assertContains(self.client.get(self.url(destino)), 'QRE123')
+        respuesta = self.client.post(self.url(destino), {'vehiculo_id': self.vehiculo.pk})
+        self.assertContains(respuesta, destino.espNumero)
+        self.assertEqual(InventarioParqueo.objects.get(fkIdVehiculo=self.vehiculo).fkIdEspacio, destino)
+        self.assertEqual(Espacio.objects.get(pk=destino.pk).espEstado, 'OCUPADO')
+        # El pool de libres ni se cargó
+        self.assertEqual(pool_espacios.metricas()['libres'], {})
+
+    def test_escanear_el_espacio_suelta_lo_apartado_en_la_entrada_general(self):
+        self.client.get(reverse('entrada_parqueadero'))
+        apartado = RetencionEspacio.objects.get().fkIdEspacio
+        self.client.post(self.url(self.espacios[2]), {'vehiculo_id': self.vehiculo.pk})
+        self.assertFalse(RetencionEspacio.objects.exists())
+        self.assertEqual(Espacio.objects.get(pk=apartado.pk).espEstado, 'DISPONIBLE')
+        self.assertEqual(ContadorEspacios.diferencias(), {})
+
+    def test_espacio_ocupado_rechaza_el_ingreso(self):
+        self.ingresar(self.espacios[0], 'OTR123')
+        respuesta = self.client.post(self.url(self.espacios[0]), {'vehiculo_id': self.vehiculo.pk})
+        self.assertRedirects(respuesta, self.url(self.espacios[0]), fetch_redirect_response=False)
+        self.assertFalse(InventarioParqueo.objects.filter(fkIdVehiculo=self.vehiculo).exists())
+
+    def test_firma_alterada_o_modo_apagado_dan_404(self):
+        token = firmar_qr_espacio(self.espacios[0].pk)
+        alterado = reverse('entrada_espacio', args=[f'{self.espacios[1].pk}:{token.split(":", 1)[1]}'])
+        self.assertEqual(self.client.get(alterado).status_code, 404)
+        with override_settings(QR_POR_ESPACIO=False):
+            self.assertEqual(self.client.get(self.url(self.espacios[0])).status_code, 404)
+
+    def test_hoja_pdf_por_piso(self):
+        self.iniciar_sesion('ADMIN')
+        url = reverse('admin_qr_espacios_pdf', args=[self.espacios[0].fkIdPiso_id])
+        self.assertContains(self.client.get(reverse('admin_generar_qr')), url)
+        respuesta = self.client.get(url)
+        self.assertEqual(respuesta['Content-Type'], 'application/pdf')
+        self.assertTrue(respuesta.content.startswith(b'%PDF'))
+
+
+class EstresConcurrenciaTests(TransactionTestCase):
+
+    def test_recorre_los_flujos_sin_violar_invariantes_y_limpia(self):
+        salida = StringIO()
+        call_command(
+            'estres_concurrencia', guardias=1, clientes=2, operaciones=12, espacios=3, semilla=7,
+            forzar=True, stdout=salida,
+        )
+        reporte = salida.getvalue()
+        for operacion in ('guardia_ingreso', 'cliente_entrada_qr', 'reserva_crear'):
+            self.assertIn(operacion, reporte)
+        self.assertIn('Invariantes OK.', reporte)
+        self.assertFalse(Usuario.objects.exists())
+        self.assertFalse(Espacio.objects.exists())
+        self.assertFalse(InventarioParqueo.objects.exists())
@@ -1,9 +1,652 @@
+import hashlib
+import heapq
+import json
+import os
+import re
+import threading
+import time
 from datetime import datetime, timedelta
 
+from django.conf import settings
+from django.contrib import messages
+from django.core import signing
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.db.models import Count, Exists, F, OuterRef, Prefetch, Sum
+from django.db.models.functions import ExtractHour, TruncDate
+from django.shortcuts import redirect
 from django.utils import timezone
 
 from pagos.models import Pago
-from .models import Piso, InventarioParqueo
+from reservas.models import Reserva
+from .models import Espacio, Piso, RespuestaIdempotente, VersionParqueadero
+
+# Vida máxima de un snapshot aunque la versión no cambie. Parte del contenido depende
+# del reloj y no de una transición (reservas que entran en la ventana de 2h, costos
+# estimados, "activos hoy"), así que un snapshot nunca se sirve más de estos segundos.
+SNAPSHOT_TTL = 30
+
+# Cuánto se conservan los snapshots anteriores para poder calcular deltas (`since=`).
+# Un cliente que lleve más tiempo sin refrescar (pestaña en segundo plano) recibe el
+# payload completo.
+SNAPSHOT_HISTORIAL_TTL = 300
+
+# Vida del HTML cacheado del mapa de pisos ({% cache %} en los templates). La clave lleva
+# la revisión del snapshot, que nunca se reutiliza, así que no hace falta invalidarlo.
+MAPA_FRAGMENTO_TTL = SNAPSHOT_HISTORIAL_TTL
+
+# Formato de la revisión que viaja al cliente: "<versión>.<timestamp del cálculo>"
+_REVISION_RE = re.compile(r'^\d+\.\d+$')
+
+
+class _Vuelo:
+    def __init__(self):
+        self.listo = threading.Event()
+        self.resultado = None
+        self.error = None
+
+
+class VueloUnico:
+    """
+    Coalescencia "single-flight" de cálculos idénticos dentro del proceso.
+
+    Cuando llegan N peticiones con la misma clave mientras el cálculo está en curso
+    (cambio de turno: todas las tablets del guardia abren el dashboard a la vez), solo
+    la primera ejecuta la función; las demás esperan y reciben el mismo resultado (o la
+    misma excepción). Los contadores `calculados` / `compartidos` muestran cuántos
+    cálculos se ahorraron; se exponen en AdminDashboardMetricasView.
+
+    Es por proceso (cada worker de gunicorn tiene el suyo). Entre procesos el caché
+    por versión de obtener_snapshot ya evita la mayoría de recálculos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._en_vuelo = {}
+        self.calculados = 0
+        self.compartidos = 0
+
+    def ejecutar(self, clave, funcion):
+        with self._lock:
+            vuelo = self._en_vuelo.get(clave)
+            lider = vuelo is None
+            if lider:
+                vuelo = self._en_vuelo[clave] = _Vuelo()
+
+        if not lider:
+            vuelo.listo.wait()
+            with self._lock:
+                self.compartidos += 1
+            if vuelo.error is not None:
+                raise vuelo.error
+            return vuelo.resultado
+
+        try:
+            vuelo.resultado = funcion()
+        except Exception as e:
+            vuelo.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._en_vuelo[clave]
+                self.calculados += 1
+            vuelo.listo.set()
+        return vuelo.resultado
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'calculados': self.calculados,
+                'compartidos': self.compartidos,
+                'en_vuelo': len(self._en_vuelo),
+            }
+
+
+vuelo_unico = VueloUnico()
+
+
+# ── Pool de espacios libres ─────────────────────────────────────────
+# Cuánto confía el pool en lo que sabe antes de recargar el tipo desde la BD. Las
+# transiciones de este proceso llegan al instante (Espacio.save/delete); las de otros
+# workers y los rollbacks después de un reclamo solo se ven al recargar.
+POOL_TTL = 30
+
+
+def prioridad_por_piso(piso_id, numero):
+    """Regla por defecto: primero el piso con menor id y dentro de él el menor número."""
+    return (piso_id, numero)
+
+
+def prioridad_pisos_preferidos(*piso_ids):
+    """
+    Regla que llena primero los pisos indicados, en ese orden (ej. los más cercanos a la
+    salida), y después el resto por prioridad_por_piso.
+    """
+    orden = {piso_id: posicion for posicion, piso_id in enumerate(piso_ids)}
+    return lambda piso_id, numero: (orden.get(piso_id, len(orden)), piso_id, numero)
+
+
+class PoolEspacios:
+    """
+    Espacios DISPONIBLES por TipoEspacio en un heap ordenado por `prioridad(piso_id, numero)`.
+
+    La entrada saca el candidato del heap en microsegundos en vez de hacer un
+    ORDER BY piso, número sobre la tabla de espacios con join al tipo; la BD solo
+    confirma el candidato por PK (Espacio.reclamar). Si el pool estaba desactualizado
+    (otro worker lo ocupó) la confirmación falla, se descarta y se prueba el siguiente:
+    el pool acelera la decisión pero nunca la toma solo.
+
+    Borrado perezoso: `_vigentes` guarda la clave con la que cada espacio libre está en el
+    heap; las entradas del heap que ya no coinciden se descartan al sacarlas.
+    Es por proceso, como VueloUnico.
+    """
+
+    def __init__(self, prioridad=prioridad_por_piso, ttl=POOL_TTL):
+        self.prioridad = prioridad
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._heaps = {}       # tipo_id -> [(clave de prioridad, pk)]
+        self._vigentes = {}    # tipo_id -> {pk: clave de prioridad}
+        self._cargado = {}     # tipo_id -> time.monotonic() de la última carga
+        self.reclamados = 0
+        self.descartados = 0
+        self.recargas = 0
+
+    def reclamar(self, tipo_id, hacia='OCUPADO'):
+        """Pasa a `hacia` y devuelve el espacio libre de mayor prioridad del tipo, o None."""
+        recargado = False
+        while True:
+            pk = self._sacar(tipo_id)
+            if pk is None:
+                if recargado:
+                    return None
+                # Vacío (o vencido): antes de decir "no hay cupo" se mira la BD una vez
+                self.cargar(tipo_id)
+                recargado = True
+                continue
+            espacio = Espacio.reclamar(pk, hacia=hacia)
+            with self._lock:
+                if espacio is None:
+                    self.descartados += 1
+                else:
+                    self.reclamados += 1
+            if espacio is not None:
+                return espacio
+
+    def cargar(self, tipo_id):
+        """Reconstruye el heap del tipo desde la BD (una query por índice)."""
+        filas = Espacio.objects.filter(
+            fkIdTipoEspacio_id=tipo_id, espEstado='DISPONIBLE',
+        ).values_list('pk', 'fkIdPiso_id', 'espNumero')
+        vigentes = {pk: self.prioridad(piso_id, numero) for pk, piso_id, numero in filas}
+        heap = [(clave, pk) for pk, clave in vigentes.items()]
+        heapq.heapify(heap)
+        with self._lock:
+            self._heaps[tipo_id] = heap
+            self._vigentes[tipo_id] = vigentes
+            self._cargado[tipo_id] = time.monotonic()
+            self.recargas += 1
+
+    def actualizar(self, pk, clave_contador, numero):
+        """
+        Refleja una transición confirmada de un espacio. `clave_contador` es su
+        (piso_id, tipo_id, estado) nuevo, o None si se borró.
+        """
+        with self._lock:
+            # Sale de cualquier tipo en el que estuviera (cambio de tipo desde el admin)
+            for vigentes in self._vigentes.values():
+                vigentes.pop(pk, None)
+            if clave_contador is None:
+                return
+            piso_id, tipo_id, estado = clave_contador
+            if estado != 'DISPONIBLE' or tipo_id not in self._heaps:
+                return  # los tipos que nunca se cargaron se leen completos al primer uso
+            clave = self.prioridad(piso_id, numero)
+            self._vigentes[tipo_id][pk] = clave
+            heapq.heappush(self._heaps[tipo_id], (clave, pk))
+
+    def invalidar(self):
+        """Olvida todo; cada tipo se recarga desde la BD en su próximo reclamo."""
+        with self._lock:
+            self._heaps.clear()
+            self._vigentes.clear()
+            self._cargado.clear()
+
+    def _sacar(self, tipo_id):
+        with self._lock:
+            cargado = self._cargado.get(tipo_id)
+            if cargado is None or time.monotonic() - cargado > self.ttl:
+                return None
+            heap, vigentes = self._heaps[tipo_id], self._vigentes[tipo_id]
+            while heap:
+                clave, pk = heapq.heappop(heap)
+                if vigentes.get(pk) == clave:
+                    del vigentes[pk]
+                    return pk
+            return None
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'reclamados': self.reclamados,
+                'descartados': self.descartados,
+                'recargas': self.recargas,
+                'libres': {tipo_id: len(vigentes) for tipo_id, vigentes in self._vigentes.items()},
+            }
+
+
+pool_espacios = PoolEspacios()
+
+
+def obtener_snapshot(nombre, construir, now=None):
+    """
+    Retorna el payload del dashboard `nombre` cacheado por versión del parqueadero.
+
+    `construir(now)` solo se ejecuta cuando cambió VersionParqueadero (o venció el
+    TTL); el resto de consultas cuesta una query (leer la versión) + un acceso al caché.
+    El dict retornado incluye la clave 'version' con la revisión del snapshot
+    ("<versión>.<timestamp>"): cambia con cada transición y con cada recálculo por TTL,
+    que es lo que el cliente devuelve en `since=` para pedir solo los cambios.
+    """
+    version = VersionParqueadero.actual()
+    clave = f'tablero:{nombre}:{version}'
+    data = cache.get(clave)
+    if data is None:
+        # Las peticiones simultáneas con la misma versión comparten un único cálculo
+        data = vuelo_unico.ejecutar(clave, lambda: _construir_snapshot(nombre, construir, version, now))
+    return data
+
+
+def _construir_snapshot(nombre, construir, version, now):
+    now = now or timezone.now()
+    data = construir(now)
+    data['version'] = f'{version}.{int(now.timestamp())}'
+    cache.set(f'tablero:{nombre}:{version}', data, SNAPSHOT_TTL)
+    cache.set(f'tablero:{nombre}:rev:{data["version"]}', data, SNAPSHOT_HISTORIAL_TTL)
+    return data
+
+
+def revision_vigente(nombre):
+    """
+    Revisión del snapshot de `nombre` que está en caché, SIN construirlo (None si no hay).
+    Es lo que usan las ETags de los endpoints del dashboard: cuesta leer la versión y un
+    acceso al caché, así que un 304 no ejecuta ninguna de las queries del payload.
+    """
+    data = cache.get(f'tablero:{nombre}:{VersionParqueadero.actual()}')
+    return data['version'] if data is not None else None
+
+
+_LAYOUT_RE = re.compile(r'^[0-9a-f]{12}$')
+
+
+def etag_tablero(request, nombre, construir):
+    """
+    ETag de los endpoints de datos del dashboard: revisión del snapshot + formato.
+
+    El cuerpo depende de `?formato=` y de `?layout=` (si el hash no coincide viaja la
+    'estructura'), así que ambos entran en la ETag: un If-None-Match de otro formato
+    no produce un 304. `since` ya va en la URL. Un `layout` que no es un hash válido
+    nunca coincide con el actual, por eso todos comparten la misma ETag.
+    Si el snapshot no está en caché se construye aquí; la vista lo reutiliza.
+    """
+    revision = obtener_snapshot(nombre, construir)['version']
+    if request.GET.get('formato') != 'compacto':
+        return revision
+    layout = request.GET.get('layout', '')
+    return f'{revision}-compacto-{layout if _LAYOUT_RE.match(layout) else "x"}'
+
+
+def etag_detalle(request, *args, **kwargs):
+    """
+    ETag de los endpoints de detalle de ocupación: versión del parqueadero + minuto.
+
+    El detalle cambia con cualquier transición (salida, pago, cambio de tarifa) y con el
+    reloj, pero la duración y el costo se calculan por minuto: dentro del mismo minuto y
+    la misma versión la respuesta es idéntica. La URL (espacio_id/registro_id) ya
+    distingue un espacio de otro.
+    """
+    return f'det-{VersionParqueadero.actual()}-{int(time.time() // 60)}'
+
+
+def obtener_delta(nombre, construir, since=None, now=None):
+    """
+    Igual que obtener_snapshot, pero si el cliente envía la revisión que ya tiene
+    (`since`) responde solo con lo que cambió desde entonces:
+
+      {'version': <nueva>, 'delta': True, <KPIs cambiados>, 'pisos': [...], <solicitudes>}
+
+    - KPIs y listas de solicitudes: solo se incluyen si cambiaron (las listas completas,
+      son cortas y el cliente las re-renderiza enteras).
+    - pisos: solo los pisos con algún cambio, con sus contadores y ÚNICAMENTE los
+      espacios cuyo dict cambió.
+
+    Si la revisión no se conoce (expiró, viene de otro proceso, o cambió la estructura
+    de pisos/espacios) se responde el payload completo con 'delta': False.
+    El delta entre un par de revisiones se cachea: todos los clientes que refrescan
+    desde la misma revisión comparten el cálculo.
+    """
+    return _obtener_delta(nombre, construir, since, now)[1]
+
+
+def obtener_delta_para(request, nombre, construir):
+    """Delta en el formato que pide el cliente: ?since=&formato=compacto&layout=."""
+    since = request.GET.get('since')
+    if request.GET.get('formato') == 'compacto':
+        return obtener_delta_compacto(nombre, construir, since, request.GET.get('layout'))
+    return obtener_delta(nombre, construir, since)
+
+
+def _obtener_delta(nombre, construir, since=None, now=None):
+    """obtener_delta que además retorna el snapshot completo: (snapshot, delta)."""
+    actual = obtener_snapshot(nombre, construir, now)
+    if not since or not _REVISION_RE.match(since):
+        return actual, {**actual, 'delta': False}
+    if since == actual['version']:
+        return actual, {'version': since, 'delta': True}
+
+    clave = f'tablero:{nombre}:delta:{since}:{actual["version"]}'
+    delta = cache.get(clave)
+    if delta is None:
+        anterior = cache.get(f'tablero:{nombre}:rev:{since}')
+        delta = _diferencia(anterior, actual) if anterior is not None else None
+        if delta is None:
+            delta = {**actual, 'delta': False}
+        cache.set(clave, delta, SNAPSHOT_TTL)
+    return actual, delta
+
+
+# ── Formato compacto (columnar) ─────────────────────────────────────
+# Para tablets con mala señal: en lugar de repetir las claves en cada espacio, cada
+# piso trae arreglos paralelos (una posición por espacio) y el estado va como código
+# entero. Lo que no cambia entre refrescos (nombres de pisos, números de espacio,
+# tabla de estados) viaja en 'estructura' solo cuando el cliente no tiene el mismo
+# `layout` (hash) guardado.
+ESTADOS_COMPACTOS = [valor for valor, _ in Espacio.EstadoChoices.choices]
+_CODIGO_ESTADO = {valor: codigo for codigo, valor in enumerate(ESTADOS_COMPACTOS)}
+
+# Columna compacta de cada campo del serializador; los campos extra usan su propio nombre
+_COLUMNAS_COMPACTAS = {
+    'pk': 'esp',
+    'espEstado': 'est',
+    'pago_pendiente': 'pago',
+    'reserva_pk': 'res',
+    'placa_actual': 'placa',
+}
+
+
+def obtener_delta_compacto(nombre, construir, since=None, layout=None, now=None):
+    """
+    obtener_delta en formato compacto. Cada piso queda como:
+      {'pk', 'total_espacios', 'ocupados_espacios', 'ocupacion_pct',
+       'esp': [pk...], 'est': [código...], 'pago': [0|1...], 'res': [pk|null...], 'placa': [...]}
+    Si `layout` no coincide con el hash de la estructura actual se agrega
+      'estructura': {'layout', 'estados', 'pisos': {pk: {'pisNombre', 'espacios': {pk: espNumero}}}}
+    """
+    actual, delta = _obtener_delta(nombre, construir, since, now)
+    estructura = _estructura_compacta(nombre, actual)
+    data = {k: v for k, v in delta.items() if k != 'pisos'}
+    data['formato'] = 'compacto'
+    data['layout'] = estructura['layout']
+    if layout != estructura['layout']:
+        data['estructura'] = estructura
+    if 'pisos' in delta:
+        data['pisos'] = [_piso_compacto(piso) for piso in delta['pisos']]
+    return data
+
+
+def _estructura_compacta(nombre, snapshot):
+    """Metadatos estáticos del mapa, calculados una vez por revisión del snapshot."""
+    clave = f'tablero:{nombre}:estructura:{snapshot["version"]}'
+    estructura = cache.get(clave)
+    if estructura is None:
+        pisos = {
+            piso['pk']: {
+                'pisNombre': piso['pisNombre'],
+                'espacios': {e['pk']: e['espNumero'] for e in piso['espacios']},
+            }
+            for piso in snapshot.get('pisos', [])
+        }
+        firma = json.dumps([ESTADOS_COMPACTOS, pisos], sort_keys=True).encode()
+        estructura = {
+            'layout': hashlib.sha1(firma).hexdigest()[:12],
+            'estados': ESTADOS_COMPACTOS,
+            'pisos': pisos,
+        }
+        cache.set(clave, estructura, SNAPSHOT_HISTORIAL_TTL)
+    return estructura
+
+
+def _piso_compacto(piso):
+    compacto = {k: v for k, v in piso.items() if k not in ('espacios', 'pisNombre')}
+    espacios = piso['espacios']
+    if not espacios:
+        compacto['esp'] = []
+        return compacto
+    for campo in espacios[0]:
+        if campo == 'espNumero':
+            continue
+        columna = [e[campo] for e in espacios]
+        if campo == 'espEstado':
+            columna = [_CODIGO_ESTADO[v] for v in columna]
+        elif campo == 'pago_pendiente':
+            columna = [int(v) for v in columna]
+        compacto[_COLUMNAS_COMPACTAS.get(campo, campo)] = columna
+    return compacto
+
+
+def _diferencia(anterior, actual):
+    """Delta entre dos snapshots, o None si la estructura de pisos no coincide."""
+    delta = {'version': actual['version'], 'delta': True}
+    for clave, valor in actual.items():
+        if clave == 'version':
+            continue
+        if clave == 'pisos':
+            pisos = _diferencia_pisos(anterior.get('pisos', []), valor)
+            if pisos is None:
+                return None
+            if pisos:
+                delta['pisos'] = pisos
+        elif anterior.get(clave) != valor:
+            delta[clave] = valor
+    return delta
+
+
+def _diferencia_pisos(anteriores, actuales):
+    """
+    Pisos con cambios y, dentro de cada uno, solo los espacios que cambiaron.
+    Retorna None si se agregaron/quitaron pisos o espacios: el cliente no puede
+    parchear elementos que no existen en su DOM.
+    """
+    if [p['pk'] for p in anteriores] != [p['pk'] for p in actuales]:
+        return None
+    cambios = []
+    for previo, piso in zip(anteriores, actuales):
+        if [e['pk'] for e in previo['espacios']] != [e['pk'] for e in piso['espacios']]:
+            return None
+        espacios = [e for e, e_prev in zip(piso['espacios'], previo['espacios']) if e != e_prev]
+        encabezado = {k: v for k, v in piso.items() if k != 'espacios'}
+        if espacios or encabezado != {k: v for k, v in previo.items() if k != 'espacios'}:
+            cambios.append({**encabezado, 'espacios': espacios})
+    return cambios
+
+
+# ── Stream de cambios (Server-Sent Events) ──────────────────────────
+# Solo con settings.DASHBOARD_SSE (workers de hilos): cada stream ocupa un hilo mientras
+# dura. Duración máxima de cada conexión SSE: el servidor corta antes del timeout de
+# gunicorn (30s por defecto) y el navegador reconecta solo (EventSource) enviando
+# Last-Event-ID: la reconexión recibe únicamente el delta.
+SSE_DURACION = 25
+SSE_RETRY_MS = 1000
+SSE_HEARTBEAT = 10
+
+
+class CanalCambios:
+    """
+    Feed de cambios del parqueadero dentro del proceso, sin broker externo.
+
+    - Los incrementos de VersionParqueadero hechos en este proceso avisan al instante
+      (VersionParqueadero._incrementar_ahora llama a notificar()).
+    - Los de OTROS procesos (otros workers de gunicorn) los detecta un único hilo vigía
+      que lee la versión cada INTERVALO_SONDEO segundos. Es una query liviana por PK por
+      proceso, sin importar cuántos navegadores estén conectados, y el hilo termina
+      cuando no queda ningún stream escuchando.
+    """
+    INTERVALO_SONDEO = 0.5
+
+    def __init__(self):
+        self._condicion = threading.Condition()
+        self._pulso = 0
+        self._version = None
+        self._oyentes = 0
+        self._hilo = None
+
+    @property
+    def pulso(self):
+        return self._pulso
+
+    def notificar(self, version=None):
+        """Despierta a los streams. `version` evita avisar dos veces el mismo cambio."""
+        with self._condicion:
+            if version is not None:
+                if version == self._version:
+                    return
+                self._version = version
+            self._pulso += 1
+            self._condicion.notify_all()
+
+    def esperar(self, pulso, timeout):
+        """Bloquea hasta que haya un cambio posterior a `pulso` o pase `timeout`."""
+        with self._condicion:
+            self._oyentes += 1
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(
+                    target=self._vigilar, name='vigia-version-parqueadero', daemon=True,
+                )
+                self._hilo.start()
+            try:
+                self._condicion.wait_for(lambda: self._pulso != pulso, timeout)
+                return self._pulso
+            finally:
+                self._oyentes -= 1
+
+    def _vigilar(self):
+        try:
+            while True:
+                with self._condicion:
+                    if not self._oyentes:
+                        return
+                try:
+                    self.notificar(VersionParqueadero.actual())
+                except Exception:
+                    # BD caída o conexión cortada: se reintenta en el siguiente ciclo
+                    connection.close()
+                time.sleep(self.INTERVALO_SONDEO)
+        finally:
+            connection.close()
+
+
+canal_cambios = CanalCambios()
+
+
+def stream_tablero(nombre, construir, since=None, duracion=SSE_DURACION, compacto=False, layout=None):
+    """
+    Generador de eventos SSE para el dashboard `nombre`.
+
+    El primer evento es el delta desde `since` (o el payload completo si no hay);
+    después solo se emite un evento cuando cambia la revisión del snapshot, con el
+    mismo formato de obtener_delta (u obtener_delta_compacto si `compacto`). Cada
+    evento lleva `id: <version>` para que el navegador la reenvíe como Last-Event-ID
+    al reconectar.
+    """
+    fin = time.monotonic() + duracion
+    yield f'retry: {SSE_RETRY_MS}\n\n'
+    pulso = canal_cambios.pulso
+    por_timeout = False
+    while True:
+        if compacto:
+            data = obtener_delta_compacto(nombre, construir, since, layout)
+            # Después del primer evento el cliente ya tiene la estructura vigente
+            layout = data['layout']
+        else:
+            data = obtener_delta(nombre, construir, since)
+        if data['version'] != since or not data['delta']:
+            since = data['version']
+            yield f'id: {since}\nevent: tablero\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n'
+        elif por_timeout:
+            yield ': ping\n\n'  # heartbeat: mantiene viva la conexión en proxies
+        restante = fin - time.monotonic()
+        if restante <= 0:
+            return
+        nuevo_pulso = canal_cambios.esperar(pulso, min(restante, SSE_HEARTBEAT))
+        por_timeout, pulso = nuevo_pulso == pulso, nuevo_pulso
+
+
+def respuesta_stream(request, nombre, construir):
+    """
+    StreamingHttpResponse SSE del dashboard; retoma desde Last-Event-ID o ?since=.
+    Con ?formato=compacto&layout= los eventos usan obtener_delta_compacto.
+    Sin settings.DASHBOARD_SSE responde 204: EventSource deja de reconectar y una
+    página vieja que aún abra el stream pasa al polling.
+    """
+    if not settings.DASHBOARD_SSE:
+        return HttpResponse(status=204)
+    since = request.headers.get('Last-Event-ID') or request.GET.get('since')
+    compacto = request.GET.get('formato') == 'compacto'
+    response = StreamingHttpResponse(
+        stream_tablero(nombre, construir, since, compacto=compacto, layout=request.GET.get('layout')),
+        content_type='text/event-stream',
+    )
+    # Evita que nginx/proxies acumulen el stream en buffer
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Campos opcionales por espacio que cada rol puede pedir a serializar_pisos
+_CAMPOS_ESPACIO_EXTRA = {
+    # Hora de inicio de la reserva próxima: el guardia la ve en el mapa para anticiparse
+    'reserva_hora': lambda e: e.reserva_proxima.resHoraInicio.strftime('%H:%M') if e.reserva_proxima else None,
+}
+
+
+def serializar_pisos(pisos_list, extras=()):
+    """
+    Serializador ÚNICO del mapa de pisos (admin, guardia, JSON y templates HTML).
+
+    Recibe la salida de _calcular_pisos_data y devuelve dicts planos:
+      piso    → pk, pisNombre, total_espacios, ocupados_espacios, ocupacion_pct, espacios
+      espacio → pk, espNumero, espEstado, pago_pendiente, reserva_pk, placa_actual
+    `extras` agrega campos opcionales por espacio (ver _CAMPOS_ESPACIO_EXTRA), así un
+    rol puede pedir más datos sin que el resto pague por ellos en cada delta.
+    """
+    campos_extra = [(campo, _CAMPOS_ESPACIO_EXTRA[campo]) for campo in extras]
+    pisos_data = []
+    for piso in pisos_list:
+        espacios_data = []
+        for espacio in piso.espacios_list:
+            data = {
+                'pk': espacio.pk,
+                'espNumero': espacio.espNumero,
+                'espEstado': espacio.espEstado,
+                'pago_pendiente': espacio.pago_pendiente,
+                'reserva_pk': espacio.reserva_proxima.pk if espacio.reserva_proxima else None,
+                'placa_actual': espacio.placa_actual,
+            }
+            for campo, valor in campos_extra:
+                data[campo] = valor(espacio)
+            espacios_data.append(data)
+        pisos_data.append({
+            'pk': piso.pk,
+            'pisNombre': piso.pisNombre,
+            'total_espacios': piso.total_espacios,
+            'ocupados_espacios': piso.ocupados_espacios,
+            'ocupacion_pct': piso.ocupacion_pct,
+            'espacios': espacios_data,
+        })
+    return pisos_data
 
 
 def _calcular_pisos_data(now):
@@ -13,6 +656,14 @@ def _calcular_pisos_data(now):
       piso.total_espacios, piso.ocupados_espacios, piso.ocupacion_pct, piso.espacios_list
       espacio.reserva_proxima, espacio.pago_pendiente, espacio.placa_actual
 
+    Número de queries FIJO (3), sin importar cuántos pisos o espacios existan:
+      1. pisos activos
+      2. espacios de esos pisos (prefetch, ya ordenados por espNumero) con la placa de
+         su turno actual (join por PK vía fkIdParqueoActual) + flag de pago pendiente
+      3. reservas activas que inician dentro de la ventana de 2h
+    Los conteos por piso se hacen en Python sobre la lista prefetcheada; NO usar
+    piso.espacios.filter()/count()/order_by() aquí porque cada uno vuelve a la BD.
+
     ⚠ Tradeoff intencional: se inyectan atributos en los objetos ORM en lugar de usar
     un dataclass porque los templates de Django iteran directamente sobre estos objetos.
     Crear un DTO separado requeriría duplicar la lógica de template o usar un dict.
@@ -23,52 +674,213 @@ def _calcular_pisos_data(now):
     # Si la reserva está a más de 2h, no se marca visualmente; el guardia no necesita
     # anticiparse tanto. Cambiar aquí si el negocio quiere ampliar/reducir la ventana.
     limite_2h = now + timedelta(hours=2)
-    from django.db.models import Prefetch
-    from .models import Espacio
-    pisos = Piso.objects.filter(pisEstado=True).prefetch_related(
-        Prefetch('espacios', queryset=Espacio.objects.order_by('espNumero')),
-        'espacios__reservas'
-    ).order_by('pisNombre')
+    espacios = Espacio.objects.annotate(
+        placa_turno=F('fkIdParqueoActual__fkIdVehiculo__vehPlaca'),
+        tiene_pago_pendiente=Exists(Pago.objects.filter(
+            fkIdParqueo=OuterRef('fkIdParqueoActual'),
+            pagEstado='PENDIENTE',
+            pagMetodo='EFECTIVO',
+        )),
+    ).order_by('espNumero')
+    pisos = list(Piso.objects.filter(pisEstado=True).prefetch_related(
+        Prefetch('espacios', queryset=espacios),
+    ).order_by('pisNombre'))
+
+    # Reservas próximas: rango exacto sobre resInicio (indexado), ya filtrado en BD
+    reservas_proximas = {}
+    reservas = Reserva.objects.filter(
+        resEstado__in=['PENDIENTE', 'CONFIRMADA'],
+        resInicio__range=(now, limite_2h),
+        fkIdEspacio__fkIdPiso__pisEstado=True,
+    ).order_by('resInicio', 'pk')
+    for reserva in reservas:
+        # setdefault: se conserva la más próxima si el espacio tiene varias
+        reservas_proximas.setdefault(reserva.fkIdEspacio_id, reserva)
 
     pisos_list = []
     for piso in pisos:
-        total_piso = piso.espacios.count()
-        ocupados_piso = piso.espacios.filter(espEstado='OCUPADO').count()
+        espacios_list = list(piso.espacios.all())  # usa el prefetch, sin query
+        total_piso = len(espacios_list)
+        ocupados_piso = sum(1 for e in espacios_list if e.espEstado == 'OCUPADO')
         piso.ocupacion_pct = int((ocupados_piso / total_piso) * 100) if total_piso > 0 else 0
         piso.total_espacios = total_piso
         piso.ocupados_espacios = ocupados_piso
 
-        espacios_list = []
-        for espacio in piso.espacios.order_by('espNumero'):
-            reserva_proxima = None
-            pago_pendiente = False
-
-            for reserva in espacio.reservas.filter(resEstado__in=['PENDIENTE', 'CONFIRMADA']):
-                fhr = datetime.combine(reserva.resFechaReserva, reserva.resHoraInicio)
-                fhr = timezone.make_aware(fhr)
-                if now <= fhr <= limite_2h:
-                    reserva_proxima = reserva
-                    break
-
+        for espacio in espacios_list:
+            espacio.reserva_proxima = reservas_proximas.get(espacio.pk)
             espacio.placa_actual = None
-            if espacio.espEstado == 'OCUPADO':
-                pago_pendiente = Pago.objects.filter(
-                    fkIdParqueo__fkIdEspacio=espacio,
-                    fkIdParqueo__parHoraSalida__isnull=True,
-                    pagEstado='PENDIENTE',
-                    pagMetodo='EFECTIVO',
-                ).exists()
-                registro_activo = InventarioParqueo.objects.filter(
-                    fkIdEspacio=espacio,
-                    parHoraSalida__isnull=True
-                ).select_related('fkIdVehiculo').first()
-                if registro_activo:
-                    espacio.placa_actual = registro_activo.fkIdVehiculo.vehPlaca
-
-            espacio.reserva_proxima = reserva_proxima
-            espacio.pago_pendiente = pago_pendiente
-            espacios_list.append(espacio)
+            espacio.pago_pendiente = False
+            if espacio.espEstado == 'OCUPADO' and espacio.placa_turno is not None:
+                espacio.placa_actual = espacio.placa_turno
+                espacio.pago_pendiente = espacio.tiene_pago_pendiente
 
         piso.espacios_list = espacios_list
         pisos_list.append(piso)
     return pisos_list
+
+
+# ── Agregados para gráficas ─────────────────────────────────────────
+# El agrupado se hace en la BD con la zona horaria local (America/Bogota): Django
+# genera CONVERT_TZ en MySQL (requiere las tablas de zonas cargadas) y AT TIME ZONE en
+# PostgreSQL. Así el costo no depende de cuántos registros tenga el día o la semana.
+
+def rango_dia_local(dia):
+    """(inicio, fin) aware del día local `dia`, para filtrar con __range."""
+    return (
+        timezone.make_aware(datetime.combine(dia, datetime.min.time())),
+        timezone.make_aware(datetime.combine(dia, datetime.max.time())),
+    )
+
+
+def conteo_por_hora(qs, campo, horas):
+    """{hora local: cantidad de filas} para cada hora de `horas` (0 si no hay)."""
+    conteo = dict.fromkeys(horas, 0)
+    filas = qs.annotate(
+        hora=ExtractHour(campo, tzinfo=timezone.get_current_timezone())
+    ).values('hora').annotate(n=Count('pk')).order_by()
+    for fila in filas:
+        if fila['hora'] in conteo:
+            conteo[fila['hora']] = fila['n']
+    return conteo
+
+
+def suma_por_dia(qs, campo, valor, dias):
+    """{fecha local: suma de `valor`} para cada fecha de `dias` (0 si no hay)."""
+    sumas = dict.fromkeys(dias, 0)
+    filas = qs.annotate(
+        dia=TruncDate(campo, tzinfo=timezone.get_current_timezone())
+    ).values('dia').annotate(total=Sum(valor)).order_by()
+    for fila in filas:
+        if fila['dia'] in sumas:
+            sumas[fila['dia']] = float(fila['total'] or 0)
+    return sumas
+
+
+# ── Idempotencia de POSTs ────────────────────────────────────────────
+
+# Cuánto se recuerda la respuesta de una clave de idempotencia
+IDEMPOTENCIA_TTL = timedelta(hours=24)
+
+# Reserva de una petición que nunca guardó su respuesta (proceso caído a mitad): pasado
+# este tiempo otra petición con la misma clave puede ejecutarse
+IDEMPOTENCIA_EN_CURSO_TTL = timedelta(minutes=2)
+
+
+def _huella_idempotencia(request, clave):
+    """sha256 de usuario, ruta, clave y parámetros: la misma clave con otro formulario es otra operación."""
+    parametros = sorted(
+        (campo, valor) for campo, valores in request.POST.lists() for valor in valores
+        if campo not in ('csrfmiddlewaretoken', 'idempotency_key')
+    )
+    base = json.dumps([request.session.get('usuario_id'), request.path, clave, parametros])
+    return hashlib.sha256(base.encode()).hexdigest()
+
+
+def _reservar_idempotencia(huella):
+    """Reserva la huella para esta petición (None) o retorna la fila vigente de una anterior."""
+    ahora = timezone.now()
+    try:
+        with transaction.atomic():
+            RespuestaIdempotente.objects.create(idemHuella=huella, idemExpira=ahora + IDEMPOTENCIA_EN_CURSO_TTL)
+        return None
+    except IntegrityError:
+        pass
+    existente = RespuestaIdempotente.objects.filter(idemHuella=huella).first()
+    if existente is not None and existente.idemExpira >= ahora:
+        return existente
+    # Vencida: UPDATE condicional para que solo una de dos peticiones simultáneas la tome
+    if RespuestaIdempotente.objects.filter(idemHuella=huella, idemExpira__lt=ahora).update(
+        idemEstado=None, idemCuerpo='', idemCabeceras={}, idemMensajes=[],
+        idemExpira=ahora + IDEMPOTENCIA_EN_CURSO_TTL,
+    ):
+        return None
+    return RespuestaIdempotente.objects.filter(idemHuella=huella).first()
+
+
+def _guardar_idempotencia(request, huella, response):
+    if response.streaming:
+        RespuestaIdempotente.objects.filter(idemHuella=huella).delete()
+        return
+    # Mensajes flash que la respuesta no mostró (redirects): se repiten en cada reenvío.
+    # Recorrer el storage lo marca como usado; se desmarca para que igual se guarden.
+    storage = messages.get_messages(request)
+    pendientes = [] if storage.used else [[m.level, str(m.message)] for m in storage]
+    storage.used = False
+    cabeceras = {h: response[h] for h in ('Content-Type', 'Location') if response.has_header(h)}
+    RespuestaIdempotente.objects.filter(idemHuella=huella).update(
+        idemEstado=response.status_code,
+        idemCuerpo=response.content.decode(response.charset),
+        idemCabeceras=cabeceras,
+        idemMensajes=pendientes,
+        idemExpira=timezone.now() + IDEMPOTENCIA_TTL,
+    )
+
+
+class IdempotenteMixin:
+    """
+    Hace idempotentes los POST que traen clave: encabezado `Idempotency-Key` o campo
+    oculto `idempotency_key` (los templates usan la `clave_idempotencia` de su contexto).
+
+    La primera petición reserva la clave, ejecuta la vista y guarda la respuesta en
+    RespuestaIdempotente; las repeticiones (misma clave, usuario, ruta y parámetros)
+    reciben esa misma respuesta, con sus mensajes flash, sin tocar inventario, pagos ni
+    espacios. Si la original sigue en curso se redirige a `idempotencia_redirect` con un
+    aviso. Sin clave la vista se ejecuta como siempre.
+
+    Va después del mixin de acceso: una petición sin permisos nunca reserva claves.
+    """
+    idempotencia_redirect = 'dashboard'
+
+    def dispatch(self, request, *args, **kwargs):
+        clave = request.method == 'POST' and (
+            request.headers.get('Idempotency-Key') or request.POST.get('idempotency_key')
+        )
+        if not clave:
+            return super().dispatch(request, *args, **kwargs)  # type: ignore[misc]
+
+        huella = _huella_idempotencia(request, clave[:100])
+        guardada = _reservar_idempotencia(huella)
+        if guardada is not None:
+            if guardada.idemEstado is None:
+                messages.info(request, 'Tu solicitud anterior todavía se está procesando.')
+                return redirect(self.idempotencia_redirect)
+            for nivel, texto in guardada.idemMensajes:
+                messages.add_message(request, nivel, texto)
+            if 'Location' in guardada.idemCabeceras:
+                response = HttpResponseRedirect(guardada.idemCabeceras['Location'])
+                response.status_code = guardada.idemEstado
+                return response
+            return HttpResponse(
+                guardada.idemCuerpo, status=guardada.idemEstado,
+                content_type=guardada.idemCabeceras.get('Content-Type'),
+            )
+
+        try:
+            response = super().dispatch(request, *args, **kwargs)  # type: ignore[misc]
+        except Exception:
+            # Sin respuesta que guardar: se libera la clave para que el reintento se ejecute
+            RespuestaIdempotente.objects.filter(idemHuella=huella).delete()
+            raise
+        _guardar_idempotencia(request, huella, response)
+        return response
+
+
+# ── QR firmado por espacio ───────────────────────────────────────────
+
+_SAL_QR_ESPACIO = 'parqueadero.qr_espacio'
+
+
+def firmar_qr_espacio(espacio_pk):
+    """
+    Token "<pk>:<firma>" del QR impreso en el espacio. No vence (el QR queda pegado en
+    el puesto); cambiar SECRET_KEY invalida todas las hojas y hay que reimprimirlas.
+    """
+    return signing.Signer(salt=_SAL_QR_ESPACIO).sign(str(espacio_pk))
+
+
+def leer_qr_espacio(token):
+    """PK del espacio de un token de firmar_qr_espacio, o None si la firma no es válida."""
+    try:
+        return int(signing.Signer(salt=_SAL_QR_ESPACIO).unsign(token))
+    except (signing.BadSignature, ValueError):
+        return None
@@ -1,17 +1,21 @@
 import math
-import re
+import uuid
 
+from django.conf import settings
 from django.contrib import messages
 from datetime import timedelta
-from django.db import transaction
 from django.db.models import Count, Q, Sum
 from django.shortcuts import get_object_or_404, redirect, render
-from django.http import JsonResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.http import Http404, HttpResponse, JsonResponse
+from django.utils.cache import quote_etag
+from django.utils.decorators import method_decorator
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
 from django.views import View
 from django.utils import timezone
-import json
 
-from multiparking import email_utils
 from reservas.models import Reserva
 from usuarios.mixins import AdminRequiredMixin
 from usuarios.models import Usuario
@@ -19,9 +23,18 @@ from pagos.models import Pago
 from tarifas.models import Tarifa
 from cupones.models import CuponAplicado
 
-from .models import Espacio, Piso, TipoEspacio, InventarioParqueo
-from .services import calcular_costo_parqueo
-from .utils import _calcular_pisos_data
+from .models import (
+    ContadorEspacios, Espacio, Piso, TipoEspacio, InventarioParqueo, RetencionEspacio, VersionParqueadero,
+)
+from .services import (
+    IngresoRechazado, calcular_costo_parqueo, registrar_ingreso, registrar_salida, vehiculo_para_ingreso,
+)
+from .utils import (
+    MAPA_FRAGMENTO_TTL, IdempotenteMixin, _calcular_pisos_data, conteo_por_hora, etag_detalle, etag_tablero,
+    firmar_qr_espacio, leer_qr_espacio,
+    obtener_delta_para, obtener_snapshot, pool_espacios, rango_dia_local, respuesta_stream, revision_vigente,
+    serializar_pisos, suma_por_dia, vuelo_unico,
+)
 from vehiculos.models import Vehiculo
 
 # ── Dashboard ────────────────────────────────────────────────────
@@ -29,146 +42,159 @@ from vehiculos.models import Vehiculo
 
 # ── Dashboard ────────────────────────────────────────────────────
 class AdminDashboardView(AdminRequiredMixin, View):
+    """
+    Shell del dashboard: solo los KPIs (contadores, 2 queries). El mapa de pisos, las
+    gráficas y las reservas recientes los pide el navegador después a sus propios
+    endpoints (AdminDashboardMapaView, ...GraficasView, ...ReservasView), cada uno con
+    su caché: un panel lento ya no retrasa el primer byte de la página.
+    """
     def get(self, request):
-        total = Espacio.objects.count()
-        ocupados = Espacio.objects.filter(espEstado='OCUPADO').count()
-        disponibles = Espacio.objects.filter(espEstado='DISPONIBLE').count()
-        reservas_activas = Reserva.objects.filter(
+        return render(request, 'admin_panel/dashboard.html', {
+            'active_page': 'dashboard',
+            **_kpis_dashboard_admin(),
+            'clave_idempotencia': uuid.uuid4().hex,
+            'dashboard_sse': settings.DASHBOARD_SSE,
+        })
+
+
+# ── Dashboard API (auto-refresh) ──────────────────────────────────
+def _kpis_dashboard_admin():
+    totales = ContadorEspacios.totales()
+    return {
+        'total_espacios': sum(totales.values()),
+        'disponibles': totales['DISPONIBLE'],
+        'ocupados': totales['OCUPADO'],
+        'reservas_activas': Reserva.objects.filter(
             resEstado__in=['PENDIENTE', 'CONFIRMADA']
-        ).count()
-        now = timezone.now()
-        pisos_list = _calcular_pisos_data(now)
+        ).count(),
+    }
+
+
+def _payload_dashboard_admin(now):
+    """Estado del dashboard admin serializable a JSON (KPIs + mapa de pisos)."""
+    return {
+        **_kpis_dashboard_admin(),
+        'pisos': serializar_pisos(_calcular_pisos_data(now)),
+    }
+
+
+def _panel_graficas_admin(now):
+    """Series de las gráficas: ingresos de los últimos 7 días y entradas por hora hoy."""
+    hoy_local = timezone.localtime(now).date()
+    hace_7_dias = hoy_local - timedelta(days=6)
+
+    # Usar __range con datetimes para compatibilidad con MySQL + timezones;
+    # la suma por día local se agrupa en la BD (una fila por día, no por pago)
+    dias = [hace_7_dias + timedelta(days=d) for d in range(7)]
+    pagos_semana = Pago.objects.filter(
+        pagFechaPago__range=(rango_dia_local(hace_7_dias)[0], rango_dia_local(hoy_local)[1]),
+        pagEstado='PAGADO',
+    )
+    ingresos_por_dia = suma_por_dia(pagos_semana, 'pagFechaPago', 'pagMonto', dias)
+    dias_semana = ['Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb', 'Dom']
+
+    # Tendencias de ocupación: ingresos del día agrupados por hora local en la BD
+    counts_por_hora = conteo_por_hora(
+        InventarioParqueo.objects.filter(parHoraEntrada__range=rango_dia_local(hoy_local)),
+        'parHoraEntrada', range(6, 23),
+    )
+    return {
+        'ingresos_labels': [f"{dias_semana[dia.weekday()]} {dia.day}" for dia in dias],
+        'ingresos_data': [ingresos_por_dia[dia] for dia in dias],
+        'ocupacion_labels': [f"{h}:00" for h in counts_por_hora],
+        'ocupacion_data': list(counts_por_hora.values()),
+    }
+
+
+def _panel_reservas_admin(now):
+    """Tabla de las 5 reservas más recientes, ya renderizada."""
+    reservas_recientes = Reserva.objects.select_related(
+        'fkIdVehiculo__fkIdUsuario', 'fkIdEspacio__fkIdPiso'
+    ).order_by('-resFechaReserva', '-resHoraInicio')[:5]
+    return {
+        'html': render_to_string('admin_panel/partials/reservas_recientes.html', {
+            'reservas_recientes': reservas_recientes,
+        }),
+    }
 
-        # ── DATOS PARA GRÁFICOS Y TABLAS ──
-        
-        # 1. Tabla de Reservas Recientes
-        reservas_recientes = Reserva.objects.select_related(
-            'fkIdVehiculo__fkIdUsuario', 'fkIdEspacio__fkIdPiso'
-        ).order_by('-resFechaReserva', '-resHoraInicio')[:5]
 
-        # 2. Ingresos Últimos 7 Días
-        now = timezone.now()
-        hoy_local = timezone.localtime(now).date()
-        hace_7_dias = hoy_local - timedelta(days=6)
+@method_decorator(condition(etag_func=lambda request: revision_vigente('admin')), name='get')
+class AdminDashboardMapaView(AdminRequiredMixin, View):
+    """
+    Panel del mapa de pisos (HTML) + la versión del snapshot del que sale. El JS arranca
+    el auto-refresh (stream/polling con `since=`) desde esa versión.
+    """
+    def get(self, request):
+        snapshot = obtener_snapshot('admin', _payload_dashboard_admin)
+        response = JsonResponse({
+            'version': snapshot['version'],
+            'html': render_to_string('admin_panel/partials/mapa_pisos.html', {
+                'pisos': snapshot['pisos'],
+                'version': snapshot['version'],
+                'mapa_ttl': MAPA_FRAGMENTO_TTL,
+            }, request=request),
+        })
+        response['ETag'] = quote_etag(snapshot['version'])
+        return response
 
-        # Usar __range con datetimes para compatibilidad con MySQL + timezones
-        from datetime import datetime
-        inicio_rango = timezone.make_aware(datetime.combine(hace_7_dias, datetime.min.time()))
-        fin_rango = timezone.make_aware(datetime.combine(hoy_local, datetime.max.time()))
 
-        pagos_semana = Pago.objects.filter(
-            pagFechaPago__range=(inicio_rango, fin_rango),
-            pagEstado='PAGADO',
-        )
+class AdminDashboardGraficasView(AdminRequiredMixin, View):
+    """Panel de gráficas; cacheado por VersionParqueadero (obtener_snapshot)."""
+    def get(self, request):
+        return JsonResponse(obtener_snapshot('admin:graficas', _panel_graficas_admin))
 
-        # Acumula montos por día en un dict para no hacer 7 queries separados
-        ingresos_por_dia = {}
-        for d in range(7):
-            dia = hace_7_dias + timedelta(days=d)
-            ingresos_por_dia[dia] = 0
-
-        for p in pagos_semana:
-            dia_pago = timezone.localtime(p.pagFechaPago).date()
-            if dia_pago in ingresos_por_dia:
-                ingresos_por_dia[dia_pago] += float(p.pagMonto)
-
-        dias_semana = ['Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb', 'Dom']
-        ingresos_labels = []
-        ingresos_valores = []
-        for dia in sorted(ingresos_por_dia.keys()):
-            ingresos_labels.append(f"{dias_semana[dia.weekday()]} {dia.day}")
-            ingresos_valores.append(ingresos_por_dia[dia])
-
-        ingresos_data = json.dumps(ingresos_valores)
-        ingresos_labels_json = json.dumps(ingresos_labels)
-
-        # 3. Tendencias de Ocupación (Por hora hoy) - TIMEZONE AWARE
-        ocupacion_data = []
-        labels_horas = []
-        
-        # Optimización: trae todos los registros del día en una sola query y cuenta por hora en Python (evita 17 queries)
-        registros_hoy = InventarioParqueo.objects.filter(
-            parHoraEntrada__range=(
-                timezone.make_aware(timezone.datetime.combine(hoy_local, timezone.datetime.min.time())),
-                timezone.make_aware(timezone.datetime.combine(hoy_local, timezone.datetime.max.time()))
-            )
-        )
-        
-        counts_por_hora = {h: 0 for h in range(6, 23)}
-        for r in registros_hoy:
-            h = timezone.localtime(r.parHoraEntrada).hour
-            if 6 <= h < 23:
-                counts_por_hora[h] += 1
-                
-        for h in range(6, 23):
-            labels_horas.append(f"{h}:00")
-            ocupacion_data.append(counts_por_hora[h])
 
-        return render(request, 'admin_panel/dashboard.html', {
-            'active_page': 'dashboard',
-            'total_espacios': total,
-            'disponibles': disponibles,
-            'ocupados': ocupados,
-            'reservas_activas': reservas_activas,
-            'pisos': pisos_list,
-            'reservas_recientes': reservas_recientes,
-            'ingresos_data': ingresos_data,
-            'ingresos_labels': ingresos_labels_json,
-            'ocupacion_data': json.dumps(ocupacion_data),
-            'ocupacion_labels': json.dumps(labels_horas),
-        })
+class AdminDashboardReservasView(AdminRequiredMixin, View):
+    """Panel de reservas recientes; cacheado por VersionParqueadero (obtener_snapshot)."""
+    def get(self, request):
+        return JsonResponse(obtener_snapshot('admin:reservas', _panel_reservas_admin))
 
 
-# ── Dashboard API (auto-refresh) ──────────────────────────────────
+@method_decorator(condition(etag_func=lambda request: etag_tablero(request, 'admin', _payload_dashboard_admin)), name='get')
+@method_decorator(gzip_page, name='get')
 class AdminDashboardDataView(AdminRequiredMixin, View):
-    """Devuelve el estado actual del dashboard en JSON para auto-refresh."""
+    """
+    Devuelve el estado actual del dashboard en JSON para auto-refresh.
+    El payload se cachea por VersionParqueadero: los refrescos sin cambios entre
+    medio no recalculan nada. Con `?since=<version>` solo se envía lo que cambió
+    (ver obtener_delta). La ETag es la revisión del snapshot + formato (etag_tablero):
+    con If-None-Match vigente se responde 304 sin tocar las queries del payload. Va
+    fuera de gzip para que la respuesta comprimida no la reciba debilitada (W/).
+    `?formato=compacto` entrega el mapa columnar (obtener_delta_compacto); gzip si el
+    cliente lo acepta.
+    """
     def get(self, request):
-        total = Espacio.objects.count()
-        ocupados = Espacio.objects.filter(espEstado='OCUPADO').count()
-        disponibles = Espacio.objects.filter(espEstado='DISPONIBLE').count()
-        reservas_activas = Reserva.objects.filter(
-            resEstado__in=['PENDIENTE', 'CONFIRMADA']
-        ).count()
+        return JsonResponse(obtener_delta_para(request, 'admin', _payload_dashboard_admin))
 
-        now = timezone.now()
-        pisos_list = _calcular_pisos_data(now)
-
-        pisos_data = []
-        for piso in pisos_list:
-            espacios_data = [{
-                'pk': espacio.pk,
-                'espNumero': espacio.espNumero,
-                'espEstado': espacio.espEstado,
-                'pago_pendiente': espacio.pago_pendiente,
-                'reserva_pk': espacio.reserva_proxima.pk if espacio.reserva_proxima else None,
-                'placa_actual': espacio.placa_actual,
-            } for espacio in piso.espacios_list]
-            pisos_data.append({
-                'pk': piso.pk,
-                'pisNombre': piso.pisNombre,
-                'total_espacios': piso.total_espacios,
-                'ocupados_espacios': piso.ocupados_espacios,
-                'ocupacion_pct': piso.ocupacion_pct,
-                'espacios': espacios_data,
-            })
 
-        return JsonResponse({
-            'total_espacios': total,
-            'disponibles': disponibles,
-            'ocupados': ocupados,
-            'reservas_activas': reservas_activas,
-            'pisos': pisos_data,
-        })
+class AdminDashboardStreamView(AdminRequiredMixin, View):
+    """
+    Stream SSE con los cambios del dashboard (mismo formato que AdminDashboardDataView).
+    Con DASHBOARD_SSE reemplaza el polling cada 10s: el navegador recibe los cambios
+    apenas confirman.
+    """
+    def get(self, request):
+        return respuesta_stream(request, 'admin', _payload_dashboard_admin)
+
+
+class AdminDashboardMetricasView(AdminRequiredMixin, View):
+    """
+    Contadores de este proceso: single-flight de los dashboards (cálculos ahorrados) y
+    pool de espacios libres (reclamos, candidatos descartados por desactualizados, recargas).
+    """
+    def get(self, request):
+        return JsonResponse({**vuelo_unico.metricas(), 'pool_espacios': pool_espacios.metricas()})
 
 
 # ── Pisos CRUD ───────────────────────────────────────────────────
 class PisoListView(AdminRequiredMixin, View):
     def get(self, request):
-        pisos = Piso.objects.annotate(
-            total=Count('espacios'),
-            ocupados=Count('espacios', filter=Q(espacios__espEstado='OCUPADO')),
-        ).order_by('pk')
+        pisos = Piso.objects.order_by('pk')
+        contadores = ContadorEspacios.por_piso()
         for p in pisos:
+            estados = contadores.get(p.pk, {})
+            p.total = sum(estados.values())
+            p.ocupados = estados.get('OCUPADO', 0)
             p.libres = p.total - p.ocupados
             p.porcentaje = round(p.ocupados * 100 / p.total) if p.total else 0
         return render(request, 'admin_panel/pisos/list.html', {
@@ -221,6 +247,7 @@ class PisoUpdateView(AdminRequiredMixin, View):
         piso.pisNombre = nombre
         piso.pisEstado = estado
         piso.save()
+        VersionParqueadero.incrementar()
         messages.success(request, 'Piso actualizado exitosamente.')
         return redirect('admin_pisos')
 
@@ -232,6 +259,7 @@ class PisoDeleteView(AdminRequiredMixin, View):
             messages.error(request, 'No se puede eliminar: tiene espacios ocupados.')
             return redirect('admin_pisos')
         piso.delete()
+        VersionParqueadero.incrementar()
         messages.success(request, 'Piso eliminado.')
         return redirect('admin_pisos')
 
@@ -345,11 +373,11 @@ class EspacioListView(AdminRequiredMixin, View):
         if estado:
             qs = qs.filter(espEstado=estado)
 
-        all_espacios = Espacio.objects.all()
-        total = all_espacios.count()
-        disponibles = all_espacios.filter(espEstado='DISPONIBLE').count()
-        ocupados = all_espacios.filter(espEstado='OCUPADO').count()
-        inactivos = all_espacios.filter(espEstado='INACTIVO').count()
+        totales = ContadorEspacios.totales()
+        total = sum(totales.values())
+        disponibles = totales['DISPONIBLE']
+        ocupados = totales['OCUPADO']
+        inactivos = totales['INACTIVO']
 
         return render(request, 'admin_panel/espacios/list.html', {
             'active_page': 'espacios',
@@ -400,6 +428,7 @@ class EspacioCreateView(AdminRequiredMixin, View):
             fkIdTipoEspacio_id=tipo_id,
             espEstado=estado,
         )
+        VersionParqueadero.incrementar()
         messages.success(request, 'Espacio creado exitosamente.')
         return redirect('admin_espacios')
 
@@ -433,6 +462,7 @@ class EspacioUpdateView(AdminRequiredMixin, View):
             })
 
         espacio.save()
+        VersionParqueadero.incrementar()
         messages.success(request, 'Espacio actualizado.')
         return redirect('admin_espacios')
 
@@ -444,6 +474,7 @@ class EspacioDeleteView(AdminRequiredMixin, View):
             messages.error(request, 'No se puede eliminar un espacio ocupado.')
             return redirect('admin_espacios')
         espacio.delete()
+        VersionParqueadero.incrementar()
         messages.success(request, 'Espacio eliminado.')
         return redirect('admin_espacios')
 
@@ -506,11 +537,15 @@ class EspacioRangeCreateView(AdminRequiredMixin, View):
                 )
                 creados += 1
 
+        if creados:
+            VersionParqueadero.incrementar()
         messages.success(request, f'{creados} espacios creados exitosamente.')
         return redirect('admin_espacios')
 
 # ── Ingreso Rápido (Visitantes/Usuarios) ─────────────────────────
-class RegistrarIngresoView(AdminRequiredMixin, View):
+class RegistrarIngresoView(AdminRequiredMixin, IdempotenteMixin, View):
+    idempotencia_redirect = 'admin_dashboard'
+
     def post(self, request):
         placa = request.POST.get('placa', '').upper().strip()
         espacio_id = request.POST.get('espacio_id')
@@ -523,53 +558,15 @@ class RegistrarIngresoView(AdminRequiredMixin, View):
             messages.error(request, 'Placa y Espacio son obligatorios.')
             return redirect(redirect_url)
 
-        if not re.match(r'^[A-Za-z0-9-]+$', placa):
-            messages.error(request, 'La placa solo acepta letras, números y guiones.')
-            return redirect(redirect_url)
-
-        if nombre and not re.match(r'^[a-zA-ZáéíóúÁÉÍÓÚñÑ\s]+$', nombre):
-            messages.error(request, 'El nombre solo debe contener letras.')
-            return redirect(redirect_url)
-
-        if telefono and not re.match(r'^[0-9]+$', telefono):
-            messages.error(request, 'El teléfono solo debe contener números.')
-            return redirect(redirect_url)
-
-        # 1. Validar Espacio
-        espacio = get_object_or_404(Espacio, pk=espacio_id)
-        if espacio.espEstado != 'DISPONIBLE':
-            messages.error(request, f'El espacio {espacio.espNumero} no está disponible.')
+        # Validación, vehículo, doble ingreso, reclamo del espacio y registro en un solo paso
+        try:
+            vehiculo = vehiculo_para_ingreso(placa, nombre, telefono)
+            nuevo_registro = registrar_ingreso(vehiculo, espacio_id=espacio_id)
+        except IngresoRechazado as e:
+            messages.error(request, str(e))
             return redirect(redirect_url)
 
-        # 2. Buscar/Crear Vehículo
-        vehiculo = Vehiculo.objects.filter(vehPlaca=placa).first()
-        if not vehiculo:
-            vehiculo = Vehiculo.objects.create(
-                vehPlaca=placa,
-                vehTipo='Carro',
-                nombre_contacto=nombre,
-                telefono_contacto=telefono
-            )
-        else:
-            if vehiculo.es_visitante and (nombre or telefono):
-                if nombre: vehiculo.nombre_contacto = nombre
-                if telefono: vehiculo.telefono_contacto = telefono
-                vehiculo.save()
-
-        # 3. Verificar si ya tiene un ingreso activo (doble check)
-        if InventarioParqueo.objects.filter(fkIdVehiculo=vehiculo, parHoraSalida__isnull=True).exists():
-             messages.error(request, f'El vehículo {placa} ya tiene un ingreso activo.')
-             return redirect(redirect_url)
-
-        with transaction.atomic():
-            nuevo_registro = InventarioParqueo.objects.create(
-                fkIdVehiculo=vehiculo,
-                fkIdEspacio=espacio
-            )
-            espacio.ocupar()
-
-        email_utils.enviar_confirmacion_entrada(nuevo_registro)
-        messages.success(request, f'Ingreso registrado para {placa} en {espacio.espNumero}.')
+        messages.success(request, f'Ingreso registrado para {placa} en {nuevo_registro.fkIdEspacio.espNumero}.')
         return redirect(redirect_url)
 
 
@@ -590,6 +587,7 @@ class BuscarVehiculoView(AdminRequiredMixin, View):
         return JsonResponse({'found': False})
 
 
+@method_decorator(condition(etag_func=etag_detalle), name='get')
 class ObtenerDetalleOcupacionView(AdminRequiredMixin, View):
     def get(self, request):
         espacio_id = request.GET.get('espacio_id')
@@ -616,17 +614,17 @@ class ObtenerDetalleOcupacionView(AdminRequiredMixin, View):
                 espacio = registro.fkIdEspacio
             else:
                 # Viene del Dashboard
-                espacio = get_object_or_404(Espacio, pk=espacio_id)
-                registro = InventarioParqueo.objects.select_related(
-                    'fkIdVehiculo', 'fkIdVehiculo__fkIdUsuario',
-                    'fkIdEspacio__fkIdPiso', 'fkIdEspacio__fkIdTipoEspacio'
-                ).filter(
-                    fkIdEspacio=espacio,
-                    parHoraSalida__isnull=True
-                ).first()
+                espacio = get_object_or_404(
+                    Espacio.objects.select_related(
+                        'fkIdPiso', 'fkIdTipoEspacio', 'fkIdParqueoActual__fkIdVehiculo__fkIdUsuario',
+                    ),
+                    pk=espacio_id,
+                )
+                registro = espacio.fkIdParqueoActual
 
                 if not registro:
                     return JsonResponse({'found': False, 'error': 'No hay registro activo'})
+                registro.fkIdEspacio = espacio
 
             ahora = timezone.now()
             entrada = registro.parHoraEntrada
@@ -736,75 +734,38 @@ class RegistrarSalidaView(AdminRequiredMixin, View):
         # Determinar de dónde viene la solicitud y obtener el registro
         if registro_id:
             # Viene del Inventario - tenemos el registro directamente
-            registro = get_object_or_404(InventarioParqueo, pk=registro_id, parHoraSalida__isnull=True)
-            espacio = registro.fkIdEspacio
+            registro = get_object_or_404(
+                InventarioParqueo.objects.select_related('fkIdVehiculo', 'fkIdEspacio'),
+                pk=registro_id, parHoraSalida__isnull=True,
+            )
         elif espacio_id:
             # Viene del Dashboard - buscamos por espacio
-            espacio = get_object_or_404(Espacio, pk=espacio_id)
+            espacio = get_object_or_404(
+                Espacio.objects.select_related('fkIdParqueoActual__fkIdVehiculo'), pk=espacio_id,
+            )
             if espacio.espEstado != 'OCUPADO':
                 messages.error(request, f'El espacio {espacio.espNumero} no está ocupado.')
                 return redirect('admin_dashboard')
 
-            # Buscar Registro Activo
-            registro = InventarioParqueo.objects.filter(
-                fkIdEspacio=espacio,
-                parHoraSalida__isnull=True
-            ).first()
+            # Registro activo: el puntero del espacio, sin buscar en el inventario
+            registro = espacio.fkIdParqueoActual
 
             if not registro:
                 espacio.liberar()
                 messages.warning(request, f'Espacio {espacio.espNumero} liberado (no se encontró registro activo).')
                 return redirect('admin_dashboard')
+            registro.fkIdEspacio = espacio
         else:
             messages.error(request, 'Datos inválidos.')
             return redirect('admin_dashboard')
 
-        ahora = timezone.now()
-        pago_a_notificar = None
-
-        with transaction.atomic():
-            # 3. Registrar salida
-            registro.parHoraSalida = ahora
-            registro.save()
-
-            # 4. Lógica de Pago
-            pago_existente = Pago.objects.filter(
-                fkIdParqueo=registro,
-                pagEstado='PENDIENTE'
-            ).first()
-
-            if pago_existente:
-                pago_existente.pagEstado = 'PAGADO'
-                pago_existente.save()
-                monto_pagado = pago_existente.pagMonto
-                if not registro.fkIdVehiculo.es_visitante:
-                    pago_a_notificar = pago_existente
-            else:
-                tarifa = Tarifa.get_active_for(espacio.fkIdTipoEspacio)
-
-                monto_pagado = 0
-
-                if tarifa:
-                    vehiculo = registro.fkIdVehiculo
-                    monto_pagado = calcular_costo_parqueo(registro.parHoraEntrada, tarifa, vehiculo, ahora)
-
-                    nuevo_pago = Pago.objects.create(
-                        pagMonto=monto_pagado,
-                        pagMetodo='EFECTIVO',
-                        pagEstado='PAGADO',
-                        fkIdParqueo=registro
-                    )
-
-                    if not registro.fkIdVehiculo.es_visitante:
-                        pago_a_notificar = nuevo_pago
+        # Cierre, cobro, sticker y liberación del espacio en un solo paso
+        resultado = registrar_salida(registro)
+        if resultado is None:
+            messages.error(request, f'La salida de {registro.fkIdVehiculo.vehPlaca} ya fue registrada.')
+            return redirect('admin_inventario' if registro_id else 'admin_dashboard')
 
-            # 5. Actualizar Espacio
-            espacio.liberar()
-
-        if pago_a_notificar:
-            email_utils.enviar_recibo_pago(pago_a_notificar, registro)
-
-        msg_pago = f" Pago registrado: ${monto_pagado:,.0f}" if monto_pagado > 0 else ""
+        msg_pago = f" Pago registrado: ${resultado.monto:,.0f}" if resultado.monto > 0 else ""
         messages.success(request, f'Salida registrada para {registro.fkIdVehiculo.vehPlaca}.{msg_pago}')
 
         # Redirect según de dónde vino la solicitud
@@ -857,6 +818,7 @@ class InventarioListView(AdminRequiredMixin, View):
             'espacios_disponibles': Espacio.objects.filter(
                 espEstado='DISPONIBLE'
             ).select_related('fkIdPiso').order_by('fkIdPiso__pisNombre', 'espNumero'),
+            'clave_idempotencia': uuid.uuid4().hex,
         })
 
 
@@ -892,41 +854,51 @@ class EntradaParqueaderoView(ClienteRequiredMixin, View):
             return redirect('dashboard')
 
         now = timezone.now()
-        hoy = now.date()
+        hoy = timezone.localtime(now).date()
 
         # Cancelar reservas vencidas (más de 15 minutos después de la hora de inicio)
-        from datetime import datetime
-        reservas_vencidas = Reserva.objects.filter(
-            resFechaReserva=hoy,
-            resEstado__in=['PENDIENTE', 'CONFIRMADA']
-        )
-
-        for reserva in reservas_vencidas:
-            fecha_hora_inicio = datetime.combine(reserva.resFechaReserva, reserva.resHoraInicio)
-            fecha_hora_inicio = timezone.make_aware(fecha_hora_inicio)
-            tiempo_desde_inicio = now - fecha_hora_inicio
-
-            # Si pasaron más de 15 minutos desde la hora de inicio, cancelar
-            if tiempo_desde_inicio > timedelta(minutes=15) and tiempo_desde_inicio < timedelta(hours=24):
-                reserva.resEstado = 'CANCELADA'
-                reserva.save()
+        # y liberar sus espacios
+        Reserva.cancelar_vencidas()
 
         # Buscar reserva activa del usuario para hoy
         reserva_hoy = Reserva.objects.filter(
             fkIdVehiculo__fkIdUsuario=usuario,
-            resFechaReserva=hoy,
+            resInicio__range=rango_dia_local(hoy),
             resEstado__in=['PENDIENTE', 'CONFIRMADA']
         ).select_related('fkIdVehiculo', 'fkIdEspacio__fkIdPiso').first()
 
         # Obtener vehículos activos del usuario
-        vehiculos = Vehiculo.objects.filter(
+        vehiculos = list(Vehiculo.objects.filter(
             fkIdUsuario=usuario,
             vehEstado=True
+        ).order_by('pk'))
+
+        # Sin reserva: apartar ya un espacio para el vehículo elegido (?vehiculo=, o el
+        # primero), para que no se lo gane otra entrada mientras confirma frente a la
+        # barrera. Solo uno por cliente: si cambió de vehículo se suelta el del otro tipo
+        RetencionEspacio.liberar_vencidas()
+        retencion = None
+        seleccionado = next(
+            (v for v in vehiculos if str(v.pk) == request.GET.get('vehiculo')),
+            vehiculos[0] if vehiculos else None,
         )
+        if reserva_hoy is None and seleccionado is not None:
+            tipo_nombre = 'Moto' if seleccionado.vehTipo == 'Moto' else 'Carro'
+            tipo_id = TipoEspacio.objects.filter(nombre=tipo_nombre).values_list('pk', flat=True).first()
+            RetencionEspacio.soltar(list(RetencionEspacio.objects.filter(
+                fkIdUsuario=usuario,
+            ).exclude(fkIdEspacio__fkIdTipoEspacio_id=tipo_id)))
+            if tipo_id is not None:
+                retencion = RetencionEspacio.retener(usuario, tipo_id)
+            if retencion is not None:
+                retencion.tipo_nombre = tipo_nombre
 
         return render(request, 'cliente/entrada_qr.html', {
             'reserva': reserva_hoy,
             'vehiculos': vehiculos,
+            'seleccionado': seleccionado,
+            'retencion': retencion,
+            'retencion_minutos': int(RetencionEspacio.DURACION.total_seconds() // 60),
         })
 
     def post(self, request):
@@ -934,29 +906,19 @@ class EntradaParqueaderoView(ClienteRequiredMixin, View):
         usuario = Usuario.objects.get(pk=usuario_id)
 
         now = timezone.now()
-        hoy = now.date()
+        hoy = timezone.localtime(now).date()
 
         # Buscar reserva activa del usuario para hoy
-        from datetime import datetime
         reserva_hoy = Reserva.objects.filter(
             fkIdVehiculo__fkIdUsuario=usuario,
-            resFechaReserva=hoy,
+            resInicio__range=rango_dia_local(hoy),
             resEstado__in=['PENDIENTE', 'CONFIRMADA']
         ).select_related('fkIdVehiculo', 'fkIdEspacio').first()
 
-        # Determinar el vehículo y espacio
+        # Determinar el vehículo (el espacio lo reclama el servicio de ingreso)
         if reserva_hoy:
             # Usuario tiene reserva - usar vehículo y espacio de la reserva
             vehiculo = reserva_hoy.fkIdVehiculo
-            espacio = reserva_hoy.fkIdEspacio
-
-            # Verificar que el espacio esté disponible
-            if espacio.espEstado != 'DISPONIBLE':
-                messages.error(
-                    request,
-                    f'El espacio reservado {espacio.espNumero} no está disponible. Contacta al administrador.'
-                )
-                return redirect('entrada_parqueadero')
         else:
             # Usuario NO tiene reserva - debe seleccionar vehículo y buscar espacio disponible
             vehiculo_id = request.POST.get('vehiculo_id')
@@ -975,41 +937,104 @@ class EntradaParqueaderoView(ClienteRequiredMixin, View):
                 messages.error(request, 'Vehículo no válido.')
                 return redirect('entrada_parqueadero')
 
-            # Buscar espacio disponible según el tipo de vehículo
-            if vehiculo.vehTipo == 'Moto':
-                tipo_nombre = 'Moto'
-            else:  # Carro
-                tipo_nombre = 'Carro'
-
-            espacio = Espacio.objects.filter(
-                espEstado='DISPONIBLE',
-                fkIdTipoEspacio__nombre=tipo_nombre
-            ).select_related('fkIdPiso').order_by('fkIdPiso__id', 'espNumero').first()
-
-            if not espacio:
-                messages.error(
-                    request,
-                    f'Lo sentimos, no hay espacios disponibles para {tipo_nombre} en este momento. Por favor intenta más tarde.'
-                )
-                return redirect('entrada_parqueadero')
+        # Retenciones que apartó el GET: la del tipo del vehículo se convierte en el turno
+        tokens = request.POST.getlist('retencion')
+        retenciones = list(RetencionEspacio.objects.filter(
+            retToken__in=tokens, fkIdUsuario=usuario,
+        ).select_related('fkIdEspacio__fkIdTipoEspacio')) if tokens else []
+        tipo_nombre = 'Moto' if vehiculo.vehTipo == 'Moto' else 'Carro'
+        retencion = None
+        if reserva_hoy is None:
+            retencion = next(
+                (r for r in retenciones if r.fkIdEspacio.fkIdTipoEspacio.nombre == tipo_nombre), None,
+            )
+
+        # Reclamo atómico: dos escaneos simultáneos del QR reciben espacios distintos
+        try:
+            nuevo_registro = registrar_ingreso(vehiculo, reserva=reserva_hoy, retencion=retencion)
+        except IngresoRechazado as e:
+            messages.error(request, str(e))
+            return redirect('entrada_parqueadero')
+        espacio = nuevo_registro.fkIdEspacio
+        # Las demás (otro tipo de vehículo) vuelven al pool sin esperar a que venzan
+        RetencionEspacio.soltar([r for r in retenciones if r is not retencion])
 
-        with transaction.atomic():
-            nuevo_registro = InventarioParqueo.objects.create(
-                parHoraEntrada=now,
-                fkIdEspacio=espacio,
-                fkIdVehiculo=vehiculo
+        return render(request, 'cliente/entrada_exitosa.html', {
+            'vehiculo': vehiculo,
+            'espacio': espacio,
+            'hora_entrada': timezone.localtime(nuevo_registro.parHoraEntrada).strftime('%I:%M %p'),
+            'es_reserva': reserva_hoy is not None,
+        })
+
+
+class EntradaEspacioView(ClienteRequiredMixin, View):
+    """
+    Entrada escaneando el QR firmado de un espacio (modo QR_POR_ESPACIO): el ingreso
+    va directo a ese espacio. Basta la verificación de la firma y una lectura por PK;
+    el reclamo es el mismo Espacio.reclamar de la portería, sin pasar por el pool.
+    """
+
+    def _espacio(self, token):
+        espacio_pk = leer_qr_espacio(token) if settings.QR_POR_ESPACIO else None
+        if espacio_pk is None:
+            raise Http404('QR de espacio no válido.')
+        return get_object_or_404(Espacio.objects.select_related('fkIdPiso', 'fkIdTipoEspacio'), pk=espacio_pk)
+
+    def _vehiculos(self, usuario_id, espacio):
+        # Solo los vehículos que caben en el espacio (misma regla de tipo que registrar_ingreso)
+        vehiculos = Vehiculo.objects.filter(fkIdUsuario_id=usuario_id, vehEstado=True)
+        if espacio.fkIdTipoEspacio.nombre == 'Moto':
+            return vehiculos.filter(vehTipo='Moto')
+        return vehiculos.exclude(vehTipo='Moto')
+
+    def get(self, request, token):
+        espacio = self._espacio(token)
+        return render(request, 'cliente/entrada_espacio.html', {
+            'espacio': espacio,
+            'vehiculos': self._vehiculos(request.session['usuario_id'], espacio),
+        })
+
+    def post(self, request, token):
+        espacio = self._espacio(token)
+        usuario_id = request.session['usuario_id']
+
+        try:
+            vehiculo = self._vehiculos(usuario_id, espacio).get(pk=request.POST.get('vehiculo_id') or 0)
+        except Vehiculo.DoesNotExist:
+            messages.error(request, 'Debes seleccionar un vehículo válido para este espacio.')
+            return redirect('entrada_espacio', token=token)
+
+        # Una reserva de hoy en otro espacio se atiende por la entrada general
+        hoy = timezone.localtime().date()
+        reserva_hoy = Reserva.objects.filter(
+            fkIdVehiculo__fkIdUsuario_id=usuario_id,
+            resInicio__range=rango_dia_local(hoy),
+            resEstado__in=['PENDIENTE', 'CONFIRMADA']
+        ).select_related('fkIdEspacio').first()
+        if reserva_hoy and reserva_hoy.fkIdEspacio_id != espacio.pk:
+            messages.info(
+                request,
+                f'Tienes una reserva para hoy en el espacio {reserva_hoy.fkIdEspacio.espNumero}. '
+                'Usa la entrada general.'
             )
-            espacio.ocupar()
-            if reserva_hoy:
-                reserva_hoy.resEstado = 'COMPLETADA'
-                reserva_hoy.save()
+            return redirect('entrada_parqueadero')
 
-        email_utils.enviar_confirmacion_entrada(nuevo_registro)
+        try:
+            if reserva_hoy:
+                nuevo_registro = registrar_ingreso(reserva_hoy.fkIdVehiculo, reserva=reserva_hoy)
+                vehiculo = reserva_hoy.fkIdVehiculo
+            else:
+                nuevo_registro = registrar_ingreso(vehiculo, espacio_id=espacio.pk)
+        except IngresoRechazado as e:
+            messages.error(request, str(e))
+            return redirect('entrada_espacio', token=token)
+        # Lo que haya apartado la entrada general vuelve al pool sin esperar a que venza
+        RetencionEspacio.soltar(list(RetencionEspacio.objects.filter(fkIdUsuario_id=usuario_id)))
 
         return render(request, 'cliente/entrada_exitosa.html', {
             'vehiculo': vehiculo,
             'espacio': espacio,
-            'hora_entrada': timezone.localtime(now).strftime('%I:%M %p'),
+            'hora_entrada': timezone.localtime(nuevo_registro.parHoraEntrada).strftime('%I:%M %p'),
             'es_reserva': reserva_hoy is not None,
         })
 
@@ -1032,4 +1057,66 @@ class GenerarQRView(AdminRequiredMixin, View):
         return render(request, 'admin_panel/qr/generar.html', {
             'active_page': 'qr',
             'qr_url': qr_url,
+            'qr_por_espacio': settings.QR_POR_ESPACIO,
+            'pisos': Piso.objects.order_by('pk') if settings.QR_POR_ESPACIO else [],
         })
+
+
+class QREspaciosPDFView(AdminRequiredMixin, View):
+    """Hoja PDF con el QR firmado de cada espacio de un piso, para imprimir y pegar en el puesto."""
+
+    COLUMNAS = 3
+    FILAS = 4
+
+    def get(self, request, pk):
+        from reportlab.graphics import renderPDF
+        from reportlab.graphics.barcode.qr import QrCodeWidget
+        from reportlab.graphics.shapes import Drawing
+        from reportlab.lib.pagesizes import A4
+        from reportlab.lib.units import mm
+        from reportlab.pdfgen import canvas
+        import io
+
+        if not settings.QR_POR_ESPACIO:
+            raise Http404('El modo de QR por espacio no está activo.')
+        piso = get_object_or_404(Piso, pk=pk)
+        espacios = piso.espacios.select_related('fkIdTipoEspacio').order_by('espNumero')
+
+        buffer = io.BytesIO()
+        pdf = canvas.Canvas(buffer, pagesize=A4)
+        pdf.setTitle(f'QR espacios - {piso.pisNombre}')
+        ancho, alto = A4
+        margen = 12 * mm
+        celda_ancho = (ancho - 2 * margen) / self.COLUMNAS
+        celda_alto = (alto - 2 * margen) / self.FILAS
+        lado_qr = min(celda_ancho, celda_alto) - 22 * mm
+        por_pagina = self.COLUMNAS * self.FILAS
+
+        for i, espacio in enumerate(espacios):
+            if i and i % por_pagina == 0:
+                pdf.showPage()
+            fila, columna = divmod(i % por_pagina, self.COLUMNAS)
+            x = margen + columna * celda_ancho
+            y = alto - margen - (fila + 1) * celda_alto
+
+            url = request.build_absolute_uri(reverse('entrada_espacio', args=[firmar_qr_espacio(espacio.pk)]))
+            qr = QrCodeWidget(url, barLevel='M')
+            x0, y0, x1, y1 = qr.getBounds()
+            dibujo = Drawing(lado_qr, lado_qr, transform=[lado_qr / (x1 - x0), 0, 0, lado_qr / (y1 - y0), 0, 0])
+            dibujo.add(qr)
+            renderPDF.draw(dibujo, pdf, x + (celda_ancho - lado_qr) / 2, y + 14 * mm)
+
+            pdf.setStrokeColorRGB(0.8, 0.8, 0.8)
+            pdf.rect(x + 2 * mm, y + 2 * mm, celda_ancho - 4 * mm, celda_alto - 4 * mm)
+            pdf.setFont('Helvetica-Bold', 16)
+            pdf.drawCentredString(x + celda_ancho / 2, y + 8 * mm, espacio.espNumero)
+            pdf.setFont('Helvetica', 8)
+            pdf.drawCentredString(
+                x + celda_ancho / 2, y + 4 * mm, f'{piso.pisNombre} · {espacio.fkIdTipoEspacio.nombre}',
+            )
+        pdf.save()
+
+        buffer.seek(0)
+        response = HttpResponse(buffer, content_type='application/pdf')
+        response['Content-Disposition'] = f'attachment; filename="qr_espacios_piso_{piso.pk}.pdf"'
+        return response
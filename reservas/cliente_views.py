@@ -4,6 +4,7 @@ Vistas para que los clientes creen y gestionen sus reservas
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.db import transaction
+from django.db.models import Q
 from django.views import View
 from django.utils import timezone
 from datetime import datetime, date, timedelta
@@ -91,8 +92,7 @@ class ClienteCrearReservaView(ClienteRequiredMixin, View):
         # Verificar que no haya otra reserva para el mismo espacio en la misma fecha y hora
         reservas_conflicto = Reserva.objects.filter(
             fkIdEspacio=espacio,
-            resFechaReserva=fecha_inicio,
-            resHoraInicio=hora_inicio_obj,
+            resInicio=fecha_hora_inicio,
             resEstado__in=['PENDIENTE', 'CONFIRMADA']
         )
 
@@ -101,6 +101,11 @@ class ClienteCrearReservaView(ClienteRequiredMixin, View):
             return self.get(request)
 
         with transaction.atomic():
+            # Reclamo atómico: entre la validación y aquí otra reserva, una entrada o una
+            # retención pudo tomar el espacio
+            if Espacio.reclamar(espacio.pk, hacia='RESERVADO') is None:
+                messages.error(request, 'El espacio seleccionado no está disponible.')
+                return self.get(request)
             nueva_reserva = Reserva.objects.create(
                 resFechaReserva=fecha_inicio,
                 resHoraInicio=hora_inicio_obj,
@@ -108,7 +113,6 @@ class ClienteCrearReservaView(ClienteRequiredMixin, View):
                 fkIdEspacio=espacio,
                 fkIdVehiculo=vehiculo
             )
-            espacio.reservar()
 
         # Enviar correo de confirmación al cliente (en hilo separado, no bloquea)
         email_utils.enviar_confirmacion_reserva(nueva_reserva)
@@ -134,10 +138,7 @@ class ClienteEditarReservaView(ClienteRequiredMixin, View):
 
         # Verificar que no esté muy cerca de la fecha de reserva (min 1h antes)
         now = timezone.now()
-        fecha_hora_reserva = datetime.combine(reserva.resFechaReserva, reserva.resHoraInicio)
-        fecha_hora_reserva = timezone.make_aware(fecha_hora_reserva)
-
-        if fecha_hora_reserva - now < timedelta(hours=1):
+        if reserva.resInicio - now < timedelta(hours=1):
             messages.error(request, 'No puedes editar una reserva con menos de 1 hora de anticipación.')
             return redirect('dashboard')
 
@@ -191,9 +192,11 @@ class ClienteEditarReservaView(ClienteRequiredMixin, View):
             messages.error(request, 'Vehículo no válido.')
             return self.get(request, pk)
 
-        # Validar que el espacio exista y esté disponible
+        # Validar que el espacio exista y esté disponible (o sea el que ya tiene la reserva)
         try:
-            espacio = Espacio.objects.get(pk=espacio_id, espEstado='DISPONIBLE')
+            espacio = Espacio.objects.get(
+                Q(espEstado='DISPONIBLE') | Q(pk=reserva.fkIdEspacio_id), pk=espacio_id,
+            )
         except Espacio.DoesNotExist:
             messages.error(request, 'El espacio seleccionado no está disponible.')
             return self.get(request, pk)
@@ -219,8 +222,7 @@ class ClienteEditarReservaView(ClienteRequiredMixin, View):
         # Verificar que no haya otra reserva para el mismo espacio en la misma fecha y hora (excluyendo esta reserva)
         reservas_conflicto = Reserva.objects.filter(
             fkIdEspacio=espacio,
-            resFechaReserva=fecha_inicio,
-            resHoraInicio=hora_inicio_obj,
+            resInicio=fecha_hora_inicio,
             resEstado__in=['PENDIENTE', 'CONFIRMADA']
         ).exclude(pk=pk)
 
@@ -229,6 +231,13 @@ class ClienteEditarReservaView(ClienteRequiredMixin, View):
             return self.get(request, pk)
 
         with transaction.atomic():
+            if espacio.pk != reserva.fkIdEspacio_id:
+                # Cambio de espacio: reclamar el nuevo (otra reserva o una entrada pudo
+                # tomarlo desde la validación) y soltar el anterior
+                if Espacio.reclamar(espacio.pk, hacia='RESERVADO') is None:
+                    messages.error(request, 'El espacio seleccionado no está disponible.')
+                    return self.get(request, pk)
+                Espacio.liberar_reservado(reserva.fkIdEspacio_id)
             reserva.fkIdVehiculo = vehiculo
             reserva.fkIdEspacio = espacio
             reserva.resFechaReserva = fecha_inicio
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:02
+
+from datetime import datetime, timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def poblar_rangos(apps, schema_editor):
+    # Misma regla que Reserva.calcular_rango (los modelos históricos no tienen sus métodos)
+    Reserva = apps.get_model('reservas', 'Reserva')
+    reservas = list(Reserva.objects.only('resFechaReserva', 'resHoraInicio', 'resHoraFin'))
+    for reserva in reservas:
+        fecha = reserva.resFechaReserva
+        reserva.resInicio = timezone.make_aware(datetime.combine(fecha, reserva.resHoraInicio))
+        reserva.resFin = None
+        if reserva.resHoraFin is not None:
+            fin = timezone.make_aware(datetime.combine(fecha, reserva.resHoraFin))
+            if fin <= reserva.resInicio:
+                fin = timezone.make_aware(datetime.combine(fecha + timedelta(days=1), reserva.resHoraFin))
+            reserva.resFin = fin
+    Reserva.objects.bulk_update(reservas, ['resInicio', 'resFin'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reservas', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reserva',
+            name='resInicio',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='reserva',
+            name='resFin',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(poblar_rangos, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='reserva',
+            name='resInicio',
+            field=models.DateTimeField(editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='reserva',
+            index=models.Index(fields=['resEstado', 'resInicio'], name='idx_reserva_estado_inicio'),
+        ),
+    ]
@@ -12,6 +12,11 @@ class Reserva(models.Model):
     resFechaReserva = models.DateField()
     resHoraInicio = models.TimeField()
     resHoraFin = models.TimeField(null=True, blank=True)  # Ahora es opcional
+    # Fecha + hora en un solo instante aware, calculado en save() — NO editar a mano.
+    # Las ventanas de tiempo ("vence en 15 min", "próxima en 2h", "de hoy") se filtran
+    # en la BD por rango sobre esta columna en vez de combinar fecha y hora en Python.
+    resInicio = models.DateTimeField(editable=False)
+    resFin = models.DateTimeField(null=True, editable=False)
     resEstado = models.CharField(
         max_length=10,
         choices=EstadoChoices.choices,
@@ -36,39 +41,93 @@ class Reserva(models.Model):
         # Shortcut para verificar si la reserva está en estado CONFIRMADA
         return self.resEstado == self.EstadoChoices.CONFIRMADA
 
+    @staticmethod
+    def calcular_rango(fecha, hora_inicio, hora_fin=None):
+        """
+        (inicio, fin) aware en la zona local. Si la hora de fin es menor o igual que la de
+        inicio la reserva cruza la medianoche y el fin cae al día siguiente.
+        """
+        from datetime import datetime, timedelta
+        from django.utils import timezone
+        inicio = timezone.make_aware(datetime.combine(fecha, hora_inicio))
+        if hora_fin is None:
+            return inicio, None
+        fin = timezone.make_aware(datetime.combine(fecha, hora_fin))
+        if fin <= inicio:
+            fin = timezone.make_aware(datetime.combine(fecha + timedelta(days=1), hora_fin))
+        return inicio, fin
+
+    def save(self, *args, **kwargs):
+        # Las vistas asignan fecha y hora como strings del formulario: se normalizan
+        # antes de combinarlas para que resInicio/resFin siempre queden al día
+        for campo in ('resFechaReserva', 'resHoraInicio', 'resHoraFin'):
+            setattr(self, campo, self._meta.get_field(campo).to_python(getattr(self, campo)))
+        self.resInicio, self.resFin = self.calcular_rango(
+            self.resFechaReserva, self.resHoraInicio, self.resHoraFin,
+        )
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'resFechaReserva', 'resHoraInicio', 'resHoraFin'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'resInicio', 'resFin'}
+        super().save(*args, **kwargs)
+
     def cerrar(self, nuevo_estado):
         """Cambia el estado de la reserva y libera el espacio si estaba RESERVADO."""
+        from parqueadero.models import Espacio, VersionParqueadero
         self.resEstado = nuevo_estado
         self.save()
-        espacio = self.fkIdEspacio
-        if espacio.espEstado == 'RESERVADO':
-            espacio.liberar()
+        Espacio.liberar_reservado(self.fkIdEspacio_id)
+        # Aunque el espacio no estuviera RESERVADO, la reserva deja de aparecer
+        # como "próxima" en el mapa y en las solicitudes de entrada del guardia
+        VersionParqueadero.incrementar()
 
     @classmethod
     def cancelar_vencidas(cls):
         """
-        Cancela las reservas PENDIENTES cuya hora de inicio ya pasó o está en ≤15 min,
-        y libera los espacios que estaban bloqueados por ellas.
+        Cancela las reservas PENDIENTES cuya hora de inicio ya pasó o está en ≤15 min y
+        las CONFIRMADAS cuyo vehículo no llegó 15 min después del inicio, y libera los
+        espacios que estaban bloqueados por ellas.
         """
         from django.utils import timezone
-        from datetime import datetime, timedelta
-        from parqueadero.models import Espacio
+        from datetime import timedelta
+        from django.db import transaction
+        from django.db.models import Q
+        from parqueadero.models import ContadorEspacios, Espacio, VersionParqueadero
+        from parqueadero.utils import pool_espacios
         now = timezone.now()
-        ids_vencidas = [
-            r.pk for r in cls.objects.filter(resEstado='PENDIENTE').select_related('fkIdEspacio')
-            if (timezone.make_aware(datetime.combine(r.resFechaReserva, r.resHoraInicio)) - now)
-               <= timedelta(minutes=15)
-        ]
+        ids_vencidas = list(cls.objects.filter(
+            Q(resEstado='PENDIENTE', resInicio__lte=now + timedelta(minutes=15))
+            | Q(resEstado='CONFIRMADA', resInicio__lt=now - timedelta(minutes=15))
+        ).values_list('pk', flat=True))
         if ids_vencidas:
-            # Liberar los espacios antes de cancelar las reservas
-            Espacio.objects.filter(
-                reservas__pk__in=ids_vencidas,
-                espEstado='RESERVADO'
-            ).update(espEstado='DISPONIBLE')
-            cls.objects.filter(pk__in=ids_vencidas).update(resEstado='CANCELADA')
+            with transaction.atomic():
+                # Liberar los espacios antes de cancelar las reservas
+                espacios = {
+                    pk: (piso_id, tipo_id, numero)
+                    for pk, piso_id, tipo_id, numero in Espacio.objects.select_for_update().filter(
+                        reservas__pk__in=ids_vencidas,
+                        espEstado='RESERVADO'
+                    ).values_list('pk', 'fkIdPiso_id', 'fkIdTipoEspacio_id', 'espNumero')
+                }
+                Espacio.objects.filter(pk__in=espacios).update(espEstado='DISPONIBLE')
+                cls.objects.filter(pk__in=ids_vencidas).update(resEstado='CANCELADA')
+                # .update() no pasa por Espacio.liberar(): contadores, pool y versión a mano
+                ContadorEspacios.aplicar(
+                    salen=[(piso_id, tipo_id, 'RESERVADO') for piso_id, tipo_id, _ in espacios.values()],
+                    entran=[(piso_id, tipo_id, 'DISPONIBLE') for piso_id, tipo_id, _ in espacios.values()],
+                )
+
+                def avisar_pool():
+                    for pk, (piso_id, tipo_id, numero) in espacios.items():
+                        pool_espacios.actualizar(pk, (piso_id, tipo_id, 'DISPONIBLE'), numero)
+                transaction.on_commit(avisar_pool)
+                VersionParqueadero.incrementar()
 
     class Meta:
         db_table = 'reservas'
+        indexes = [
+            # Todas las ventanas de tiempo filtran por estado + rango de inicio
+            models.Index(fields=['resEstado', 'resInicio'], name='idx_reserva_estado_inicio'),
+        ]
         verbose_name = 'Reserva'
         verbose_name_plural = 'Reservas'
 
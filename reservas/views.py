@@ -130,13 +130,12 @@ class ReservaEditarView(AdminRequiredMixin, View):
             return redirect('admin_reservas_editar', pk=pk)
 
         with transaction.atomic():
-            # Si cambia el espacio, liberar el anterior y bloquear el nuevo
-            espacio_anterior = reserva.fkIdEspacio
-            if espacio_anterior.pk != nuevo_espacio.pk:
-                if espacio_anterior.espEstado == 'RESERVADO':
-                    espacio_anterior.liberar()
-                if nuevo_espacio.espEstado == 'DISPONIBLE':
-                    nuevo_espacio.reservar()
+            # Si cambia el espacio, liberar el anterior y bloquear el nuevo. Ambos se
+            # cambian solo si siguen en el estado esperado: los cargados arriba pudieron
+            # ser tomados por una entrada mientras tanto
+            if reserva.fkIdEspacio_id != nuevo_espacio.pk:
+                Espacio.liberar_reservado(reserva.fkIdEspacio_id)
+                Espacio.reclamar(nuevo_espacio.pk, hacia='RESERVADO')
 
             reserva.fkIdEspacio = nuevo_espacio
             reserva.fkIdVehiculo = vehiculo
@@ -211,6 +210,14 @@ class AdminCrearReservaView(AdminRequiredMixin, View):
             return redirect('admin_dashboard')
 
         with transaction.atomic():
+            # Reclamo atómico: entre la validación y aquí otra reserva o una entrada pudo
+            # tomar el espacio
+            if Espacio.reclamar(espacio.pk, hacia='RESERVADO') is None:
+                msg = 'El espacio no está disponible.'
+                if is_ajax:
+                    return JsonResponse({'ok': False, 'error': msg}, status=400)
+                messages.error(request, msg)
+                return redirect('admin_dashboard')
             reserva = Reserva.objects.create(
                 fkIdEspacio=espacio,
                 fkIdVehiculo=vehiculo,
@@ -219,7 +226,6 @@ class AdminCrearReservaView(AdminRequiredMixin, View):
                 resHoraFin=hora_fin_obj,
                 resEstado='PENDIENTE',
             )
-            espacio.reservar()
 
         if is_ajax:
             return JsonResponse({'ok': True, 'reserva_id': reserva.pk})
@@ -45,6 +45,19 @@ class Tarifa(models.Model):
     def __str__(self):
         return f'{self.nombre} - {self.fkIdTipoEspacio.nombre}'
 
+    def save(self, *args, **kwargs):
+        # La tarifa activa entra en los costos estimados de los dashboards y del detalle
+        # de ocupación: cualquier cambio invalida sus snapshots/ETags.
+        from parqueadero.models import VersionParqueadero
+        super().save(*args, **kwargs)
+        VersionParqueadero.incrementar()
+
+    def delete(self, *args, **kwargs):
+        from parqueadero.models import VersionParqueadero
+        resultado = super().delete(*args, **kwargs)
+        VersionParqueadero.incrementar()
+        return resultado
+
     @classmethod
     def get_active_for(cls, tipo_espacio):
         """
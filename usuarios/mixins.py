@@ -1,4 +1,8 @@
+import hmac
+
+from django.conf import settings
 from django.contrib import messages
+from django.http import JsonResponse
 from django.shortcuts import redirect
 
 # Mapa de rol → URL de destino tras login/registro exitoso.
@@ -61,3 +65,20 @@ class ClienteRequiredMixin:
             messages.error(request, 'Debes iniciar sesión.')
             return redirect('home')
         return super().dispatch(request, *args, **kwargs)  # type: ignore[attr-defined]
+
+
+class CamaraRequiredMixin:
+    """
+    Autentica dispositivos de portería (cámaras LPR) con `Authorization: Bearer <clave>`.
+
+    No usa sesión: las claves válidas vienen de settings.LPR_API_KEYS y, si no hay
+    ninguna configurada, el endpoint queda cerrado.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        esquema, _, clave = request.headers.get('Authorization', '').partition(' ')
+        clave = clave.strip().encode()
+        # compare_digest: tiempo constante, no filtra cuántos caracteres coinciden
+        if esquema != 'Bearer' or not clave or not any(hmac.compare_digest(clave, k.encode()) for k in settings.LPR_API_KEYS):
+            return JsonResponse({'error': 'Credenciales de cámara inválidas.'}, status=401)
+        return super().dispatch(request, *args, **kwargs)  # type: ignore[attr-defined]
@@ -187,11 +187,12 @@ def dashboard_view(request):
     ).order_by('-pk')
 
     # Reservas del usuario (activas y futuras)
-    from datetime import datetime, timedelta
+    from datetime import timedelta
 
     now = timezone.now()
 
     # Auto-cancela reservas PENDIENTES cuya hora de inicio es en 15 minutos o menos
+    # y las CONFIRMADAS con más de 15 minutos de retraso
     Reserva.cancelar_vencidas()
 
     reservas_raw = Reserva.objects.filter(
@@ -201,15 +202,12 @@ def dashboard_view(request):
         'fkIdVehiculo',
         'fkIdEspacio',
         'fkIdEspacio__fkIdPiso'
-    ).order_by('-resFechaReserva', '-resHoraInicio')[:5]
+    ).order_by('-resInicio')[:5]
 
     # Para cada reserva calcula si está dentro de la ventana de confirmación (< 1h) o si aún puede editarse
     reservas = []
     for reserva in reservas_raw:
-        fecha_hora_reserva = datetime.combine(reserva.resFechaReserva, reserva.resHoraInicio)
-        fecha_hora_reserva = timezone.make_aware(fecha_hora_reserva)
-
-        tiempo_restante = fecha_hora_reserva - now
+        tiempo_restante = reserva.resInicio - now
         necesita_confirmacion = timedelta(0) <= tiempo_restante <= timedelta(hours=1)
         puede_editar = tiempo_restante > timedelta(hours=1)
 